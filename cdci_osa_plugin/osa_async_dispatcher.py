@@ -0,0 +1,316 @@
+"""
+Overview
+--------
+
+asyncio counterpart of OsaDispatcher: submission to the DDA backend, polling
+of delegated ReportScWList requests, pokes and the timesystem API go through
+an async HTTP client (aiohttp), so that one event loop can drive many
+concurrent submissions. Answers and failures are mapped to QueryOutput and
+DDAException by the same OsaDispatcher methods as in the blocking dispatcher,
+and the process-wide health monitor and circuit breaker are shared.
+
+aiohttp is an optional dependency, install with `cdci_osa_plugin[async]`
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   AsyncOsaDispatcher
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import asyncio
+import functools
+import json
+import logging
+import time
+import weakref
+
+# Project
+import ddaclient as dc
+from cdci_data_analysis.analysis.products import QueryOutput
+
+from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher
+from cdci_osa_plugin.osa_scwlist_cache import scwlist_cache
+from cdci_osa_plugin.osa_dda_client import (dda_health_monitor, dda_circuit_breaker, dda_single_flight,
+                                            get_exception_status_message, DDAHealthState, _env_int)
+
+
+logger = logging.getLogger(__name__)
+
+
+# one session per event loop: aiohttp sessions can not be shared between loops
+_http_sessions = weakref.WeakKeyDictionary()
+
+
+def get_http_session():
+    """
+    keep-alive aiohttp session of the running event loop, created on first use
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("AsyncOsaDispatcher needs aiohttp, install cdci_osa_plugin[async]")
+
+    loop = asyncio.get_running_loop()
+
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=_env_int('CDCI_OSA_PLUGIN_DDA_ASYNC_MAX_CONNECTIONS', 100))
+        session = aiohttp.ClientSession(connector=connector)
+        _http_sessions[loop] = session
+
+    return session
+
+
+async def close_http_session():
+    """
+    close the session of the running event loop, to be awaited before the loop is closed
+    """
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncOsaDispatcher(OsaDispatcher):
+    """
+    OsaDispatcher with coroutine run_query, test_communication and test_has_input_products
+
+    n_retries and retry_sleep_s follow ddaclient.RemoteDDA.query, which retries unexpected failures;
+    poll_interval_s is the delay between polls of a delegated ReportScWList request
+    """
+
+    n_retries = 10
+    retry_sleep_s = 5
+    poll_interval_s = 2
+
+    async def query_dda_async(self, remote, target, modules=[], assume=[], inject=[], prompt_delegate=True,
+                              callback=None, n_retries=None, record=True):
+        """
+        async equivalent of OsaDispatcher.query_dda, raising the same ddaclient exceptions
+        """
+        try:
+            res = await self._query_dda_retrying(remote, target, modules, assume, inject, prompt_delegate, callback,
+                                                 n_retries)
+        except Exception as e:
+            if record:
+                self.record_dda_outcome(e)
+            raise
+
+        if record:
+            self.record_dda_outcome()
+        return res
+
+    async def _query_dda_retrying(self, remote, target, modules, assume, inject, prompt_delegate, callback, n_retries):
+        # as RemoteDDA.query
+        if n_retries is None:
+            n_retries = self.n_retries
+
+        for i in reversed(range(n_retries)):
+            try:
+                return await self._query_dda(remote, target, modules, assume, inject, prompt_delegate, callback)
+            except (dc.NotAuthorizedOnDDA, dc.AnalysisException, dc.PermanentAnalysisException,
+                    dc.AnalysisDelegatedException):
+                raise
+            except Exception as e:
+                logger.warning("something failed in query: %s, %s / %s attempts left", repr(e), i, n_retries)
+                if i == 0:
+                    raise
+                await asyncio.sleep(self.retry_sleep_s)
+
+    async def _query_dda(self, remote, target, modules, assume, inject, prompt_delegate, callback):
+        import aiohttp
+
+        p = remote.prepare_request(target, modules, assume, inject, prompt_delegate, callback)
+        auth = remote.secret.get_auth()
+
+        logger.info("request to pipeline with parameters: %s", p)
+
+        async with get_http_session().post(p['url'],
+                                           data=json.dumps(p['params']),
+                                           auth=aiohttp.BasicAuth(auth.username, auth.password or '')) as response:
+            status = response.status
+            text = await response.text()
+
+        if status != 200:
+            if status in [403, 401]:
+                raise dc.NotAuthorizedOnDDA(f"used auth from {remote.secret._auth_source}, raw response {text}")
+            else:
+                raise dc.UnknownDDABackendProblem(f"got unexpected response status {status}, raw response {text}")
+
+        if target == "poke":
+            return
+
+        # interpreting the response may download files from the backend cache, with the blocking pooled client
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._interpret_dda_response, remote, text))
+
+    @staticmethod
+    def _interpret_dda_response(remote, text):
+        response_json = json.loads(text)
+        try:
+            return dc.DDAproduct(response_json, remote.ddcache_root_local, remote)
+        except dc.WorkerException as e:
+            result = response_json.get('result')
+            worker_output = result.get('output') if isinstance(result, dict) else None
+            raise dc.WorkerException("no reasonable response!", content=text,
+                                     worker_output=worker_output, product_exception=e)
+        except (dc.AnalysisException, dc.AnalysisDelegatedException):
+            raise
+        except Exception as e:
+            raise Exception(f"UNKNOWN exception in worker {e}, response was {text[:200]}...")
+
+    async def poke(self):
+        """
+        async equivalent of DDAHealthMonitor.poke, the outcome is recorded by the shared health monitor
+        """
+        t0 = time.monotonic()
+        try:
+            # recorded by the health monitor, below
+            await self.query_dda_async(self.get_remote_dda(), "poke", n_retries=1, record=False)
+            state = DDAHealthState(self.data_server_url, True, 'OK', time.monotonic() - t0)
+        except Exception as e:
+            state = DDAHealthState(self.data_server_url, False, get_exception_status_message(e), time.monotonic() - t0,
+                                   exception=e)
+            logger.info("poke of %s failed: %s", self.data_server_url, repr(e))
+
+        return dda_health_monitor.record_state(state)
+
+    async def test_communication(self, max_trial=120, sleep_s=1, logger=None):
+        query_out = QueryOutput()
+
+        if dda_circuit_breaker.is_open(self.data_server_url):
+            self.set_backend_degraded(query_out, 'test connection', logger=logger)
+
+        state = dda_health_monitor.get_fresh_state(self.data_server_url)
+
+        if state is None:
+            for i in range(max_trial):
+                if not dda_circuit_breaker.allow_request(self.data_server_url):
+                    self.set_backend_degraded(query_out, 'test connection', logger=logger)
+
+                state = await self.poke()
+
+                if state.ok:
+                    break
+
+                query_out.set_query_exception(state.exception, 'test connection',
+                                              message='connection_status=%s' % state.status, logger=logger)
+
+                # a fixed delay bounds the wait to about max_trial * sleep_s, backoff is left to the circuit breaker
+                if i < max_trial - 1:
+                    await asyncio.sleep(sleep_s)
+
+        if not state.ok:
+            self.set_communication_failed(query_out, state, logger=logger)
+
+        #DONE
+        query_out.set_done(message='', debug_message='')
+
+        return query_out
+
+    async def test_has_input_products(self, instrument, logger=None):
+        scw_list = instrument.get_par_by_name('scw_list').value
+
+        if (scw_list is not None and scw_list != []) or \
+                self._test_products_method not in ("timesystem", "ReportScWList"):
+            # nothing to wait for, or no async client for the method
+            return await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(OsaDispatcher.test_has_input_products, self, instrument, logger=logger))
+
+        RA = instrument.get_par_by_name('RA').value
+        DEC = instrument.get_par_by_name('DEC').value
+        radius = instrument.get_par_by_name('radius').value
+        use_max_pointings = instrument.get_par_by_name('max_pointings').value
+        T1_iso = instrument.get_par_by_name('T1')._astropy_time.isot
+        T2_iso = instrument.get_par_by_name('T2')._astropy_time.isot
+
+        query_out = QueryOutput()
+
+        if self._test_products_method == "timesystem":
+            async def fetch(t1, t2):
+                async with get_http_session().get(self.get_timesystem_scwlist_url(t1, t2, RA, DEC, radius)) as response:
+                    return await response.json(content_type=None)
+
+            scwlist_lookup = scwlist_cache.lookup(RA, DEC, radius, T1_iso, T2_iso, key=('timesystem',))
+            prod_list_raw = scwlist_lookup.scw_list
+            if prod_list_raw is None:
+                prod_list_raw = scwlist_cache.complete(
+                    scwlist_lookup, await asyncio.gather(*[fetch(t1, t2) for t1, t2 in scwlist_lookup.missing]))
+
+            return query_out, self.select_timesystem_scwlist(prod_list_raw)
+
+        target, modules, assume = self.get_report_scwlist_query(T1_iso, T2_iso, RA, DEC, radius, use_max_pointings)
+
+        scwlist_lookup = scwlist_cache.lookup(RA, DEC, radius, T1_iso, T2_iso,
+                                              key=('ReportScWList', use_max_pointings), exact=True)
+
+        if scwlist_lookup.scw_list is not None:
+            query_out.set_done(message='', debug_message='')
+            return query_out, scwlist_lookup.scw_list
+
+        remote = self.get_remote_dda()
+
+        while True:
+            if not dda_circuit_breaker.allow_request(self.data_server_url):
+                self.set_backend_degraded(query_out, 'test has input prods', logger=logger)
+
+            try:
+                product = await self.query_dda_async(remote, target, modules, assume)
+                prod_list = self.set_report_scwlist_done(product, query_out, logger=logger)
+                scwlist_cache.complete(scwlist_lookup, [prod_list])
+                break
+
+            except dc.AnalysisDelegatedException as e:
+                logger.info("waiting for ReportScWList: %s", e)
+                await asyncio.sleep(self.poll_interval_s)
+
+            except Exception as e:
+                self.set_has_input_products_exception(e, query_out, logger=logger)
+
+        return query_out, prod_list
+
+    async def run_query(self, call_back_url, run_asynch=True, logger=None, target=None, modules=None, assume=None):
+        if target is None:
+            target = self.target
+
+        if modules is None:
+            modules = self.modules
+
+        if assume is None:
+            assume = self.assume
+
+        res = None
+        query_out = QueryOutput()
+
+        if not dda_circuit_breaker.allow_request(self.data_server_url):
+            self.set_backend_degraded(query_out, 'run query ', logger=logger)
+
+        try:
+            res = await dda_single_flight.do_async(
+                dda_single_flight.key(target, modules, assume, self.inject, prompt_delegate=run_asynch,
+                                      data_server_url=self.data_server_url,
+                                      data_server_cache=self.data_server_cache),
+                lambda: self.query_dda_async(self.get_remote_dda(),
+                                             target,
+                                             modules=modules,
+                                             assume=assume,
+                                             inject=self.inject,
+                                             prompt_delegate=run_asynch,
+                                             callback=call_back_url))
+
+            self.set_run_query_done(res, query_out)
+
+        except Exception as e:
+            self.set_run_query_exception(e, res, query_out, logger=logger)
+
+        return res, query_out
@@ -0,0 +1,226 @@
+"""
+Overview
+--------
+
+canonical form of the DDA queries built by the plugin: the same request should
+always produce the same assumption strings, so that it hits the same backend
+cache entries. Numbers are formatted uniformly (E1=20 and E1=20.0 both give
+20.0, also in use_version tags), whitespace outside string literals is
+normalized, and ScW lists are sorted and deduplicated.
+
+CDCI_OSA_PLUGIN_CANONICAL_ASSUME selects the mode:
+
+ * yes: canonical queries are sent
+ * report (default): raw queries are sent, and for a sampled fraction of
+   them (CDCI_OSA_PLUGIN_CANONICAL_REPORT_FRACTION, 0.01 by default) the
+   canonical query is built as well: canonicalization_report records which
+   distinct raw queries would have collapsed onto the same canonical query
+ * no: raw queries are sent
+
+Canonical queries are not byte-identical to the raw ones (e.g. whitespace,
+ScW order, numbers such as 20.000000000000004), and would miss the backend
+cache entries of the raw ones: yes is opt-in, once the report shows it is
+worth the cache misses.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   canonical_query
+   canonical_number
+   canonical_whitespace
+   canonical_scw_list
+   CanonicalizationReport
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Project
+from cdci_osa_plugin.osa_dda_client import _env_float
+
+
+logger = logging.getLogger(__name__)
+
+
+canonical_mode = os.environ.get('CDCI_OSA_PLUGIN_CANONICAL_ASSUME', 'report')
+
+if canonical_mode not in ('yes', 'report', 'no'):
+    logger.warning("ignoring CDCI_OSA_PLUGIN_CANONICAL_ASSUME=%s, should be yes, report or no", canonical_mode)
+    canonical_mode = 'report'
+
+# in report mode, the query is built a second time, canonically, for this fraction of the requests
+canonical_report_fraction = _env_float('CDCI_OSA_PLUGIN_CANONICAL_REPORT_FRACTION', 0.01)
+
+
+_formatting = threading.local()
+
+
+def _canonicalizing():
+    return getattr(_formatting, 'canonical', canonical_mode == 'yes')
+
+
+@contextmanager
+def _canonical_formatting(enabled):
+    previous = getattr(_formatting, 'canonical', None)
+    _formatting.canonical = enabled
+    try:
+        yield
+    finally:
+        if previous is None:
+            del _formatting.canonical
+        else:
+            _formatting.canonical = previous
+
+
+def canonical_number(value, significant_digits=10):
+    """
+    number formatted for an assumption string: shortest repr of the float, rounded to significant_digits to absorb
+    conversion noise; non-numbers and raw mode give '%s' % value
+    """
+    if not _canonicalizing():
+        return '%s' % (value,)
+
+    try:
+        f = float(value)
+    except (TypeError, ValueError):
+        return '%s' % (value,)
+
+    if not math.isfinite(f):
+        return '%s' % (value,)
+
+    # + 0. turns -0. into 0.
+    return repr(float('%.*g' % (significant_digits, f)) + 0.)
+
+
+_string_or_space = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|(\s+)''')
+
+
+def _is_word(c):
+    return c.isalnum() or c == '_'
+
+
+def canonical_whitespace(expression):
+    """
+    assumption expression without whitespace outside string literals, except a single space between two words
+    """
+    if not _canonicalizing():
+        return expression
+
+    def sub(m):
+        if m.group(1) is not None:
+            return m.group(1)
+
+        before = expression[m.start() - 1:m.start()]
+        after = expression[m.end():m.end() + 1]
+        if before and after and _is_word(before) and _is_word(after):
+            return ' '
+        return ''
+
+    return _string_or_space.sub(sub, expression)
+
+
+def canonical_scw_list(scw_list):
+    """
+    ScW ids, sorted and without duplicates; in raw mode only stripped
+    """
+    scw_list = [scw.strip() for scw in scw_list]
+
+    if not _canonicalizing():
+        return scw_list
+
+    return sorted(set(scw_list))
+
+
+def _query_key(query):
+    target, modules, assume = query[:3]
+    return json.dumps(dict(target=target, modules=list(modules), assume=list(assume)), sort_keys=True)
+
+
+class CanonicalizationReport(object):
+    """
+    distinct raw queries seen for each canonical query, i.e. the requests which share (or, in report mode,
+    would share) backend cache entries thanks to canonicalization
+
+    max_queries: number of canonical queries kept, least recently seen are dropped
+    """
+
+    def __init__(self, max_queries=10000):
+        self.max_queries = max_queries
+
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, raw, canonical):
+        raw_key = _query_key(raw)
+        canonical_key = _query_key(canonical)
+
+        with self._lock:
+            variants = self._variants.pop(canonical_key, None)
+            if variants is None:
+                variants = {}
+            self._variants[canonical_key] = variants
+
+            new_variant = raw_key not in variants
+            variants[raw_key] = variants.get(raw_key, 0) + 1
+            n_variants = len(variants)
+
+            while len(self._variants) > self.max_queries:
+                self._variants.popitem(last=False)
+
+        if new_variant and n_variants > 1:
+            logger.info("%d distinct raw queries collapse onto canonical query %s, new: %s",
+                        n_variants, canonical_key, raw_key)
+
+    def collisions(self):
+        """
+        {canonical query: {raw query: number of requests}}, for canonical queries with more than one raw variant
+        """
+        with self._lock:
+            return {canonical_key: dict(variants)
+                    for canonical_key, variants in self._variants.items() if len(variants) > 1}
+
+
+canonicalization_report = CanonicalizationReport()
+
+
+def canonical_query(build, *args, **kwargs):
+    """
+    build(*args, **kwargs) returns the query as (target, modules, assume, ...); returns it with canonical
+    formatting of numbers and ScW lists in build, and canonical whitespace in assume, depending on the mode;
+    in report mode only sampled requests are built twice
+    """
+    if canonical_mode != 'yes':
+        with _canonical_formatting(False):
+            raw = build(*args, **kwargs)
+
+        if canonical_mode == 'no' or random.random() >= canonical_report_fraction:
+            return raw
+
+    with _canonical_formatting(True):
+        query = build(*args, **kwargs)
+        canonical = (query[0], query[1], [canonical_whitespace(a) for a in query[2]]) + tuple(query[3:])
+
+    if canonical_mode == 'yes':
+        return canonical
+
+    canonicalization_report.record(raw, canonical)
+
+    return raw
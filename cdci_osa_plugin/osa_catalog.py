@@ -36,14 +36,262 @@ __author__ = "Andrea Tramacere"
 # Project
 # relative import eg: from .mod import f
 import  numpy as np
+import hashlib
+import json
+import itertools
+import threading
+from collections import OrderedDict
 
 from astropy.io import  fits as pf
+from astropy.table import Table
 from cdci_data_analysis.analysis.io_helper import FitsFile
 from cdci_data_analysis.analysis.catalog import BasicCatalog
 
+from cdci_osa_plugin.osa_scw_index import _unit_vectors
 
 
-class OsaIsgriCatalog(BasicCatalog):
+
+def read_srclres_columns(srclres, columns):
+    """
+    frame and the given columns of a srclres catalog, NAME stripped; the table is memory-mapped and only these
+    columns are read
+    """
+    with pf.open(FitsFile(srclres).file_path.path, memmap=True) as f:
+        catalog = f[1]
+        frame = catalog.header['RADECSYS'].lower()
+
+        # copies, the file is closed after
+        data = {n: np.array(catalog.data[n]) for n in columns}
+
+    if 'NAME' in data:
+        data['NAME'] = np.char.strip(data['NAME'].astype(str)).tolist()
+
+    return frame, data
+
+
+class CatalogIndex(object):
+    """
+    spatial index and significance order of the sources of a catalog, all rows regardless of the selection
+
+    cone and nearest neighbour searches use a KD-tree on unit vectors (scipy, optional), or without scipy
+    binary search on declination; significance cuts use binary search on the sorted significance
+    """
+
+    def __init__(self, ra, dec, significance):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self._xyz = _unit_vectors(self.ra, self.dec)
+
+        significance = np.asarray(significance, dtype=float)
+        # nan, as masked, are last and never above a threshold
+        self._significance_order = np.argsort(significance, kind='stable')
+        self._sorted_significance = significance[self._significance_order]
+        self._n_finite = int(np.count_nonzero(~np.isnan(significance)))
+
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            self._tree = None
+            self._dec_order = np.argsort(self.dec, kind='stable')
+            self._sorted_dec = self.dec[self._dec_order]
+        else:
+            self._tree = cKDTree(self._xyz)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def significance_above(self, threshold):
+        """
+        mask of the rows with significance > threshold
+        """
+        first = np.searchsorted(self._sorted_significance[:self._n_finite], threshold, side='right')
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self._significance_order[first:self._n_finite]] = True
+        return mask
+
+    def cone_search(self, ra, dec, radius):
+        """
+        rows within radius (deg) of ra, dec (deg), sorted
+        """
+        xyz = _unit_vectors(ra, dec)
+
+        if self._tree is not None:
+            # chord length, slightly larger to be exact after the angular cut below
+            rows = np.asarray(self._tree.query_ball_point(xyz, 2 * np.sin(np.radians(min(radius, 180.)) / 2) + 1e-12),
+                              dtype=int)
+        else:
+            first = np.searchsorted(self._sorted_dec, dec - radius, side='left')
+            last = np.searchsorted(self._sorted_dec, dec + radius, side='right')
+            rows = self._dec_order[first:last]
+
+        rows = rows[self._xyz[rows] @ xyz >= np.cos(np.radians(radius))]
+        return np.sort(rows)
+
+    def nearest(self, ra, dec, k=1):
+        """
+        rows of the k nearest sources to ra, dec (deg), and their separations (deg), nearest first
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        xyz = _unit_vectors(ra, dec)
+
+        if self._tree is not None:
+            _, rows = self._tree.query(xyz, k=k)
+            rows = np.atleast_1d(rows)
+        else:
+            rows = np.argpartition(-(self._xyz @ xyz), k - 1)[:k]
+
+        separation = np.degrees(np.arccos(np.clip(self._xyz[rows] @ xyz, -1., 1.)))
+        order = np.argsort(separation, kind='stable')
+        return rows[order], separation[order]
+
+    def query_pairs(self, ra, dec, radius):
+        """
+        for arrays of points ra, dec (deg): (point, row, separation in deg) of all the rows within radius (deg,
+        scalar or per point) of each point, by point
+        """
+        xyz = _unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), xyz.shape[:1])
+
+        if len(xyz) == 0 or len(self) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+        if self._tree is not None:
+            row_lists = self._tree.query_ball_point(xyz, 2 * np.sin(np.radians(np.minimum(radius, 180.)) / 2) + 1e-12)
+            counts = np.fromiter(map(len, row_lists), dtype=int, count=len(row_lists))
+            rows = np.fromiter(itertools.chain.from_iterable(row_lists), dtype=int, count=int(counts.sum()))
+        else:
+            dec = np.atleast_1d(np.asarray(dec, dtype=float))
+            first = np.searchsorted(self._sorted_dec, dec - radius, side='left')
+            last = np.searchsorted(self._sorted_dec, dec + radius, side='right')
+            counts = last - first
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows = self._dec_order[np.repeat(first, counts) + offsets]
+
+        points = np.repeat(np.arange(len(xyz)), counts)
+
+        cos_separation = np.einsum('ij,ij->i', self._xyz[rows], xyz[points])
+        keep = cos_separation >= np.cos(np.radians(radius[points]))
+
+        return points[keep], rows[keep], np.degrees(np.arccos(np.clip(cos_separation[keep], -1., 1.)))
+
+
+_catalog_indices = OrderedDict()
+_catalog_indices_lock = threading.Lock()
+_catalog_indices_max = 64
+
+
+def get_catalog_index(catalog):
+    """
+    CatalogIndex of a BasicCatalog, shared by catalogs with the same content, e.g. across requests
+    """
+    sc = catalog._sc.fk5
+    ra = np.asarray(sc.ra.deg, dtype=float)
+    dec = np.asarray(sc.dec.deg, dtype=float)
+    significance = np.ma.filled(np.ma.asarray(catalog._table['significance'], dtype=float), np.nan)
+
+    key = hashlib.sha256(ra.tobytes() + dec.tobytes() + significance.tobytes()).hexdigest()
+
+    with _catalog_indices_lock:
+        index = _catalog_indices.pop(key, None)
+        if index is None:
+            index = CatalogIndex(ra, dec, significance)
+        _catalog_indices[key] = index
+
+        while len(_catalog_indices) > _catalog_indices_max:
+            _catalog_indices.popitem(last=False)
+
+    return index
+
+
+class IndexedCatalog(object):
+    """
+    searches over a catalog through its CatalogIndex, rows are in the full table regardless of the selection
+    """
+
+    @property
+    def index(self):
+        """
+        CatalogIndex of the catalog, looked up once, and again only if its table or coordinates are replaced
+        """
+        cached = getattr(self, '_index', None)
+        if cached is None or cached[0] is not self._table or cached[1] is not self._sc:
+            cached = self._index = (self._table, self._sc, get_catalog_index(self))
+        return cached[2]
+
+    def significance_above(self, threshold):
+        return self.index.significance_above(threshold)
+
+    def cone_search(self, ra, dec, radius):
+        return self.index.cone_search(ra, dec, radius)
+
+    def nearest(self, ra, dec, k=1):
+        return self.index.nearest(ra, dec, k=k)
+
+    def cross_match(self, reference, **kwargs):
+        return cross_match(self, reference, **kwargs)
+
+
+def _err_rad(catalog):
+    if 'ERR_RAD' in catalog._table.colnames:
+        return np.ma.filled(np.ma.asarray(catalog._table['ERR_RAD'], dtype=float), 0.)
+    return np.zeros(len(catalog._table))
+
+
+def cross_match(detections, reference, radius=None, n_sigma=3., min_radius=1. / 60):
+    """
+    pairs of detected sources (e.g. OsaIsgriCatalog, OsaJemxCatalog) and sources of a reference catalog (e.g. the
+    user BasicCatalog) closer than the match radius: radius (deg) if given, otherwise n_sigma times the ERR_RAD of
+    both (deg, 0 if there is no such column) added in quadrature, and at least min_radius
+
+    only the selected sources of both catalogs are matched; returns a Table by detection and separation, with the
+    rows of the pair in detections.table and reference.table, and nearest, true for the closest reference source of
+    each detection
+    """
+    det_rows = np.flatnonzero(np.asarray(detections.selected, dtype=bool))
+    ref_selected = np.asarray(reference.selected, dtype=bool)
+    # row in the full table to row in the selection
+    ref_view = np.cumsum(ref_selected) - 1
+
+    det_sc = detections._sc.fk5[det_rows]
+    det_err = _err_rad(detections)[det_rows]
+    ref_err = _err_rad(reference)
+
+    if radius is None:
+        max_ref_err = ref_err[ref_selected].max() if np.any(ref_selected) else 0.
+        search_radius = np.maximum(n_sigma * np.hypot(det_err, max_ref_err), min_radius)
+    else:
+        search_radius = radius
+
+    ref_index = reference.index if isinstance(reference, IndexedCatalog) else get_catalog_index(reference)
+    points, ref_rows, separation = ref_index.query_pairs(det_sc.ra.deg, det_sc.dec.deg,
+                                                                           search_radius)
+
+    if radius is None:
+        match_radius = np.maximum(n_sigma * np.hypot(det_err[points], ref_err[ref_rows]), min_radius)
+    else:
+        match_radius = np.broadcast_to(np.asarray(radius, dtype=float), separation.shape)
+
+    keep = ref_selected[ref_rows] & (separation <= match_radius)
+    points, ref_rows, separation, match_radius = points[keep], ref_rows[keep], separation[keep], match_radius[keep]
+
+    order = np.lexsort((separation, points))
+    points, ref_rows, separation, match_radius = points[order], ref_rows[order], separation[order], match_radius[order]
+
+    nearest = np.ones(len(points), dtype=bool)
+    nearest[1:] = points[1:] != points[:-1]
+
+    det_names = np.asarray(detections._table['src_names'])[det_rows]
+    ref_names = np.asarray(reference._table['src_names'])
+
+    return Table([points, ref_view[ref_rows], det_names[points], ref_names[ref_rows], separation, match_radius,
+                  nearest],
+                 names=['det_row', 'ref_row', 'det_name', 'ref_name', 'separation', 'match_radius', 'nearest'])
+
+
+class OsaIsgriCatalog(IndexedCatalog, BasicCatalog):
 
     def __init__(self,
                  src_names,
@@ -91,23 +339,16 @@ class OsaIsgriCatalog(BasicCatalog):
 
     @classmethod
     def build_from_ddosa_srclres(cls, srclres,prod_prefix=None):
-        #catalog = pf.open(srclres)[1]
-        catalog=FitsFile(srclres).open()[1]
+        frame, catalog = read_srclres_columns(srclres, ['NAME', 'RA_FIN', 'DEC_FIN', 'RA_OBJ', 'DEC_OBJ', 'DETSIG',
+                                                        'NEW_SOURCE', 'ISGRI_FLAG', 'FLAG', 'ERR_RAD'])
 
-        #print ('cat file',srclres)
-        frame = catalog.header['RADECSYS'].lower()
-        catalog=catalog.data
-        #TODO
         #if RA_FIN==0.0000 and DEC_FIN=0.0000
-        #change RA_OBJ,DEC_OBJ
-        msk=catalog['RA_FIN']==0.
-        msk*= catalog['DEC_FIN'] == 0.
-        catalog['RA_FIN'][msk]=catalog['RA_OBJ'][msk]
-        catalog['DEC_FIN'][msk] = catalog['DEC_OBJ'][msk]
-
-        return cls( [n.strip() for n in catalog['NAME']],
-                    catalog['RA_FIN'],
-                    catalog['DEC_FIN'],
+        #use RA_OBJ,DEC_OBJ
+        msk = (catalog['RA_FIN'] == 0.) & (catalog['DEC_FIN'] == 0.)
+
+        return cls( catalog['NAME'],
+                    np.where(msk, catalog['RA_OBJ'], catalog['RA_FIN']),
+                    np.where(msk, catalog['DEC_OBJ'], catalog['DEC_FIN']),
                     significance=catalog['DETSIG'],
                     frame=frame,
                     NEW_SOURCE=catalog['NEW_SOURCE'],
@@ -116,7 +357,7 @@ class OsaIsgriCatalog(BasicCatalog):
                     ERR_RAD=catalog['ERR_RAD'] )
 
 
-class OsaJemxCatalog(BasicCatalog):
+class OsaJemxCatalog(IndexedCatalog, BasicCatalog):
 
     def __init__(self,
                  src_names,
@@ -162,12 +403,9 @@ class OsaJemxCatalog(BasicCatalog):
 
     @classmethod
     def build_from_ddosa_srclres(cls, srclres,prod_prefix=None):
-        #catalog = pf.open(srclres)[1]
-        catalog = FitsFile(srclres).open()[1]
-        #print ('cat file',srclres)
-        frame = catalog.header['RADECSYS'].lower()
-        catalog=catalog.data
-        return cls( [n.strip() for n in catalog['NAME']],
+        frame, catalog = read_srclres_columns(srclres, ['NAME', 'RA_OBJ', 'DEC_OBJ', 'DETSIG', 'FLAG', 'ERR_RAD'])
+
+        return cls( catalog['NAME'],
                     catalog['RA_OBJ'],
                     catalog['DEC_OBJ'],
                     significance=catalog['DETSIG'],
@@ -178,4 +416,29 @@ class OsaJemxCatalog(BasicCatalog):
                     ERR_RAD=catalog['ERR_RAD'] )
 
 
-
+def get_inject_columns(user_catalog):
+    """
+    columns of the SourceCatalog inject for user_catalog, as lists of python values, built one column at a time
+    """
+    table = user_catalog.table
+    n_sources = len(table)
+
+    def get_col_data(n, default):
+        if n in table.colnames:
+            return np.asarray(table[n])
+        return np.full(n_sources, default)
+
+    return {
+        "RA": np.asarray(user_catalog.ra.deg, dtype=float).tolist(),
+        "DEC": np.asarray(user_catalog.dec.deg, dtype=float).tolist(),
+        "NAME": np.asarray(table['src_names']).astype(str).tolist(),
+        "FLAG": get_col_data('FLAG', 0).astype(int).tolist(),
+        "ISGRI_FLAG": get_col_data('ISGRI_FLAG', 0).astype(int).tolist(),
+    }
+
+
+def get_inject_content_hash(columns):
+    """
+    hash of the catalog content, the same for identical catalogs
+    """
+    return hashlib.sha256(json.dumps(columns, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,165 @@
+"""
+Overview
+--------
+
+content-addressed store of user catalogs: a catalog is stored once under the
+hash of its content (see osa_catalog.get_inject_content_hash), and the
+SourceCatalog inject of every later request, and of every poll of the same
+job, only carries the hash reference instead of the full catalog.
+
+LocalCatalogStore keeps the catalogs as json files in a directory, which
+has to be shared with the backend reading them, and drops the least
+recently used ones beyond max_entries.
+
+The store directory is set with CDCI_OSA_PLUGIN_CATALOG_STORE; catalogs are
+sent in full when it is not set.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   LocalCatalogStore
+   get_catalog_store
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# Project
+from cdci_osa_plugin.osa_catalog import get_inject_content_hash
+from cdci_osa_plugin.osa_dda_client import _env_int
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCatalogStore(object):
+    """
+    catalog columns stored as <root>/<hash>.json
+
+    max_entries: number of catalogs kept, least recently used (by file modification time) are removed
+    """
+
+    suffix = '.json'
+
+    def __init__(self, root, max_entries=1000):
+        self.root = root
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, content_hash):
+        return os.path.join(self.root, content_hash + self.suffix)
+
+    def reference(self, content_hash):
+        return "sha256:" + content_hash
+
+    def put(self, columns, content_hash=None):
+        """
+        stores the catalog unless it is already there, and returns its hash
+        """
+        if content_hash is None:
+            content_hash = get_inject_content_hash(columns)
+
+        path = self._path(content_hash)
+
+        if self._touch(path):
+            return content_hash
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(columns, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logger.info("stored catalog %s in %s", content_hash, self.root)
+
+        self._evict()
+
+        return content_hash
+
+    def get(self, content_hash):
+        """
+        catalog columns stored under content_hash, None if not stored
+        """
+        path = self._path(content_hash)
+        try:
+            with open(path) as f:
+                columns = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        self._touch(path)
+        return columns
+
+    def __contains__(self, content_hash):
+        return os.path.exists(self._path(content_hash))
+
+    def __len__(self):
+        return len(self._stored())
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _stored(self):
+        return [entry for entry in os.scandir(self.root) if entry.name.endswith(self.suffix)]
+
+    def _evict(self):
+        with self._lock:
+            stored = self._stored()
+            if len(stored) <= self.max_entries:
+                return
+
+            stored.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in stored[:len(stored) - self.max_entries]:
+                logger.info("removing least recently used catalog %s", entry.name)
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_catalog_store(root=None):
+    """
+    store in root, by default CDCI_OSA_PLUGIN_CATALOG_STORE; None if not set
+    """
+    if root is None:
+        root = os.environ.get('CDCI_OSA_PLUGIN_CATALOG_STORE')
+
+    if not root:
+        return None
+
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = _stores[root] = LocalCatalogStore(
+                root, max_entries=_env_int('CDCI_OSA_PLUGIN_CATALOG_STORE_MAX_ENTRIES', 1000))
+
+    return store
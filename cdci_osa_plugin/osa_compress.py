@@ -0,0 +1,227 @@
+"""
+Overview
+--------
+
+gzip compression of product files on several cores: the data are cut in
+blocks compressed in parallel (zlib releases the GIL), each primed with the
+end of the previous block and ending on a byte boundary, and concatenated in
+order as one raw deflate stream, in a single standard gzip member readable
+by any gzip reader.
+
+Products written as .gz files are compressed with the level
+CDCI_OSA_PLUGIN_GZIP_LEVEL (0, default: written as before, uncompressed),
+with CDCI_OSA_PLUGIN_GZIP_WORKERS threads; single file FITS products
+(mosaics, lightcurves) are then also written as .fits.gz.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   ParallelGzipWriter
+   compress_file
+   compress_product
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Project
+from cdci_data_analysis.analysis.io_helper import FilePath
+
+from cdci_osa_plugin.osa_dda_client import _env_int
+
+
+logger = logging.getLogger(__name__)
+
+
+gzip_level = _env_int('CDCI_OSA_PLUGIN_GZIP_LEVEL', 0)
+gzip_workers = _env_int('CDCI_OSA_PLUGIN_GZIP_WORKERS', os.cpu_count() or 1)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# temporary files are created owner-only, products get the permissions of files written with open()
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def move_in_place(tmp_path, out_path):
+    """
+    moves the complete temporary file tmp_path to out_path, with the default permissions of new files
+    """
+    os.chmod(tmp_path, 0o666 & ~_umask)
+    shutil.move(tmp_path, out_path)
+
+
+# deflate window, primed from the previous block
+_dictionary_size = 2 ** 15
+
+
+def _compress_block(block, dictionary, compresslevel):
+    if dictionary:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    """
+    binary file object writing a gzip member to fileobj, with blocks of block_size compressed by workers threads
+
+    closing the writer does not close fileobj
+    """
+
+    def __init__(self, fileobj, compresslevel=6, workers=None, block_size=2 ** 20):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+
+        if workers is None:
+            workers = gzip_workers
+        self.workers = max(1, workers)
+
+        self._pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+
+        # no name, no mtime, unknown OS
+        xfl = 2 if compresslevel == 9 else 4 if compresslevel == 1 else 0
+        self.fileobj.write(GZIP_MAGIC + b'\x08\x00' + struct.pack('<I', 0) + bytes([xfl, 255]))
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+
+        dictionary, self._dictionary = self._dictionary, block[-_dictionary_size:]
+
+        if self._pool is None:
+            self.fileobj.write(_compress_block(block, dictionary, self.compresslevel))
+            return
+
+        while len(self._pending) >= 2 * self.workers:
+            self.fileobj.write(self._pending.popleft().result())
+
+        self._pending.append(self._pool.submit(_compress_block, block, dictionary, self.compresslevel))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+
+            # final empty block
+            self.fileobj.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.fileobj.write(struct.pack('<II', self._crc, self._size & 0xffffffff))
+        finally:
+            self.closed = True
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+
+    def abort(self):
+        """
+        stop without completing the gzip member
+        """
+        self.closed = True
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def output_gzip_level(path):
+    """
+    compression level of the product file at path, None if it is not compressed
+    """
+    if gzip_level > 0 and str(path).endswith('.gz'):
+        return gzip_level
+
+
+def compress_file(in_path, out_path=None, compresslevel=None, workers=None, block_size=2 ** 20):
+    """
+    gzip compressed copy of in_path at out_path, by default in place
+    """
+    if out_path is None:
+        out_path = in_path
+
+    if compresslevel is None:
+        compresslevel = gzip_level or 6
+
+    with open(in_path, 'rb') as f_in, \
+            tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(out_path)), delete=False) as f_tmp:
+        try:
+            with ParallelGzipWriter(f_tmp, compresslevel=compresslevel, workers=workers,
+                                    block_size=block_size) as f_out:
+                for block in iter(lambda: f_in.read(block_size), b''):
+                    f_out.write(block)
+        except Exception:
+            f_tmp.close()
+            os.remove(f_tmp.name)
+            raise
+
+    move_in_place(f_tmp.name, out_path)
+
+
+def gzip_file_path(product):
+    """
+    if products are compressed, output file of the (single file FITS) product renamed from .fits to .fits.gz,
+    before it is written
+    """
+    if gzip_level > 0 and product.file_path.name.endswith('.fits'):
+        product.file_path = FilePath(file_name=product.file_path.name + '.gz', file_dir=product.file_path.dir_name)
+
+
+def compress_product(product):
+    """
+    compress the output .gz file of the product, once written, unless it is already compressed
+    """
+    path = product.file_path.path
+
+    compresslevel = output_gzip_level(path)
+    if compresslevel is not None and not is_gzip(path):
+        logger.info("compressing %s with level %s", path, compresslevel)
+        compress_file(path, compresslevel=compresslevel)
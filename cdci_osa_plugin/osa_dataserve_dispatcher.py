@@ -46,6 +46,13 @@ import logging
 import os
 import requests
 from cdci_osa_plugin import conf_file as plugin_conf_file
+from cdci_osa_plugin.osa_dda_client import dda_client_pool, dda_health_monitor, dda_circuit_breaker, dda_single_flight, get_exception_status_message, is_backend_failure, _env_int
+from cdci_osa_plugin.osa_canonical import canonical_scw_list, canonical_number
+from cdci_osa_plugin.osa_scw_index import get_scw_pointing_index
+from cdci_osa_plugin.osa_scwlist import ScWList
+from cdci_osa_plugin.osa_catalog import get_inject_columns, get_inject_content_hash
+from cdci_osa_plugin.osa_catalog_store import get_catalog_store
+from cdci_osa_plugin.osa_scwlist_cache import scwlist_cache
 
 from cdci_data_analysis.configurer import DataServerConf
 from cdci_data_analysis.analysis.queries import  *
@@ -58,7 +65,6 @@ import json
 import traceback
 import time
 from ast import literal_eval
-import  re
 from contextlib import contextmanager
 
 from astropy.coordinates import SkyCoord
@@ -128,7 +134,13 @@ class OsaDispatcher(object):
         self.assume = assume
         self.inject = inject
 
-        self._test_products_method = "timesystem" # TODO: this should be configurable, could be astroquery, ReportScWList, timesystem
+        # could be astroquery, ReportScWList, timesystem, pointing_index
+        self._test_products_method = os.environ.get('CDCI_OSA_PLUGIN_TEST_PRODUCTS_METHOD', "timesystem")
+
+        if self._test_products_method == "pointing_index" and get_scw_pointing_index() is None:
+            logger.warning("no ScW pointing index found at CDCI_OSA_PLUGIN_SCW_INDEX=%s, using timesystem",
+                           os.environ.get('CDCI_OSA_PLUGIN_SCW_INDEX'))
+            self._test_products_method = "timesystem"
 
         config=None
 
@@ -183,15 +195,34 @@ class OsaDispatcher(object):
         self.data_server_cache = _data_server_cache
         self.logdir = _logdir
 
+        dda_health_monitor.watch(self.data_server_url, self.data_server_cache, self.logdir)
+
+    def get_remote_dda(self):
+        # connections are pooled process-wide, see osa_dda_client
+        return dda_client_pool.get_client(self.data_server_url, self.data_server_cache, self.logdir)
+
+    def query_dda(self, remote, **kwargs):
+        try:
+            res = remote.query(**kwargs)
+        except Exception as e:
+            self.record_dda_outcome(e)
+            raise
+
+        self.record_dda_outcome()
+        return res
+
+    def record_dda_outcome(self, e=None):
+        # analysis failures and delegation mean that the backend is working, refused requests and local errors
+        # tell nothing about it
+        if e is None or isinstance(e, (dc.AnalysisException, dc.AnalysisDelegatedException)):
+            dda_circuit_breaker.record_success(self.data_server_url)
+        elif is_backend_failure(e):
+            dda_circuit_breaker.record_failure(self.data_server_url)
+        else:
+            dda_circuit_breaker.record_neutral(self.data_server_url)
+
     def get_exception_status_message(self,e):
-        status=''
-        if hasattr(e,'content'):
-            try:
-                content = json.loads(e.content)
-                status = content['result']['status']
-            except:
-                pass
-        return status
+        return get_exception_status_message(e)
 
 
     def get_exceptions_message(self,e):
@@ -206,88 +237,92 @@ class OsaDispatcher(object):
 
     def test_communication(self, max_trial=120, sleep_s=1,logger=None):
         print('--> start test connection to',self.data_server_url)
-        remote = dc.RemoteDDA(self.data_server_url, self.data_server_cache, self.logdir)
 
         query_out = QueryOutput()
 
-
         message=''
         debug_message = ''
-        connection_status_message=''
-        busy_exception=False
 
+        log = logging.getLogger(__name__) if logger is None else logger
 
-        time.sleep(sleep_s)
+        if dda_circuit_breaker.is_open(self.data_server_url):
+            self.set_backend_degraded(query_out, 'test connection', logger=logger)
 
-        for i in range(max_trial):
-            time.sleep(sleep_s)
-            try:
-                r = remote.poke()
-                print('remote poke ok at trial',i)
-                #DONE
-                query_out.set_done(message=message, debug_message=str(debug_message))
-                busy_exception=False
-                connection_status_message='OK'
-                break
-            except dc.WorkerException as e:
-                connection_status_message = self.get_exception_status_message(e)
-                query_out.set_query_exception(e, 'test connection',message='connection_status=%s'%connection_status_message,logger=logger)
-                busy_exception=True
-                print('remote poke not ok, trial',i,connection_status_message)
+        # the health monitor pokes data servers in the background, a live poke is only needed when it has no recent state
+        state = dda_health_monitor.get_fresh_state(self.data_server_url)
 
-            except Exception as e:
-                connection_status_message = self.get_exception_status_message(e)
-                query_out.set_query_exception(e, 'test connection',
-                                              message='connection_status=%s' % connection_status_message, logger=logger)
-                busy_exception = True
-                print('remote poke not ok, trial', i, connection_status_message)
+        if state is not None:
+            log.info('data server state from health monitor: %s', state)
+        else:
+            for i in range(max_trial):
+                if not dda_circuit_breaker.allow_request(self.data_server_url):
+                    self.set_backend_degraded(query_out, 'test connection', logger=logger)
 
+                # pokes are recorded by the circuit breaker
+                state = dda_health_monitor.poke(self.data_server_url, self.data_server_cache, self.logdir)
 
-        if busy_exception==True:
-            try:
-                r = remote.poke()
-            except Exception as e:
-                connection_status_message = self.get_exception_status_message(e)
-                # FAILED
-                 #query_out.set_failed('test connection',
-                 #                message='connection_status=%s' % connection_status_message,
-                 #                logger=logger,
-                 #                excep=e)
-
-                run_query_message = 'Connection Error'
-                debug_message = self.get_exceptions_message(e)
-                # FAILED
-                query_out.set_failed('test connection',
-                                     message='connection_status=%s' % connection_status_message,
-                                     logger=logger,
-                                     excep=e,
-                                     e_message=run_query_message,
-                                     debug_message=debug_message)
-
-                raise DDAException('Connection Error',debug_message)
-
-        if connection_status_message == 'busy' or busy_exception==True:
+                if state.ok:
+                    print('remote poke ok at trial',i)
+                    break
+
+                query_out.set_query_exception(state.exception, 'test connection',
+                                              message='connection_status=%s' % state.status, logger=logger)
+                log.info('remote poke not ok, trial %s: %s (%s)', i, state.status, 'busy' if state.busy else 'down')
+
+                # a fixed delay bounds the wait to about max_trial * sleep_s, backoff is left to the circuit breaker
+                if i < max_trial - 1:
+                    time.sleep(sleep_s)
+
+        if not state.ok:
+            self.set_communication_failed(query_out, state, logger=logger)
+
+        #DONE
+        query_out.set_done(message=message, debug_message=str(debug_message))
+
+        print('--> end test busy')
+
+        return query_out
+
+    def set_communication_failed(self, query_out, state, logger=None):
+        e = state.exception
+        debug_message = self.get_exceptions_message(e)
+
+        if state.busy:
             print('server is busy')
             # FAILED
-            #query_out.set_failed('test busy',
-            #                 message='connection_status=%s'%connection_status_message,
-            #                 logger=logger,
-            #                 excep=e)
-
             query_out.set_failed('test busy',
-                                 message='connection_status=%s' % connection_status_message,
+                                 message='connection_status=%s' % state.status,
                                  logger=logger,
                                  excep=e,
                                  e_message='data server busy',
                                  debug_message='data server busy')
 
-            raise DDAException('Connection Error', debug_message)
+            raise DDAException('data server busy', debug_message)
 
+        print('server is down')
+        # FAILED
+        query_out.set_failed('test connection',
+                             message='connection_status=%s' % state.status,
+                             logger=logger,
+                             excep=e,
+                             e_message='Connection Error',
+                             debug_message=debug_message)
 
+        raise DDAException('Connection Error', debug_message)
 
-        print('--> end test busy')
+    def set_backend_degraded(self, query_out, failed_operation, logger=None):
+        retry_after_s = dda_circuit_breaker.retry_after_s(self.data_server_url)
+        debug_message = 'repeated failures talking to %s, requests are suspended for %.0f s' % (self.data_server_url, retry_after_s)
 
-        return query_out
+        # FAILED
+        query_out.set_failed(failed_operation,
+                             message='backend degraded',
+                             logger=logger,
+                             job_status='failed',
+                             e_message='backend degraded',
+                             debug_message=debug_message)
+
+        raise DDAException(message='backend degraded', debug_message=debug_message)
 
     def test_has_input_products(self,instrument,logger=None):
         print('--> start has input_products')
@@ -334,104 +369,149 @@ class OsaDispatcher(object):
                                 fields='All'
                             )
 
-            elif self._test_products_method == "timesystem":
-                # cons is expected
-                timesystem_api_base = "https://www.astro.unige.ch/cdci/astrooda/dispatch-data/gw/timesystem/api"
-                prod_list_raw = requests.get(f"{timesystem_api_base}/v1.0/scwlist/cons/{T1_iso}/{T2_iso}?&ra={RA}&dec={DEC}&radius={radius}").json()
+            elif self._test_products_method == "pointing_index":
+                prod_list_raw = get_scw_pointing_index().query(RA, DEC, radius,
+                                                               instrument.get_par_by_name('T1')._astropy_time.mjd,
+                                                               instrument.get_par_by_name('T2')._astropy_time.mjd)
+                prod_list = self.select_timesystem_scwlist(prod_list_raw)
 
-                prod_list = [ scw for scw in prod_list_raw if scw.endswith("0010.001") ] 
-                # ? &min_good_isgri=1000
+            elif self._test_products_method == "timesystem":
+                # windows extending cached ones are only resolved for the missing part, see ScWListCache
+                prod_list_raw = scwlist_cache.get(
+                    lambda t1, t2: requests.get(self.get_timesystem_scwlist_url(t1, t2, RA, DEC, radius)).json(),
+                    RA, DEC, radius, T1_iso, T2_iso, key=('timesystem',))
+                prod_list = self.select_timesystem_scwlist(prod_list_raw)
 
             elif self._test_products_method == "ReportScWList":
-                target = "ReportScWList"
-                modules = ['git://rangequery/staging-1-3']
+                target, modules, assume = self.get_report_scwlist_query(T1_iso, T2_iso, RA, DEC, radius, use_max_pointings)
+
+                # max_pointings makes the result a selection, not a union over time: only repeats are cached
+                scwlist_lookup = scwlist_cache.lookup(RA, DEC, radius, T1_iso, T2_iso,
+                                                      key=('ReportScWList', use_max_pointings), exact=True)
 
+                if scwlist_lookup.scw_list is not None:
+                    query_out.set_done(message='', debug_message='')
+                    prod_list = scwlist_lookup.scw_list
 
-                scwlist_assumption = OsaDispatcher.get_scwlist_assumption(None, T1_iso, T2_iso, RA, DEC, radius, use_max_pointings)
-                assume = ["rangequery.ReportScWList(input_scwlist=%s)"%scwlist_assumption[0],
-                          scwlist_assumption[1]]
+                else:
+                    remote = self.get_remote_dda()
 
+                    while True:
+                        if not dda_circuit_breaker.allow_request(self.data_server_url):
+                            self.set_backend_degraded(query_out, 'test has input prods', logger=logger)
 
-                remote = dc.RemoteDDA(self.data_server_url, self.data_server_cache, self.logdir)
+                        try:
+                            product = self.query_dda(remote, target=target, modules=modules, assume=assume, sync=True)
+                            prod_list = self.set_report_scwlist_done(product, query_out, logger=logger)
+                            scwlist_cache.complete(scwlist_lookup, [prod_list])
+                            break
 
-                while True:
-                    try:
-                        product = remote.query(target=target, modules=modules, assume=assume, sync=True)
-                        #DONE
-                        query_out.set_done(message=message, debug_message=str(debug_message))
+                        except dc.AnalysisDelegatedException as e:
+                            logger.info("waiting for ReportScWList: %s", e)
+                            time.sleep(2)
+                            continue
 
-                        logger.info("scwlist result product: %s", product)
+                        except Exception as e:
+                            self.set_has_input_products_exception(e, query_out, logger=logger)
 
-                        prod_list = getattr(product, 'scwidlist', None)
+        return query_out,prod_list
 
-                        logger.info("scwlist result prod_list: %s", prod_list)
+    # the helpers below are shared with AsyncOsaDispatcher, so that both map backend answers to the same QueryOutput
 
-                        if prod_list is None:
-                            raise RuntimeError(f"product.prod_list is None")
+    timesystem_api_base = "https://www.astro.unige.ch/cdci/astrooda/dispatch-data/gw/timesystem/api"
 
-                        if len(prod_list)<1:
-                            run_query_message = 'scwlist empty'
-                            debug_message = ''
-                            query_out.set_failed('test has input prods',
-                                                message=run_query_message,
-                                                logger=logger,
-                                                job_status='failed',
-                                                e_message=run_query_message,
-                                                debug_message='')
+    # rows: one dict per source; columns: one list per field, needs a backend accepting catalog_columns
+    catalog_inject_format = os.environ.get('CDCI_OSA_PLUGIN_CATALOG_INJECT_FORMAT', 'rows')
 
-                            raise DDAException(message='scwlist empty', debug_message='')
+    # explicit ScW lists at least this long are sent as runs of pointings, see ScWList.expression; 0 disables
+    compact_scwlist_min = _env_int('CDCI_OSA_PLUGIN_COMPACT_SCWLIST_MIN', 0)
 
-                        break
+    @classmethod
+    def get_timesystem_scwlist_url(cls, T1_iso, T2_iso, RA, DEC, radius):
+        # cons is expected
+        return f"{cls.timesystem_api_base}/v1.0/scwlist/cons/{T1_iso}/{T2_iso}?&ra={RA}&dec={DEC}&radius={radius}"
 
-                    except dc.AnalysisDelegatedException as e:
-                        logger.info("waiting for ReportScWList: %s", e)
-                        time.sleep(2)
-                        continue
+    @staticmethod
+    def select_timesystem_scwlist(prod_list_raw):
+        # ? &min_good_isgri=1000
+        return [ scw for scw in prod_list_raw if scw.endswith("0010.001") ]
 
-                    except dc.WorkerException as e:
-                        run_query_message = 'WorkerException'
-                        debug_message = self.get_exceptions_message(e)
-                        # FAILED
-                        query_out.set_failed('test has input prods',
-                                            message='has input_products=%s' % run_query_message,
-                                            logger=logger,
-                                            excep=e,
-                                            job_status='failed',
-                                            e_message=run_query_message,
-                                            debug_message=debug_message)
+    @classmethod
+    def get_report_scwlist_query(cls, T1_iso, T2_iso, RA, DEC, radius, use_max_pointings):
+        target = "ReportScWList"
+        modules = ['git://rangequery/staging-1-3']
 
-                        raise DDAException('WorkerException', debug_message)
+        scwlist_assumption = cls.get_scwlist_assumption(None, T1_iso, T2_iso, RA, DEC, radius, use_max_pointings)
+        assume = ["rangequery.ReportScWList(input_scwlist=%s)"%scwlist_assumption[0],
+                  scwlist_assumption[1]]
 
-                    except dc.AnalysisException as e:
+        return target, modules, assume
 
-                        run_query_message = 'AnalysisException'
-                        debug_message = self.get_exceptions_message(e)
+    def set_report_scwlist_done(self, product, query_out, logger=None):
+        #DONE
+        query_out.set_done(message='', debug_message='')
 
-                        query_out.set_failed('test has input prods',
-                                            message='run query message=%s' % run_query_message,
-                                            logger=logger,
-                                            excep=e,
-                                            job_status='failed',
-                                            e_message=run_query_message,
-                                            debug_message=debug_message)
+        logger.info("scwlist result product: %s", product)
 
-                        raise DDAException(message=run_query_message, debug_message=debug_message)
+        prod_list = getattr(product, 'scwidlist', None)
 
-                    except Exception as e:
-                        run_query_message = 'DDAUnknownException in test has input prods: ' + repr(e)
-                        query_out.set_failed('test has input prods ',
-                                            message='run query message=%s' % run_query_message,
-                                            logger=logger,
-                                            excep=e,
-                                            job_status='failed',
-                                            e_message=run_query_message,
-                                            debug_message='')
+        logger.info("scwlist result prod_list: %s", prod_list)
 
-                        raise DDAUnknownException()
+        if prod_list is None:
+            raise RuntimeError(f"product.prod_list is None")
 
-        return query_out,prod_list
+        if len(prod_list)<1:
+            run_query_message = 'scwlist empty'
+            query_out.set_failed('test has input prods',
+                                message=run_query_message,
+                                logger=logger,
+                                job_status='failed',
+                                e_message=run_query_message,
+                                debug_message='')
+
+            raise DDAException(message='scwlist empty', debug_message='')
 
+        return prod_list
 
+    def set_has_input_products_exception(self, e, query_out, logger=None):
+        if isinstance(e, dc.WorkerException):
+            run_query_message = 'WorkerException'
+            debug_message = self.get_exceptions_message(e)
+            # FAILED
+            query_out.set_failed('test has input prods',
+                                message='has input_products=%s' % run_query_message,
+                                logger=logger,
+                                excep=e,
+                                job_status='failed',
+                                e_message=run_query_message,
+                                debug_message=debug_message)
+
+            raise DDAException('WorkerException', debug_message)
+
+        if isinstance(e, dc.AnalysisException):
+            run_query_message = 'AnalysisException'
+            debug_message = self.get_exceptions_message(e)
+
+            query_out.set_failed('test has input prods',
+                                message='run query message=%s' % run_query_message,
+                                logger=logger,
+                                excep=e,
+                                job_status='failed',
+                                e_message=run_query_message,
+                                debug_message=debug_message)
+
+            raise DDAException(message=run_query_message, debug_message=debug_message)
+
+        run_query_message = 'DDAUnknownException in test has input prods: ' + repr(e)
+        query_out.set_failed('test has input prods ',
+                            message='run query message=%s' % run_query_message,
+                            logger=logger,
+                            excep=e,
+                            job_status='failed',
+                            e_message=run_query_message,
+                            debug_message='')
+
+        raise DDAUnknownException()
 
     def get_comments(self,res):
         comment=''
@@ -462,12 +542,11 @@ class OsaDispatcher(object):
 
 
         res = None
-        #status = 0
-        message = ''
-        debug_message = ''
-        backend_comment = ''
-        backend_warning = ''
         query_out = QueryOutput()
+
+        if not dda_circuit_breaker.allow_request(self.data_server_url):
+            self.set_backend_degraded(query_out, 'run query ', logger=logger)
+
         try:
 
             logger.setLevel(logging.ERROR)
@@ -479,26 +558,43 @@ class OsaDispatcher(object):
 
 
 
-            res= dc.RemoteDDA(self.data_server_url, self.data_server_cache, self.logdir).query(target=target,
-                                                    modules=modules,
-                                                    assume=assume,
-                                                    inject=self.inject,
-                                                    prompt_delegate = run_asynch,
-                                                    callback = call_back_url)
-
-            backend_comment,backend_warning=self.get_comments(1)
-
-
+            # identical queries in flight are sent once, see DDASingleFlight
+            res= dda_single_flight.do(dda_single_flight.key(target, modules, assume, self.inject, prompt_delegate=run_asynch,
+                                                            data_server_url=self.data_server_url,
+                                                            data_server_cache=self.data_server_cache),
+                                      lambda: self.query_dda(self.get_remote_dda(),
+                                                             target=target,
+                                                             modules=modules,
+                                                             assume=assume,
+                                                             inject=self.inject,
+                                                             prompt_delegate = run_asynch,
+                                                             callback = call_back_url))
 
             print ('--> url for call_back',call_back_url)
             print("--> cached object in", res,res.ddcache_root_local)
-            #DONE
-            query_out.set_done(message=message, debug_message=str(debug_message),job_status='done',comment=backend_comment,warning=backend_warning)
+
+            self.set_run_query_done(res, query_out)
 
             #job.set_done()
 
-        except dc.AnalysisException as e:
+        except Exception as e:
+            self.set_run_query_exception(e, res, query_out, logger=logger)
+
+        return res, query_out
+
+    def set_run_query_done(self, res, query_out):
+        backend_comment,backend_warning=self.get_comments(1)
+
+        #DONE
+        query_out.set_done(message='', debug_message='',job_status='done',comment=backend_comment,warning=backend_warning)
 
+    def set_run_query_exception(self, e, res, query_out, logger=None):
+        """
+        sets query_out from an exception raised while querying the backend, and raises the matching DDAException;
+        delegation is not an error, query_out is set to submitted and nothing is raised
+        """
+        if isinstance(e, dc.AnalysisException):
+            # the backend is working, it is the analysis which failed
             run_query_message = 'AnalysisException'
             debug_message=self.get_exceptions_message(e)
             # we have to add the exception to the message
@@ -525,8 +621,7 @@ class OsaDispatcher(object):
 
             raise DDAException(message=run_query_message,debug_message=debug_message)
 
-        except dc.WorkerException as e:
-
+        if isinstance(e, dc.WorkerException):
             run_query_message = 'WorkerException'
             debug_message = self.get_exceptions_message(e)
             #FAILED
@@ -540,25 +635,22 @@ class OsaDispatcher(object):
 
             raise DDAException(message=run_query_message, debug_message=debug_message)
 
-
-        except dc.AnalysisDelegatedException as e:
+        if isinstance(e, dc.AnalysisDelegatedException):
             # DONE DELEGATION
             backend_comment, backend_warning = self.get_comments(res)
-            query_out.set_done(message=message, debug_message=str(debug_message), job_status='submitted',comment=backend_comment,warning=backend_warning)
-
-        except Exception as e:
-            run_query_message = 'DDAUnknownException in run_query: ' + repr(e)
-            query_out.set_failed('run query ',
-                                 message='run query message=%s' %run_query_message,
-                                 logger=logger,
-                                 excep=e,
-                                 job_status='failed',
-                                 e_message=run_query_message,
-                                 debug_message='')
+            query_out.set_done(message='', debug_message='', job_status='submitted',comment=backend_comment,warning=backend_warning)
+            return
 
-            raise DDAUnknownException(message=run_query_message)
+        run_query_message = 'DDAUnknownException in run_query: ' + repr(e)
+        query_out.set_failed('run query ',
+                             message='run query message=%s' %run_query_message,
+                             logger=logger,
+                             excep=e,
+                             job_status='failed',
+                             e_message=run_query_message,
+                             debug_message='')
 
-        return res, query_out
+        raise DDAUnknownException(message=run_query_message)
 
 
     @classmethod
@@ -567,18 +659,21 @@ class OsaDispatcher(object):
         logger.info('DEBUG --> scw_list: %s of %s', scw_list, len(scw_list))
         if scw_list is not None and scw_list != []:
 
-            scw_list=[item.strip() for item in scw_list]
-            template = re.compile(r'^(\d{12}).(\d{3})$')
-            acceptList = [item.strip() for item in scw_list if template.match(item)]
-            if len(acceptList) != len(scw_list):
-                wrong_list = [item for item in scw_list if item not in acceptList]
-                raise DDAException(message='the following scws have a wrong format %s' % wrong_list)
+            parsed_scw_list = ScWList(scw_list)
+            if not np.all(parsed_scw_list.valid):
+                raise DDAException(message='the following scws have a wrong format %s' % parsed_scw_list.malformed())
 
-            scwlist_assumption = ['ddosa.IDScWList','ddosa.IDScWList(use_scwid_list=[%s])' % (", ".join(["\""+str(scw)+"\"" for scw in scw_list])) ]
+            scw_list = canonical_scw_list(parsed_scw_list.ids)
+
+            if 0 < cls.compact_scwlist_min <= len(scw_list):
+                # evaluates to the same list on the backend, written as runs of consecutive pointings
+                scwlist_assumption = ['ddosa.IDScWList','ddosa.IDScWList(use_scwid_list=%s)' % ScWList(scw_list).expression() ]
+            else:
+                scwlist_assumption = ['ddosa.IDScWList','ddosa.IDScWList(use_scwid_list=[%s])' % (", ".join(["\""+str(scw)+"\"" for scw in scw_list])) ]
         else:
             scwlist_assumption = ['rangequery.TimeDirectionScWList',
                                   f'''rangequery.TimeDirectionScWList(
-                                                  use_coordinates=dict(RA={RA},DEC={DEC},radius={radius}),
+                                                  use_coordinates=dict(RA={canonical_number(RA)},DEC={canonical_number(DEC)},radius={canonical_number(radius)}),
                                                   use_timespan=dict(T1="{T1}",T2="{T2}"),
                                                   use_max_pointings={use_max_pointings},
                                                   use_scwversion="any",
@@ -633,40 +728,47 @@ class OsaDispatcher(object):
     def get_instr_catalog(cls, instrument, user_catalog=None):
         cat = None
 
-        def get_col_data(t, n, default):
-            if n in user_catalog.table.colnames:
-                return t[n].data
-            else:
-                return default
-
         if user_catalog is not None:
-            cat = ['SourceCatalog',
-                   {
-                       "catalog": [
-                           {
-                               "RA": float(ra.deg),
-                               "DEC": float(dec.deg),
-                               "NAME": str(name),
-                               "FLAG": int(flag),
-                               "ISGRI_FLAG": int(isgri_flag),
-                           }
-                           for ra, dec, name, flag, isgri_flag in zip(
-                               user_catalog.ra,
-                               user_catalog.dec,
-                               user_catalog.name,
-                               get_col_data(user_catalog.table, 'FLAG', np.zeros(len(user_catalog.ra))),
-                               get_col_data(user_catalog.table, 'ISGRI_FLAG', np.zeros(len(user_catalog.ra))),
-                           )
-                       ],
-                       "version": "v2",  # catalog id here; good if user-understandable, but can be computed internally
-                       "autoversion": True,
-                   }
-                   ]
-
-        if instrument.name == 'jemx':
-            print('jemx cat', cat)
-        if instrument.name == 'isgri':
-            print('isgri cat', cat)
+            columns = get_inject_columns(user_catalog)
+            # only sent, and so computed, with the reference and columns formats
+            content_hash = None
+
+            catalog_store = get_catalog_store()
+
+            if catalog_store is not None:
+                # the backend reads the catalog from the shared store, the request only carries the reference
+                content_hash = get_inject_content_hash(columns)
+                catalog_store.put(columns, content_hash=content_hash)
+                cat = ['SourceCatalog',
+                       {
+                           "catalog_ref": catalog_store.reference(content_hash),
+                           "content_hash": content_hash,
+                           "version": "v3",
+                           "autoversion": True,
+                       }
+                       ]
+            elif cls.catalog_inject_format == 'columns':
+                content_hash = get_inject_content_hash(columns)
+                cat = ['SourceCatalog',
+                       {
+                           "catalog_columns": columns,
+                           "content_hash": content_hash,
+                           "version": "v3",
+                           "autoversion": True,
+                       }
+                       ]
+            else:
+                cat = ['SourceCatalog',
+                       {
+                           "catalog": [dict(zip(columns.keys(), row)) for row in zip(*columns.values())],
+                           "version": "v2",  # catalog id here; good if user-understandable, but can be computed internally
+                           "autoversion": True,
+                       }
+                       ]
+
+            logger.info("%s user catalog: %d sources, %s inject, content hash %s",
+                        instrument.name, len(columns['NAME']),
+                        'reference' if catalog_store is not None else cls.catalog_inject_format, content_hash)
 
         # else:
         #    cat = None
@@ -686,10 +788,8 @@ class OsaQuery(ProductQuery):
 
         osa_version = par_dic.get('osa_version')
 
-        scw_list = par_dic.get('scw_list', '')
+        scw_list = ScWList(par_dic.get('scw_list', ''))
         # scw_list = self.get_par_by_name('scw_list').value
-        if isinstance(scw_list, str):
-            scw_list = scw_list.split(",")
 
         integral_data_rights = par_dic.get('integral_data_rights')
         # integral_data_rights = self.get_par_by_name('integral_data_rights').value
@@ -709,7 +809,7 @@ class OsaQuery(ProductQuery):
             needed_roles.append('unige-hpc-extreme') 
             needed_roles_with_comments['unige-hpc-extreme'] = "it is needed to request > 500 ScW"
 
-        if any([scw.endswith('.000') for scw in scw_list]) and integral_data_rights == "public":
+        if scw_list.has_nrt() and integral_data_rights == "public":
             needed_roles.append('integral-public-nrt')
             needed_roles_with_comments['integral-public-nrt'] = (f"some of the pointings you requested are NRT, but you requested public data. "
                                                                 f"This was likely a mistake, since almost none of of NRT data is public.")
@@ -0,0 +1,739 @@
+"""
+Overview
+--------
+
+process-wide plumbing for talking to the DDA backend: a registry of
+ddaclient.RemoteDDA clients sharing pooled keep-alive HTTP sessions, a
+background monitor keeping the last known health of each data server, a
+circuit breaker shared by all threads submitting to the same data server, and
+a single-flight layer sending identical queries in flight only once
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   DDAClientPool
+   PooledRemoteDDA
+   DDAHealthState
+   DDAHealthMonitor
+   DDACircuitBreaker
+   DDASingleFlight
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Dependencies
+import requests
+from requests.adapters import HTTPAdapter
+
+import ddaclient as dc
+
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning("ignoring non-integer %s=%s, using %s", name, os.environ.get(name), default)
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logger.warning("ignoring non-numeric %s=%s, using %s", name, os.environ.get(name), default)
+        return default
+
+
+def get_exception_status_message(e):
+    status = ''
+    if hasattr(e, 'content'):
+        try:
+            content = json.loads(e.content)
+            status = content['result']['status']
+        except Exception:
+            pass
+    return status
+
+
+# exceptions of DDA requests which mean that the backend is not working, see is_backend_failure
+_backend_failures = (dc.WorkerException, ConnectionError, TimeoutError, asyncio.TimeoutError,
+                     requests.ConnectionError, requests.Timeout)
+
+try:
+    import aiohttp
+except ImportError:
+    pass
+else:
+    _backend_failures += (aiohttp.ClientConnectionError,)
+
+
+def is_backend_failure(e):
+    """
+    whether the exception of a DDA request means that the backend is failing: worker errors, connection errors,
+    timeouts, 5xx answers and busy workers. Refused requests (NotAuthorizedOnDDA), permanent analysis failures and
+    local errors say nothing of the backend.
+    """
+    if isinstance(e, dc.UnknownDDABackendProblem):
+        status = re.search(r'response status (\d+)', str(e))
+        return status is None or int(status.group(1)) >= 500
+
+    return isinstance(e, _backend_failures) or get_exception_status_message(e) == 'busy'
+
+
+class PooledRemoteDDA(dc.RemoteDDA):
+    """
+    RemoteDDA which sends its requests through a shared session from DDAClientPool.
+
+    Instances are cheap and should not be shared between threads (RemoteDDA keeps per-request state),
+    the session and its connections are. The session is held for the duration of each call, so that the
+    pool does not close it under a running request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pool_session = kwargs.pop('pool_session')
+        self.client_pool = kwargs.pop('client_pool', None)
+        super(PooledRemoteDDA, self).__init__(*args, **kwargs)
+
+    @contextmanager
+    def _session(self):
+        if self.client_pool is None:
+            yield self.pool_session
+        else:
+            with self.client_pool.session_in_use(self.pool_session) as session:
+                yield session
+
+    def _call_in_session(self, method, *args, **kwargs):
+        with self._session() as session:
+            return _with_requests(method, _SessionRequests(session))(self, *args, **kwargs)
+
+    def download_ddcache_file(self, cached_path, filename, local_fn):
+        return self._call_in_session(dc.RemoteDDA.download_ddcache_file, cached_path, filename, local_fn)
+
+    def _query(self, *args, **kwargs):
+        return self._call_in_session(dc.RemoteDDA._query, *args, **kwargs)
+
+
+class _SessionRequests(object):
+    """
+    stands for the requests module in the code of ddaclient.RemoteDDA, which sends with requests.get and
+    requests.post: these go through the session, everything else is the requests module
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, *args, **kwargs):
+        return self.session.get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.session.post(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def _with_requests(method, requests_module):
+    """
+    the function method, unchanged, with requests_module for the requests module of its globals; the module
+    itself is not patched, other threads keep using it
+    """
+    f = types.FunctionType(method.__code__, dict(method.__globals__, requests=requests_module), method.__name__,
+                           method.__defaults__, method.__closure__)
+    f.__kwdefaults__ = method.__kwdefaults__
+    return f
+
+
+class DDAClientPool(object):
+    """
+    registry of keep-alive HTTP sessions, keyed by (data_server_url, data_server_cache), shared by all
+    requests and threads of the process
+
+    pool_connections: number of distinct hosts for which connections are kept, per session
+    pool_maxsize: number of connections kept open per host, per session
+    pool_block: if True, wait for a free connection instead of opening one beyond pool_maxsize
+    max_sessions: number of (data_server_url, data_server_cache) sessions kept, least recently used are dropped,
+    and closed once no request is running through them
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, pool_block=False, max_sessions=16):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_sessions = max_sessions
+
+        self._sessions = OrderedDict()
+        self._clients_created = {}
+        self._in_use = {}
+        self._dropped = set()
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, data_server_url, data_server_cache):
+        key = (data_server_url, data_server_cache)
+
+        with self._lock:
+            session = self._sessions.get(key)
+
+            if session is None:
+                session = self._new_session()
+                self._sessions[key] = session
+                self._clients_created[key] = 0
+                logger.info("opened DDA session pool for %s", key)
+
+                while len(self._sessions) > self.max_sessions:
+                    old_key, old_session = self._sessions.popitem(last=False)
+                    self._clients_created.pop(old_key, None)
+                    logger.info("dropping least recently used DDA session pool for %s", old_key)
+                    self._close_when_unused(old_session)
+            else:
+                self._sessions.move_to_end(key)
+
+            self._clients_created[key] += 1
+
+        return session
+
+    def get_client(self, data_server_url, data_server_cache, logdir):
+        session = self.get_session(data_server_url, data_server_cache)
+        return PooledRemoteDDA(data_server_url, data_server_cache, logdir, pool_session=session, client_pool=self)
+
+    def _close_when_unused(self, session):
+        # under self._lock
+        if self._in_use.get(session, 0) > 0:
+            self._dropped.add(session)
+        else:
+            session.close()
+
+    @contextmanager
+    def session_in_use(self, session):
+        """
+        hold the session for a request: a session dropped from the pool meanwhile is closed when released
+        """
+        with self._lock:
+            self._in_use[session] = self._in_use.get(session, 0) + 1
+
+        try:
+            yield session
+        finally:
+            with self._lock:
+                n = self._in_use.pop(session) - 1
+                if n > 0:
+                    self._in_use[session] = n
+                elif session in self._dropped:
+                    self._dropped.discard(session)
+                    session.close()
+
+    @staticmethod
+    def _session_counters(session):
+        opened = 0
+        requests_sent = 0
+
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                opened += getattr(pool, 'num_connections', 0)
+                requests_sent += getattr(pool, 'num_requests', 0)
+
+        return dict(connections_opened=opened,
+                    connections_reused=max(requests_sent - opened, 0),
+                    requests=requests_sent)
+
+    def stats(self):
+        """
+        connection counters per (data_server_url, data_server_cache) and in total
+        """
+        with self._lock:
+            items = list(self._sessions.items())
+            clients_created = dict(self._clients_created)
+
+        per_key = {}
+        total = dict(connections_opened=0, connections_reused=0, requests=0, clients=0)
+
+        for key, session in items:
+            counters = self._session_counters(session)
+            counters['clients'] = clients_created.get(key, 0)
+            per_key[key] = counters
+
+            for k in total:
+                total[k] += counters[k]
+
+        return dict(pools=per_key,
+                    total=total,
+                    limits=dict(pool_connections=self.pool_connections,
+                                pool_maxsize=self.pool_maxsize,
+                                pool_block=self.pool_block,
+                                max_sessions=self.max_sessions))
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                self._close_when_unused(session)
+            self._sessions.clear()
+            self._clients_created.clear()
+
+
+class _Circuit(object):
+
+    def __init__(self):
+        self.state = DDACircuitBreaker.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.
+        self.probe_started_at = None
+
+
+class DDACircuitBreaker(object):
+    """
+    per data server circuit breaker, shared by all threads of the process
+
+    closed: requests go through, consecutive failures are counted
+    open: after failure_threshold consecutive failures requests fail fast, until a backoff expires
+    half-open: once the backoff expires a single probe request is let through; success closes the circuit,
+               failure opens it again with a longer backoff
+
+    backoffs grow exponentially from base_backoff_s up to max_backoff_s; a random fraction (up to jitter)
+    is taken off each of them so that workers do not come back in lockstep
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, base_backoff_s=1., max_backoff_s=300., jitter=0.5,
+                 probe_timeout_s=60., rng=None):
+        self.failure_threshold = failure_threshold
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.jitter = jitter
+        self.probe_timeout_s = probe_timeout_s
+
+        self._rng = random.Random() if rng is None else rng
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, data_server_url):
+        c = self._circuits.get(data_server_url)
+        if c is None:
+            c = self._circuits[data_server_url] = _Circuit()
+        return c
+
+    def backoff_s(self, attempt, base_s=None):
+        """
+        delay before retry number attempt (starting from 1)
+        """
+        if base_s is None:
+            base_s = self.base_backoff_s
+
+        delay = min(base_s * 2 ** max(attempt - 1, 0), self.max_backoff_s)
+
+        return delay * (1 - self.jitter * self._rng.random())
+
+    def _trip(self, c, now):
+        c.trips += 1
+        c.state = self.OPEN
+        c.open_until = now + self.backoff_s(c.trips)
+        c.probe_started_at = None
+
+    def allow_request(self, data_server_url):
+        """
+        whether a request to data_server_url may be sent now; in half-open state only one probe is allowed
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            c = self._circuit(data_server_url)
+
+            if c.state == self.OPEN:
+                if now < c.open_until:
+                    return False
+                c.state = self.HALF_OPEN
+                c.probe_started_at = None
+
+            if c.state == self.HALF_OPEN:
+                if c.probe_started_at is not None and now - c.probe_started_at < self.probe_timeout_s:
+                    return False
+                c.probe_started_at = now
+
+            return True
+
+    def is_open(self, data_server_url):
+        """
+        whether requests to data_server_url currently fail fast; does not use up the half-open probe
+        """
+        with self._lock:
+            c = self._circuits.get(data_server_url)
+            return c is not None and c.state == self.OPEN and time.monotonic() < c.open_until
+
+    def record_success(self, data_server_url):
+        with self._lock:
+            c = self._circuit(data_server_url)
+            if c.state != self.CLOSED:
+                logger.info("circuit for %s closed", data_server_url)
+            c.state = self.CLOSED
+            c.failures = 0
+            c.trips = 0
+            c.probe_started_at = None
+
+    def record_failure(self, data_server_url):
+        now = time.monotonic()
+
+        with self._lock:
+            c = self._circuit(data_server_url)
+            c.failures += 1
+
+            if c.state == self.HALF_OPEN or (c.state == self.CLOSED and c.failures >= self.failure_threshold):
+                self._trip(c, now)
+                logger.warning("circuit for %s opened after %d failures, retry in %.1f s",
+                               data_server_url, c.failures, c.open_until - now)
+
+    def record_neutral(self, data_server_url):
+        """
+        outcome telling nothing about the backend (e.g. a refused request): releases the half-open probe slot
+        """
+        with self._lock:
+            c = self._circuits.get(data_server_url)
+            if c is not None and c.state == self.HALF_OPEN:
+                c.probe_started_at = None
+
+    def retry_after_s(self, data_server_url):
+        with self._lock:
+            c = self._circuits.get(data_server_url)
+            if c is None or c.state != self.OPEN:
+                return 0.
+            return max(c.open_until - time.monotonic(), 0.)
+
+    def get_state(self, data_server_url):
+        with self._lock:
+            c = self._circuits.get(data_server_url)
+            return self.CLOSED if c is None else c.state
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class _AsyncFlight(object):
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class DDASingleFlight(object):
+    """
+    coalesces identical DDA queries in flight in this process: the first caller (the leader) sends the query,
+    callers with the same key arriving before it completes wait for it, and get the same result or the same
+    exception (including delegation) raised
+
+    only the leader's query reaches the backend, so only the leader's callback is registered with it: followers
+    learn of completion by polling, as every dispatcher job does
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+        self._flights = {}
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self._n_leaders = 0
+        self._n_followers = 0
+
+    @staticmethod
+    def key(target, modules, assume, inject, **extra):
+        """
+        sha256 of the canonical json of the query; extra are other inputs changing the answer, e.g. prompt_delegate
+        """
+        canonical = json.dumps(dict(target=target, modules=list(modules), assume=list(assume), inject=inject, **extra),
+                               sort_keys=True, separators=(',', ':'), default=repr)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def do(self, key, fn):
+        if not self.enabled:
+            return fn()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self._n_leaders += 1
+                leader = True
+            else:
+                self._n_followers += 1
+                leader = False
+
+        if not leader:
+            logger.info("joining DDA query in flight %s", key)
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def do_async(self, key, coro_fn):
+        """
+        as do(), for coroutines: coalesces queries in flight in the same event loop
+
+        the query runs in its own task: a caller cancelled while waiting, including the leader, leaves it running
+        for the others, and it is only cancelled when nobody waits for it any more
+        """
+        if not self.enabled:
+            return await coro_fn()
+
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            flight = self._async_flights.get((loop, key))
+            if flight is None:
+                flight = self._async_flights[(loop, key)] = _AsyncFlight(loop.create_task(coro_fn()))
+                flight.task.add_done_callback(functools.partial(self._async_flight_done, (loop, key), flight))
+                self._n_leaders += 1
+            else:
+                logger.info("joining DDA query in flight %s", key)
+                self._n_followers += 1
+            flight.waiters += 1
+
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            with self._lock:
+                abandoned = flight.waiters == 1
+            if abandoned and not flight.task.done():
+                logger.info("cancelling DDA query in flight %s, nobody is waiting for it", key)
+                flight.task.cancel()
+            raise
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+
+    def _async_flight_done(self, flight_key, flight, task):
+        with self._lock:
+            if self._async_flights.get(flight_key) is flight:
+                del self._async_flights[flight_key]
+
+        # marks the exception as retrieved, there may be nobody left waiting to do it
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        with self._lock:
+            return dict(leaders=self._n_leaders,
+                        followers=self._n_followers,
+                        in_flight=len(self._flights) + len(self._async_flights),
+                        enabled=self.enabled)
+
+
+class DDAHealthState(object):
+    """
+    outcome of one poke of a data server
+
+    status is 'OK' on success, otherwise the status reported by the backend (e.g. 'busy'), if any
+
+    a data server which is not ok is either busy: it answered, but has no worker free for the request, or down:
+    it could not be reached or failed otherwise
+    """
+
+    def __init__(self, data_server_url, ok, status, latency_s, exception=None):
+        self.data_server_url = data_server_url
+        self.ok = ok
+        self.status = status
+        self.latency_s = latency_s
+        self.exception = exception
+        self.checked_at = time.time()
+        self._checked_at_monotonic = time.monotonic()
+
+    @property
+    def busy(self):
+        return not self.ok and (self.status == 'busy' or isinstance(self.exception, dc.WorkerException))
+
+    @property
+    def down(self):
+        return not self.ok and not self.busy
+
+    @property
+    def age_s(self):
+        return time.monotonic() - self._checked_at_monotonic
+
+    def __repr__(self):
+        return "[%s: %s ok=%s busy=%s status=%s latency=%.3fs age=%.1fs]" % (
+            self.__class__.__name__, self.data_server_url, self.ok, self.busy, self.status, self.latency_s, self.age_s)
+
+
+class DDAHealthMonitor(object):
+    """
+    keeps the last known health of every data server the dispatcher talks to
+
+    once a data server is watched, a daemon thread pokes it every interval_s; live pokes done on demand
+    are recorded too. States older than stale_after_s are not reported as fresh.
+    """
+
+    def __init__(self, client_pool, interval_s=10., stale_after_s=30., background=True, circuit_breaker=None):
+        self.client_pool = client_pool
+        self.circuit_breaker = circuit_breaker
+        self.interval_s = interval_s
+        self.stale_after_s = stale_after_s
+        self.background = background
+
+        self._targets = OrderedDict()
+        self._states = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, data_server_url, data_server_cache, logdir):
+        with self._lock:
+            self._targets[data_server_url] = (data_server_cache, logdir)
+
+            if self.background and (self._thread is None or not self._thread.is_alive()):
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='dda-health-monitor', daemon=True)
+                self._thread.start()
+
+    def poke(self, data_server_url, data_server_cache=None, logdir=None):
+        """
+        poke the data server now, record and return the resulting DDAHealthState
+        """
+        if data_server_cache is None or logdir is None:
+            with self._lock:
+                data_server_cache, logdir = self._targets[data_server_url]
+
+        remote = self.client_pool.get_client(data_server_url, data_server_cache, logdir)
+        # one attempt per poke: retrying is up to the caller, and it keeps the latency honest
+        remote.n_retries = 1
+
+        t0 = time.monotonic()
+        try:
+            remote.poke()
+            state = DDAHealthState(data_server_url, True, 'OK', time.monotonic() - t0)
+        except Exception as e:
+            state = DDAHealthState(data_server_url, False, get_exception_status_message(e), time.monotonic() - t0,
+                                   exception=e)
+            logger.info("poke of %s failed: %s", data_server_url, repr(e))
+
+        return self.record_state(state)
+
+    def record_state(self, state):
+        """
+        record the outcome of a poke made elsewhere (e.g. by AsyncOsaDispatcher) as the current state of its data server
+        """
+        with self._lock:
+            self._states[state.data_server_url] = state
+
+        if self.circuit_breaker is not None:
+            if state.ok:
+                self.circuit_breaker.record_success(state.data_server_url)
+            elif is_backend_failure(state.exception):
+                self.circuit_breaker.record_failure(state.data_server_url)
+            else:
+                self.circuit_breaker.record_neutral(state.data_server_url)
+
+        return state
+
+    def get_state(self, data_server_url):
+        with self._lock:
+            return self._states.get(data_server_url)
+
+    def get_fresh_state(self, data_server_url):
+        state = self.get_state(data_server_url)
+        if state is not None and state.age_s <= self.stale_after_s:
+            return state
+        return None
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                targets = list(self._targets.items())
+
+            for data_server_url, (data_server_cache, logdir) in targets:
+                if self._stop.is_set():
+                    break
+                try:
+                    self.poke(data_server_url, data_server_cache, logdir)
+                except Exception as e:
+                    logger.warning("health monitor failed to poke %s: %s", data_server_url, repr(e))
+
+            self._stop.wait(self.interval_s)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval_s)
+            self._thread = None
+
+
+dda_client_pool = DDAClientPool(
+    pool_connections=_env_int('CDCI_OSA_PLUGIN_DDA_POOL_CONNECTIONS', 4),
+    pool_maxsize=_env_int('CDCI_OSA_PLUGIN_DDA_POOL_MAXSIZE', 16),
+    pool_block=os.environ.get('CDCI_OSA_PLUGIN_DDA_POOL_BLOCK', 'no') == 'yes',
+    max_sessions=_env_int('CDCI_OSA_PLUGIN_DDA_POOL_MAX_SESSIONS', 16),
+)
+
+
+dda_circuit_breaker = DDACircuitBreaker(
+    failure_threshold=_env_int('CDCI_OSA_PLUGIN_DDA_CIRCUIT_FAILURES', 5),
+    base_backoff_s=_env_float('CDCI_OSA_PLUGIN_DDA_CIRCUIT_BASE_BACKOFF_S', 1.),
+    max_backoff_s=_env_float('CDCI_OSA_PLUGIN_DDA_CIRCUIT_MAX_BACKOFF_S', 300.),
+)
+
+
+dda_health_monitor = DDAHealthMonitor(
+    dda_client_pool,
+    circuit_breaker=dda_circuit_breaker,
+    interval_s=_env_float('CDCI_OSA_PLUGIN_DDA_HEALTH_INTERVAL_S', 10.),
+    stale_after_s=_env_float('CDCI_OSA_PLUGIN_DDA_HEALTH_STALE_AFTER_S', 30.),
+    background=os.environ.get('CDCI_OSA_PLUGIN_DDA_HEALTH_MONITOR', 'yes') == 'yes',
+)
+
+
+dda_single_flight = DDASingleFlight(
+    enabled=os.environ.get('CDCI_OSA_PLUGIN_DDA_SINGLE_FLIGHT', 'yes') == 'yes',
+)
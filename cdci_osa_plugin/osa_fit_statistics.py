@@ -0,0 +1,85 @@
+"""
+Overview
+--------
+
+constant and linear weighted least squares fits of lightcurves, as drawn with
+the lightcurve plots: the weighted sums of the rates are computed once and
+give both fits, their chi-squared, degrees of freedom and reduced chi-squared.
+
+Bins with zero, negative or non finite errors, or non finite times or rates,
+have no weight and are not counted, instead of turning the statistics to nan.
+
+The statistics are kept in the product meta_data, and written as keywords of
+the lightcurve extension header (see OsaLightCurve.write).
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   lightcurve_fit_statistics
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Dependencies
+import numpy as np
+
+
+def _fit(p, chisq, n_bins):
+    dof = n_bins - len(p)
+    return dict(p=[float(v) for v in p],
+                chisq=float(max(chisq, 0.)),
+                dof=int(dof),
+                chisq_red=float(max(chisq, 0.)) / dof if dof > 0 else None)
+
+
+def lightcurve_fit_statistics(x, y, dy):
+    """
+    fits of y(x) with errors dy, weighted by 1 / dy**2:
+
+    constant: p = [level]
+    linear: p = [slope, intercept], as numpy.polyfit
+
+    each with chisq, dof and chisq_red, or None if there are not enough bins (or distinct x, for linear);
+    plain python values, to be kept in product meta_data
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = np.isfinite(x) & np.isfinite(y) & np.isfinite(dy) & (dy > 0)
+
+    x, y, w = x[valid], y[valid], 1. / dy[valid] ** 2
+    n_bins = int(len(x))
+
+    statistics = dict(n_bins=n_bins, constant=None, linear=None)
+
+    if n_bins < 2:
+        return statistics
+
+    sum_w = w.sum()
+    mean_x = np.dot(w, x) / sum_w
+    mean_y = np.dot(w, y) / sum_w
+
+    # centered, to avoid cancellation
+    cx = x - mean_x
+    cy = y - mean_y
+    sxx = np.dot(w, cx * cx)
+    sxy = np.dot(w, cx * cy)
+    syy = np.dot(w, cy * cy)
+
+    statistics['constant'] = _fit([mean_y], syy, n_bins)
+
+    if n_bins > 2 and sxx > 0:
+        slope = sxy / sxx
+        statistics['linear'] = _fit([slope, mean_y - slope * mean_x], syy - slope * sxy, n_bins)
+
+    return statistics
@@ -0,0 +1,204 @@
+"""
+Overview
+--------
+
+rewriting of FITS files header by header, without decoding their data: the
+data blocks are copied byte for byte and only the header cards are patched,
+so that the extensions of a response file of many MB are renamed in one
+buffered pass and without materializing the matrix in memory.
+
+Gzip compressed inputs are read transparently, the output is gzip compressed
+with compresslevel, in parallel (see osa_compress).
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   fits_extnames
+   rewrite_fits_headers
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import gzip
+import logging
+import os
+import tempfile
+
+# Dependencies
+from astropy.io import fits as pf
+
+# Project
+from cdci_osa_plugin.osa_compress import ParallelGzipWriter, move_in_place
+
+
+logger = logging.getLogger(__name__)
+
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+_copy_chunk_size = 2 ** 20
+
+
+def open_fits_stream(path):
+    """
+    binary file object reading the FITS file, decompressed if it is gzip compressed
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+
+    return open(path, 'rb')
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    while len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _read_header_cards(f):
+    """
+    cards of the next header, as 80 bytes each, None at the end of the file
+    """
+    cards = []
+    while True:
+        block = _read_exactly(f, BLOCK_SIZE)
+        if not block:
+            if cards:
+                raise ValueError("truncated FITS header")
+            return None
+
+        if len(block) < BLOCK_SIZE:
+            raise ValueError("truncated FITS header block")
+
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE]
+            cards.append(card)
+            if card[:8] == b'END     ':
+                return cards
+
+
+def _card_value(cards, keyword, default=None):
+    keyword = keyword.encode('ascii').ljust(8)
+    for card in cards:
+        if card[:8] == keyword:
+            return pf.Card.fromstring(card.decode('ascii')).value
+    return default
+
+
+def data_size(cards):
+    """
+    size of the data following the header, padded to whole blocks
+    """
+    naxis = _card_value(cards, 'NAXIS', 0)
+    if naxis == 0:
+        return 0
+
+    n = 1
+    for i in range(1, naxis + 1):
+        n *= _card_value(cards, 'NAXIS%d' % i)
+
+    size = abs(_card_value(cards, 'BITPIX')) // 8 * _card_value(cards, 'GCOUNT', 1) * (_card_value(cards, 'PCOUNT', 0) + n)
+
+    return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def fits_extnames(path):
+    """
+    EXTNAME of each HDU of the file (None if not set), reading only the headers, and skipping the data
+    """
+    extnames = []
+    with open_fits_stream(path) as f:
+        while True:
+            cards = _read_header_cards(f)
+            if cards is None:
+                return extnames
+
+            extnames.append(_card_value(cards, 'EXTNAME'))
+            f.seek(data_size(cards), os.SEEK_CUR)
+
+
+def _header_bytes(header):
+    return pf.Header(header).tostring(sep='', endcard=True, padding=True).encode('ascii')
+
+
+def rewrite_fits_headers(in_path, out_path, extnames=None, primary_header=None, compresslevel=None):
+    """
+    copy of the FITS file in_path at out_path, with the extensions renamed and the data copied as is
+
+    extnames: {EXTNAME in the file: EXTNAME in the copy}
+    primary_header: dict of the cards of the primary header of the copy, if it has to be changed (the structure
+    keywords have to describe the data of the file)
+    compresslevel: gzip compress the copy, if not None
+
+    the copy is written to a temporary file and moved in place when complete
+    """
+    extnames = extnames or {}
+
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+
+    with open_fits_stream(in_path) as f_in, \
+            tempfile.NamedTemporaryFile(dir=out_dir, delete=False) as f_tmp:
+        f_out = f_tmp
+        try:
+            if compresslevel is not None:
+                f_out = ParallelGzipWriter(f_tmp, compresslevel=compresslevel)
+
+            hdu_index = 0
+            while True:
+                cards = _read_header_cards(f_in)
+                if cards is None:
+                    break
+
+                if hdu_index == 0 and primary_header is not None:
+                    header = _header_bytes(primary_header)
+                else:
+                    for i, card in enumerate(cards):
+                        if card[:8] == b'EXTNAME ':
+                            extname = pf.Card.fromstring(card.decode('ascii')).value
+                            if extname in extnames:
+                                cards[i] = pf.Card('EXTNAME', extnames[extname]).image.encode('ascii')
+
+                    header = b''.join(cards)
+                    header += b' ' * (-len(header) % BLOCK_SIZE)
+
+                f_out.write(header)
+
+                size = data_size(cards)
+                while size > 0:
+                    chunk = _read_exactly(f_in, min(size, _copy_chunk_size))
+                    if not chunk:
+                        raise ValueError("truncated FITS data in %s" % in_path)
+                    f_out.write(chunk)
+                    size -= len(chunk)
+
+                hdu_index += 1
+
+            if f_out is not f_tmp:
+                f_out.close()
+        except Exception:
+            if f_out is not f_tmp:
+                f_out.abort()
+            f_tmp.close()
+            os.remove(f_tmp.name)
+            raise
+
+    move_in_place(f_tmp.name, out_path)
+
+    logger.debug("rewrote %d headers of %s to %s", hdu_index, in_path, out_path)
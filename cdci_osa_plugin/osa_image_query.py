@@ -31,6 +31,8 @@ import numpy as np
 from .osa_catalog import OsaIsgriCatalog, OsaJemxCatalog
 from .osa_dataserve_dispatcher import OsaDispatcher, OsaQuery
 from .osa_common_pars import DummyOsaRes, split_osa_version
+from .osa_canonical import canonical_query, canonical_number
+from .osa_compress import gzip_file_path, compress_product
 
 
 logger = logging.getLogger(__name__)
@@ -88,6 +90,15 @@ class OsaMosaicQuery(ImageQuery, OsaQuery):
 
     def get_data_server_query(self, instrument, config=None):
 
+        target, modules, assume, inject = canonical_query(self.build_data_server_query, instrument)
+
+        q = OsaDispatcher(config=config, target=target, modules=modules,
+                          assume=assume, inject=inject, instrument=instrument)
+
+        return q
+
+    def build_data_server_query(self, instrument):
+
         scwlist_assumption, cat, extramodules, inject = OsaDispatcher.get_osa_query_base(
             instrument)
         E1 = instrument.get_par_by_name('E1_keV').value
@@ -101,10 +112,7 @@ class OsaMosaicQuery(ImageQuery, OsaQuery):
             target, modules, assume = self.set_instr_dictionaries(
                 extramodules, scwlist_assumption, E1, E2, osa_version)
 
-        q = OsaDispatcher(config=config, target=target, modules=modules,
-                          assume=assume, inject=inject, instrument=instrument)
-
-        return q
+        return target, modules, assume, inject
 
     def process_product_method(self, instrument, prod_list, api=False, **kw):
 
@@ -119,7 +127,9 @@ class OsaMosaicQuery(ImageQuery, OsaQuery):
 
         query_image.add_url_to_fits_file(
             instrument._current_par_dic, url=instrument.disp_conf.products_url)
+        gzip_file_path(query_image)
         query_image.write(overwrite=True)
+        compress_product(query_image)
         query_catalog.write(overwrite=True, format='fits')
         query_catalog.write(overwrite=True, format='ds9')
 
@@ -247,7 +257,7 @@ class IsgriMosaicQuery(OsaMosaicQuery):
         assume = ['ddosa.ImageGroups(input_scwlist=%s)' % scwlist_assumption[0],
                   scwlist_assumption[1],
                   'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(
-                      E1=E1, E2=E2),
+                      E1=canonical_number(E1), E2=canonical_number(E2)),
                   'ddosa.ImagingConfig(use_SouFit=0,use_version="soufit0")',
                   ]
 
@@ -346,7 +356,7 @@ class JemxMosaicQuery(OsaMosaicQuery):
         assume = ['ddjemx.JMXImageGroups(input_scwlist=%s)' % scwlist_assumption[0],
                   scwlist_assumption[1],
                   'ddjemx.JEnergyBins(use_bins=[(%(E1)s,%(E2)s)])' % dict(
-                      E1=E1, E2=E2),
+                      E1=canonical_number(E1), E2=canonical_number(E2)),
                   'ddjemx.JEMX(use_num=%s)' % jemx_num]
 
         return target, modules, assume
@@ -39,11 +39,11 @@ import os
 
 
 import ddaclient as dc
+import logging
 
 # Project
 # relative import eg: from .mod import f
 import numpy as np
-from numpy.lib.recfunctions import append_fields
 from pathlib import Path
 
 from astropy.io import fits as pf
@@ -57,9 +57,125 @@ from cdci_data_analysis.analysis.exceptions import RequestNotUnderstood
 from oda_api.data_products import NumpyDataProduct
 from .osa_dataserve_dispatcher import OsaDispatcher, OsaQuery
 from .osa_common_pars import DummyOsaRes, split_osa_version
+from .osa_canonical import canonical_query, canonical_number
+from .osa_dda_client import _env_int
+from .osa_fit_statistics import lightcurve_fit_statistics
+from .osa_parallel import ordered_map
+from .osa_compress import gzip_file_path, compress_product
+
+logger = logging.getLogger(__name__)
+
+
+def timedel_half_widths(t_lc, timedel, scalar_tail=8):
+    """
+    half widths of the bins centered at t_lc: timedel / 2, shrunk so that a bin does not overlap the previous one
+
+    the recurrence dt[i + 1] = min(timedel / 2, t[i + 1] - t[i] - dt[i]), or timedel / 2 if this is not positive,
+    only has to be followed where t[i + 1] - t[i] is in (0, timedel): elsewhere the result is timedel / 2 whatever
+    dt[i]. These runs are stepped all together, with the same operations as the plain loop, and the last few long
+    runs are finished with the plain loop
+    """
+    half = timedel / 2
+    dt_lc = half * np.ones(t_lc.shape)
+
+    if len(t_lc) < 2:
+        return dt_lc
+
+    gap = np.diff(t_lc)
+
+    dependent = np.zeros(len(t_lc), dtype=bool)
+    dependent[1:] = ~((gap >= timedel) | (gap <= 0))
+
+    run_start = np.flatnonzero(dependent & ~np.r_[False, dependent[:-1]])
+    run_stop = np.flatnonzero(dependent & ~np.r_[dependent[1:], False]) + 1
+
+    while len(run_start) > scalar_tail:
+        x = gap[run_start - 1] - dt_lc[run_start - 1]
+        x = np.where(x < half, x, half)
+        x[x <= 0] = half
+        dt_lc[run_start] = x
+
+        run_start = run_start + 1
+        running = run_start < run_stop
+        run_start, run_stop = run_start[running], run_stop[running]
+
+    for start, stop in zip(run_start, run_stop):
+        for i in range(start - 1, stop - 1):
+            dt_lc[i + 1] = min(half, gap[i] - dt_lc[i])
+            if dt_lc[i + 1] <= 0:
+                dt_lc[i + 1] = half
+
+    return dt_lc
+
+
+def decimate_lightcurve(x, dx, y, dy, max_points, method='minmax'):
+    """
+    at most max_points of the lightcurve (x, dx, y, dy: bin centers, half widths, rates, errors) for plotting,
+    from buckets of consecutive bins; all of them if max_points is 0 or not exceeded
+
+    minmax: the bins with the lowest and highest rate of each bucket, as they are, to keep flares and dips
+    rebin: each bucket as one bin spanning it, with the rate averaged over the bin widths and its error propagated
+    """
+    n = len(x)
+    if max_points <= 0 or n <= max_points:
+        return x, dx, y, dy
+
+    x, dx, y, dy = (np.asarray(a) for a in (x, dx, y, dy))
+
+    if method == 'minmax':
+        n_buckets = max(max_points // 2, 1)
+        bucket = np.arange(n) * n_buckets // n
+
+        # by bucket, then rate: the first and the last of each bucket
+        order = np.lexsort((y, bucket))
+        first = np.r_[True, bucket[order][1:] != bucket[order][:-1]]
+        last = np.r_[first[1:], True]
+        rows = np.unique(np.concatenate([order[first], order[last]]))
+
+        return x[rows], dx[rows], y[rows], dy[rows]
+
+    if method == 'rebin':
+        starts = np.unique(np.arange(max_points) * n // max_points)
+
+        width = 2 * dx
+        sum_width = np.add.reduceat(width, starts)
+        low = np.minimum.reduceat(x - dx, starts)
+        high = np.maximum.reduceat(x + dx, starts)
+
+        return ((low + high) / 2,
+                (high - low) / 2,
+                np.add.reduceat(y * width, starts) / sum_width,
+                np.sqrt(np.add.reduceat((dy * width) ** 2, starts)) / sum_width)
+
+    raise RuntimeError(f"unknown lightcurve decimation {method}, should be minmax or rebin")
+
+
+def append_field(data, name, values):
+    """
+    data, a structured array, with a new field, as numpy.lib.recfunctions.append_fields(...).data but filled field by
+    field into a single new array
+    """
+    raw = data.view(np.ndarray)
+    values = np.asarray(values)
+
+    out = np.empty(raw.shape, dtype=raw.dtype.descr + [(name, values.dtype.str)])
+    for field in raw.dtype.names:
+        out[field] = raw[field]
+    out[name] = values
+
+    return out
 
 
 class OsaLightCurve(LightCurveProduct):
+    # see decimate_lightcurve; 0 plots all bins
+    plot_max_points = _env_int('CDCI_OSA_PLUGIN_LC_PLOT_MAX_POINTS', 10000)
+    plot_decimation = os.environ.get('CDCI_OSA_PLUGIN_LC_PLOT_DECIMATION', 'minmax')
+
+    # lightcurves of the sources built in parallel, the files being read at once at most build_max_pending_mb (0: no
+    # limit) in total, as on disk
+    build_workers = _env_int('CDCI_OSA_PLUGIN_LC_BUILD_WORKERS', 1)
+    build_max_pending_mb = _env_int('CDCI_OSA_PLUGIN_LC_BUILD_MAX_PENDING_MB', 1024)
+
     def __init__(self,
                  name='osa_lc',
                  file_name=None,
@@ -99,17 +215,9 @@ class OsaLightCurve(LightCurveProduct):
             timedel = du.header['TIMEDEL']
             timepix = du.header['TIMEPIXR']
             t_lc = du.data['TIME'] + (0.5 - timepix) * timedel
-            dt_lc = (timedel / 2) * np.ones(t_lc.shape)
-        
-            for i in range(len(t_lc) - 1):
-                dt_lc[i + 1] = min(timedel / 2, t_lc[i + 1] - t_lc[i] - dt_lc[i])
-                if dt_lc[i + 1] <= 0:
-                    dt_lc[i + 1] = timedel / 2
-        
-            _d = np.array(du.data)
-            _o = append_fields(_d, 'TIMEDEL', dt_lc*2)
+            dt_lc = timedel_half_widths(t_lc, timedel)
 
-            du.data = _o.data
+            du.data = append_field(du.data, 'TIMEDEL', dt_lc*2)
 
     @classmethod
     def build_isgri_lc_from_ddosa_res(cls,
@@ -130,16 +238,12 @@ class OsaLightCurve(LightCurveProduct):
         print(
             f"\033[31m build_isgri_lc_from_ddosa_res: {res.extracted_sources} \033[0m")
 
-        for source_name, lightcurve_attr in res.extracted_sources:
+        def build_lc(input_lc_path):
             meta_data = {}
-            input_lc_path = getattr(res, lightcurve_attr)
 
             npd = NumpyDataProduct.from_fits_file(
                 input_lc_path, meta_data=meta_data)
 
-            print(
-                f"\033[31m build_isgri_lc_from_ddosa_res: {res.extracted_sources} \033[0m")
-
             du = npd.get_data_unit_by_name('ISGR-SRC.-LCR')
 
             if du is not None:
@@ -153,10 +257,11 @@ class OsaLightCurve(LightCurveProduct):
                 if du.data is not None:
                     OsaLightCurve.ensure_timedel(du)
 
-                    lc = cls(name='isgri_lc', data=npd, file_name=out_file_name, file_dir=file_dir, prod_prefix=prod_prefix,
-                         src_name=src_name, meta_data=meta_data)
+                    return cls(name='isgri_lc', data=npd, file_name=out_file_name, file_dir=file_dir, prod_prefix=prod_prefix,
+                               src_name=src_name, meta_data=meta_data)
 
-                    lc_list.append(lc)
+        lc_list = cls.build_in_parallel(build_lc, [getattr(res, lightcurve_attr)
+                                                   for source_name, lightcurve_attr in res.extracted_sources])
 
         return lc_list
 
@@ -185,7 +290,7 @@ class OsaLightCurve(LightCurveProduct):
         if prod_prefix is None:
             prod_prefix = ''
 
-        for source_name, input_lc_paht in zip(src_name_list, lc_path_list):
+        def build_lc(input_lc_paht):
             meta_data = {}
 
             npd = NumpyDataProduct.from_fits_file(
@@ -199,7 +304,7 @@ class OsaLightCurve(LightCurveProduct):
 
             if du is None:
                 # warning, this one is empty (add to warning list)
-                continue
+                return
  #               raise RuntimeError('Missing data unit with light curve in the fits file')
 
             if du is not None:
@@ -212,17 +317,25 @@ class OsaLightCurve(LightCurveProduct):
 
                 OsaLightCurve.ensure_timedel(du)
 
-                lc = cls(name='jemx_lc', data=npd, file_name=out_file_name, file_dir=file_dir, prod_prefix=prod_prefix,
-                         src_name=src_name, meta_data=meta_data)
+                return cls(name='jemx_lc', data=npd, file_name=out_file_name, file_dir=file_dir, prod_prefix=prod_prefix,
+                           src_name=src_name, meta_data=meta_data)
 
-                lc_list.append(lc)
+        lc_list = cls.build_in_parallel(build_lc, lc_path_list)
 
         return lc_list
 
-    def get_html_draw(self, plot=False):
-        #
-        npd = NumpyDataProduct.from_fits_file(self.file_path.path)
+    @classmethod
+    def build_in_parallel(cls, build_lc, lc_paths):
+        """
+        build_lc for each lightcurve file, with build_workers threads, skipping None, in order
+        """
+        return [lc for lc in ordered_map(build_lc, lc_paths,
+                                         max_workers=cls.build_workers,
+                                         max_pending_bytes=cls.build_max_pending_mb * 1024 * 1024)
+                if lc is not None]
 
+    @staticmethod
+    def get_lc_data_unit(npd):
         du = npd.get_data_unit_by_name('ISGR-SRC.-LCR')
 
         if du is None:
@@ -231,6 +344,64 @@ class OsaLightCurve(LightCurveProduct):
         if du is None:
             du = npd.get_data_unit_by_name('JMX1-SRC.-LCR')
 
+        return du
+
+    def get_fit_statistics(self, du):
+        """
+        constant and linear fits of the non zero bins of the lightcurve data unit, of time - x_offset (days), see
+        osa_fit_statistics; computed once, and kept in meta_data
+        """
+        fit_statistics = self.meta_data.get('fit_statistics')
+
+        if fit_statistics is None:
+            data = du.data[np.count_nonzero([du.data['RATE'], du.data['ERROR']], axis=0) > 0]
+            x_offset = int(data['TIME'].min()) if len(data) > 0 else 0
+
+            fit_statistics = lightcurve_fit_statistics(data['TIME'] - x_offset, data['RATE'], data['ERROR'])
+            fit_statistics['x_offset'] = x_offset
+            self.meta_data['fit_statistics'] = fit_statistics
+
+        return fit_statistics
+
+    @staticmethod
+    def get_fit_statistics_header(fit_statistics):
+        """
+        header keywords of the fit statistics: number of bins, time offset, and for the constant (CF_) and linear
+        (LF_) fits with enough bins their parameters, chi-squared, dof and reduced chi-squared
+        """
+        header = dict(FIT_NBIN=fit_statistics['n_bins'], FIT_TOFF=fit_statistics['x_offset'])
+
+        for fit, prefix, parameters in ('constant', 'CF_', ['LEVEL']), ('linear', 'LF_', ['SLOPE', 'ICEPT']):
+            values = fit_statistics[fit]
+            if values is None:
+                continue
+
+            header.update({prefix + name: p for name, p in zip(parameters, values['p'])})
+            header[prefix + 'CHI2'] = values['chisq']
+            header[prefix + 'DOF'] = values['dof']
+            if values['chisq_red'] is not None:
+                header[prefix + 'RCHI2'] = values['chisq_red']
+
+        return header
+
+    def write(self, *args, **kwargs):
+        # the fit statistics go with the file, in the header of the lightcurve extension
+        du = self.get_lc_data_unit(self.data) if isinstance(self.data, NumpyDataProduct) else None
+
+        if du is not None and du.data is not None:
+            du.header.update(self.get_fit_statistics_header(self.get_fit_statistics(du)))
+
+        return super(OsaLightCurve, self).write(*args, **kwargs)
+
+    def get_html_draw(self, plot=False):
+        # the product in memory is the one just written, the file is only read if it is not there
+        du = None
+        if isinstance(self.data, NumpyDataProduct):
+            du = self.get_lc_data_unit(self.data)
+
+        if du is None or du.data is None:
+            du = self.get_lc_data_unit(NumpyDataProduct.from_fits_file(self.file_path.path))
+
         if du is None:
             raise RuntimeError('du with lc not found in fits file')
 
@@ -243,7 +414,7 @@ class OsaLightCurve(LightCurveProduct):
         data = data[msk_non_zero]
 
         x = data['TIME']
-        colnames = [x.name for x in data.columns]
+        colnames = list(data.dtype.names)
         if 'TIMEDEL' in colnames:
             dx = data['TIMEDEL'] / 2
         elif 'XAX_E' in colnames:
@@ -260,7 +431,8 @@ class OsaLightCurve(LightCurveProduct):
         except KeyError:
             mjdref = header['MJDREF'] + int(x.min())
 
-        x = x - int(x.min())
+        x_offset = int(x.min())
+        x = x - x_offset
 
         x_range = [(x - dx).min(), (x + dx).max()]
         y_range = [(y - dy).min(), (y + dy).max()]
@@ -271,7 +443,13 @@ class OsaLightCurve(LightCurveProduct):
                          x_range=x_range,
                          y_range=y_range)
 
-        sp.add_errorbar(x, y, yerr=dy, xerr=dx)
+        # the plot gets at most plot_max_points, the product keeps all the bins
+        x_plot, dx_plot, y_plot, dy_plot = decimate_lightcurve(x, dx, y, dy, self.plot_max_points,
+                                                               method=self.plot_decimation)
+        if len(x_plot) < len(x):
+            logger.info("plotting %d points for %d bins of %s, %s", len(x_plot), len(x), self.name, self.plot_decimation)
+
+        sp.add_errorbar(x_plot, y_plot, yerr=dy_plot, xerr=dx_plot)
 
         footer_str = None
         if self.name == 'jemx_lc':
@@ -290,37 +468,37 @@ class OsaLightCurve(LightCurveProduct):
         if footer_str != None:
             footer_str = 'Exposure %5.5f (s) \n' % exposure
 
+        # both fits from one pass over the bins, kept with the product for later draws, and written with it
+        fit_statistics = self.get_fit_statistics(du)
+
+        xf = np.array([x.min(), x.max()])
+
         try:
-            slope = None
-            normalized_slope = None
-            chisq_red = None
-            poly_deg = 0
-            p, chisq, chisq_red, dof, xf, yf = self.do_linear_fit(
-                x, y, dy, poly_deg, 'constant fit')
-            sp.add_line(xf, yf, 'constant fit', color='green')
+            fit = fit_statistics['constant']
+            p = fit['p'] if fit is not None else None
+            sp.add_line(xf, np.polyval(p, xf), 'constant fit', color='green')
 
             if p is not None:
                 footer_str += '\n'
                 footer_str += 'Constant fit\n'
                 footer_str += 'flux level %5.5f (cts/s)\n' % p[0]
-                footer_str += 'dof ' + '%d' % dof + '\n'
-                footer_str += 'Chi-squared red. %5.5f\n' % chisq_red
+                footer_str += 'dof ' + '%d' % fit['dof'] + '\n'
+                footer_str += 'Chi-squared red. %5.5f\n' % fit['chisq_red']
 
         except:
             pass
 
         try:
-            poly_deg = 1
-            p, chisq, chisq_red, dof, xf, yf = self.do_linear_fit(
-                x, y, dy, poly_deg, 'linear fit')
+            fit = fit_statistics['linear']
+            p = fit['p'] if fit is not None else None
             if p is not None:
                 footer_str += '\n'
                 footer_str += 'Linear fit\n'
                 footer_str += 'slope %5.5f\n' % p[0]
-                footer_str += 'dof ' + '%d' % dof + '\n'
-                footer_str += 'Chi-squared red. %5.5f\n' % chisq_red
+                footer_str += 'dof ' + '%d' % fit['dof'] + '\n'
+                footer_str += 'Chi-squared red. %5.5f\n' % fit['chisq_red']
 
-            sp.add_line(xf, yf, 'linear fit', color='orange')
+            sp.add_line(xf, np.polyval(p, xf), 'linear fit', color='orange')
         except:
             pass
 
@@ -334,28 +512,6 @@ class OsaLightCurve(LightCurveProduct):
 
         return res_dict
 
-    def do_linear_fit(self, x, y, dy, poly_deg, label):
-
-        p = None
-        chisq = None
-        chisq_red = None
-        dof = None
-        x_grid = None
-        y_grid = None
-
-        if y.size > poly_deg + 1:
-            p = np.polyfit(x, y, poly_deg)
-
-            x_grid = np.linspace(x.min(), x.max(), 100)
-            lin_fit = np.poly1d(p)
-
-            chisq = (lin_fit(x) - y) ** 2 / dy ** 2
-            dof = y.size - (poly_deg + 1)
-            chisq_red = chisq.sum() / float(dof)
-            y_grid = lin_fit(x_grid)
-
-        return p, chisq, chisq_red, dof, x_grid, y_grid
-
 
 class OSATimebin(TimeDelta):
     def __init__(self,
@@ -398,6 +554,14 @@ class OsaLightCurveQuery(OsaQuery):
     def get_data_server_query(self, instrument,
                               config=None):
 
+        target, modules, assume, inject = canonical_query(self.build_data_server_query, instrument)
+
+        q = OsaDispatcher(config=config, instrument=instrument,
+                          target=target, modules=modules, assume=assume, inject=inject)
+        return q
+
+    def build_data_server_query(self, instrument):
+
         scwlist_assumption, cat, extramodules, inject = OsaDispatcher.get_osa_query_base(
             instrument)
 
@@ -416,9 +580,7 @@ class OsaLightCurveQuery(OsaQuery):
             target, modules, assume = self.set_instr_dictionaries(extramodules, scwlist_assumption, E1, E2, src_name,
                                                                   delta_t, osa_version=osa_version)
 
-        q = OsaDispatcher(config=config, instrument=instrument,
-                          target=target, modules=modules, assume=assume, inject=inject)
-        return q
+        return target, modules, assume, inject
 
     def set_instr_dictionaries(self, extramodules, scwlist_assumption, E1, E2, src_name, delta_t):
         raise RuntimeError('Must be specified for each instrument')
@@ -439,7 +601,9 @@ class OsaLightCurveQuery(OsaQuery):
 
             query_lc.add_url_to_fits_file(
                 instrument._current_par_dic, url=instrument.disp_conf.products_url)
+            gzip_file_path(query_lc)
             query_lc.write()
+            compress_product(query_lc)
 
             if api == False:
                 _names.append(query_lc.meta_data['src_name'])
@@ -524,10 +688,10 @@ class IsgriLightCurveQuery(OsaLightCurveQuery):
 
         assume = ['process_isgri_lc.ScWLCList(input_scwlist=%s)' % scwlist_assumption[0],
                   scwlist_assumption[1],
-                  'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=E1,
-                                                                                                           E2=E2),
-                  'ddosa.LCEnergyBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=E1,
-                                                                                                              E2=E2),
+                  'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=canonical_number(E1),
+                                                                                                           E2=canonical_number(E2)),
+                  'ddosa.LCEnergyBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=canonical_number(E1),
+                                                                                                              E2=canonical_number(E2)),
                   'ddosa.ImagingConfig(use_SouFit=0,use_version="soufit0_p2",use_DoPart2=1)',
                   'ddosa.CatForLC(use_minsig=3)',
                   'ddosa.LCTimeBin(use_time_bin_seconds=%f)' % delta_t]
@@ -597,7 +761,7 @@ class JemxLightCurveQuery(OsaLightCurveQuery):
         assume = ['ddjemx.JMXLCGroups(input_scwlist=%s)' % scwlist_assumption[0],
                   scwlist_assumption[1],
                   'ddjemx.JEnergyBinsLC (use_bins=[(%(E1)s,%(E2)s)])' % dict(
-                      E1=E1, E2=E2),
+                      E1=canonical_number(E1), E2=canonical_number(E2)),
                   'ddjemx.LCTimeBin(use_time_bin_seconds=%f)' % delta_t,
                   'ddjemx.JEMX(use_num=%d)' % jemx_num]
 
@@ -0,0 +1,85 @@
+"""
+Overview
+--------
+
+bounded thread pool map keeping the order of the inputs, for building
+products of many sources (or files) at once: reading and decompressing
+FITS files and numpy work release the GIL, so that they overlap between
+sources.
+
+The number of items in flight is bounded by the number of workers, and
+optionally by the total size of their inputs.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   ordered_map
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+def file_size(path):
+    """
+    size of a file on disk, 0 if it can not be found; compressed files count for their compressed size
+    """
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def ordered_map(fn, items, max_workers=1, max_pending_bytes=0, item_bytes=file_size):
+    """
+    [fn(item) for item in items], with max_workers > 1 computed in a thread pool
+
+    max_pending_bytes: if > 0, items are only started while the item_bytes(item) of the ones started and not yet
+    collected add up to at most this, but always at least one; the results are collected in order
+
+    an exception of fn is raised when its result is collected, after the items already started have completed
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    results = [None] * len(items)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        pending_bytes = 0
+
+        for i, item in enumerate(items):
+            size = item_bytes(item) if max_pending_bytes > 0 else 0
+
+            while pending and (len(pending) >= 2 * max_workers or
+                               (max_pending_bytes > 0 and pending_bytes + size > max_pending_bytes)):
+                j, future, future_size = pending.popleft()
+                results[j] = future.result()
+                pending_bytes -= future_size
+
+            pending.append((i, pool.submit(fn, item), size))
+            pending_bytes += size
+
+        while pending:
+            j, future, _ = pending.popleft()
+            results[j] = future.result()
+
+    return results
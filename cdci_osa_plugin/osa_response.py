@@ -0,0 +1,244 @@
+"""
+Overview
+--------
+
+response matrices of spectra in compressed sparse row form, for folding
+models through them in spectral fits: the OGIP groups (F_CHAN, N_CHAN) of
+every energy row of the RMF are expanded once into the non zero elements
+only, and many model spectra are folded at once, as one sparse by dense
+matrix product.
+
+The responses are built from the SPECRESP MATRIX and EBOUNDS data units of
+the RMF products, and kept by content hash of the RMF file (see
+osa_response_cache), so that repeated fits of the same response do not read
+it again.
+
+Sparse products use scipy (optional, install with `cdci_osa_plugin[spatial]`),
+otherwise the non zero elements are summed per channel with numpy.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   SparseResponse
+   get_sparse_response
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import logging
+import threading
+from collections import OrderedDict
+
+# Dependencies
+import numpy as np
+
+# Project
+from cdci_osa_plugin.osa_dda_client import _env_int
+from cdci_osa_plugin.osa_response_cache import response_cache, file_content_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+MATRIX_EXTNAMES = ('SPECRESP MATRIX', 'MATRIX')
+EBOUNDS_EXTNAME = 'EBOUNDS'
+
+# elements of the (models x non zero elements) products summed at once without scipy
+_fold_chunk_size = 2 ** 24
+
+
+def _column_header_value(header, column, keyword, default=None):
+    for key, value in header.items():
+        if key.startswith('TTYPE') and str(value).strip().upper() == column:
+            return header.get(keyword + key[len('TTYPE'):], default)
+    return default
+
+
+def _get_data_unit(data_units, names):
+    for du in data_units:
+        if du.name in names:
+            return du
+
+
+class SparseResponse(object):
+    """
+    response R[energy, channel] in CSR form: indptr (n_energies + 1), channels and values of the non zero elements
+    of each energy row
+
+    energ_lo, energ_hi: edges of the energy rows
+    e_min, e_max: edges of the channels, if EBOUNDS are known
+    """
+
+    def __init__(self, indptr, channels, values, n_channels, energ_lo=None, energ_hi=None, e_min=None, e_max=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.channels = np.asarray(channels, dtype=np.int64)
+        self.values = np.asarray(values, dtype=float)
+        self.n_channels = int(n_channels)
+
+        self.energ_lo = energ_lo
+        self.energ_hi = energ_hi
+        self.e_min = e_min
+        self.e_max = e_max
+
+        self._rows = np.repeat(np.arange(self.n_energies), np.diff(self.indptr))
+
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            self._matrix_t = None
+
+            # by channel, to sum per channel
+            order = np.argsort(self.channels, kind='stable')
+            self._channel_rows = self._rows[order]
+            self._channel_values = self.values[order]
+            self._summed_channels, self._channel_starts = np.unique(self.channels[order], return_index=True)
+        else:
+            self._matrix_t = csr_matrix((self.values, self.channels, self.indptr),
+                                        shape=(self.n_energies, self.n_channels)).T.tocsr()
+
+    @property
+    def n_energies(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    @classmethod
+    def from_data_units(cls, data_units):
+        """
+        from the SPECRESP MATRIX (or MATRIX) and, if any, EBOUNDS data units of an RMF
+        """
+        matrix_du = _get_data_unit(data_units, MATRIX_EXTNAMES)
+        if matrix_du is None:
+            raise ValueError("no %s data unit in the response, found %s" % (
+                ' or '.join(MATRIX_EXTNAMES), [du.name for du in data_units]))
+
+        ebounds_du = _get_data_unit(data_units, (EBOUNDS_EXTNAME,))
+
+        data = matrix_du.data
+        n_energies = len(data)
+
+        n_grp = data['N_GRP'] if 'N_GRP' in data.dtype.names else np.ones(n_energies, dtype=int)
+
+        first_channel = _column_header_value(matrix_du.header, 'F_CHAN', 'TLMIN')
+        if first_channel is None and ebounds_du is not None:
+            first_channel = int(np.min(ebounds_du.data['CHANNEL']))
+        if first_channel is None:
+            first_channel = 1
+
+        n_channels = matrix_du.header.get('DETCHANS')
+
+        rows_channels = []
+        rows_values = []
+        for i in range(n_energies):
+            f_chan = np.atleast_1d(data['F_CHAN'][i])[:n_grp[i]]
+            n_chan = np.atleast_1d(data['N_CHAN'][i])[:n_grp[i]]
+
+            channels = np.concatenate([np.arange(f, f + n) for f, n in zip(f_chan, n_chan)] or
+                                      [np.zeros(0, dtype=int)]) - first_channel
+            values = np.atleast_1d(data['MATRIX'][i])[:len(channels)].astype(float)
+
+            nonzero = values != 0
+            rows_channels.append(channels[nonzero])
+            rows_values.append(values[nonzero])
+
+        indptr = np.zeros(n_energies + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(values) for values in rows_values])
+        channels = np.concatenate(rows_channels) if rows_channels else np.zeros(0, dtype=np.int64)
+        values = np.concatenate(rows_values) if rows_values else np.zeros(0)
+
+        if n_channels is None:
+            if ebounds_du is not None:
+                n_channels = len(ebounds_du.data)
+            else:
+                n_channels = int(channels.max()) + 1 if len(channels) else 0
+
+        kw = {}
+        if 'ENERG_LO' in data.dtype.names:
+            kw.update(energ_lo=np.array(data['ENERG_LO'], dtype=float), energ_hi=np.array(data['ENERG_HI'], dtype=float))
+        if ebounds_du is not None:
+            kw.update(e_min=np.array(ebounds_du.data['E_MIN'], dtype=float),
+                      e_max=np.array(ebounds_du.data['E_MAX'], dtype=float))
+
+        return cls(indptr, channels, values, n_channels, **kw)
+
+    def fold(self, models, specresp=None):
+        """
+        expected counts in the channels of the models, photon fluxes in the energy rows: one model (n_energies)
+        or many (n_models, n_energies), folded at once
+
+        specresp: effective area of the energy rows (ARF), multiplied to the models
+        """
+        models = np.asarray(models, dtype=float)
+        single = models.ndim == 1
+        models = np.atleast_2d(models)
+
+        if models.shape[1] != self.n_energies:
+            raise ValueError("models of %d energies for a response of %d" % (models.shape[1], self.n_energies))
+
+        if specresp is not None:
+            models = models * np.asarray(specresp, dtype=float)
+
+        if self._matrix_t is not None:
+            counts = np.asarray(self._matrix_t.dot(models.T).T)
+        else:
+            counts = np.zeros((len(models), self.n_channels))
+            if self.nnz > 0:
+                chunk = max(1, _fold_chunk_size // self.nnz)
+                for i in range(0, len(models), chunk):
+                    contributions = models[i:i + chunk, self._channel_rows] * self._channel_values
+                    counts[i:i + chunk, self._summed_channels] = np.add.reduceat(contributions, self._channel_starts,
+                                                                                 axis=1)
+
+        if single:
+            return counts[0]
+        return counts
+
+    def to_dense(self):
+        matrix = np.zeros((self.n_energies, self.n_channels))
+        matrix[self._rows, self.channels] = self.values
+        return matrix
+
+
+_sparse_responses = OrderedDict()
+_sparse_responses_lock = threading.Lock()
+_sparse_responses_max_entries = _env_int('CDCI_OSA_PLUGIN_SPARSE_RESPONSE_CACHE_ENTRIES', 16)
+
+
+def get_sparse_response(rmf_file, extnames=None, content_hash=None):
+    """
+    SparseResponse of the RMF file, built once per file content
+
+    extnames: {name in the file: name in the product}, see osa_response_cache.ResponseCache.get
+    content_hash: of the file, if already known
+    """
+    if content_hash is None:
+        content_hash = file_content_hash(rmf_file)
+
+    with _sparse_responses_lock:
+        response = _sparse_responses.get(content_hash)
+        if response is not None:
+            _sparse_responses.move_to_end(content_hash)
+            return response
+
+    response = SparseResponse.from_data_units(response_cache.get(rmf_file, extnames, content_hash=content_hash))
+
+    logger.info("sparse response %s: %d energies, %d channels, %d non zero elements", content_hash,
+                response.n_energies, response.n_channels, response.nnz)
+
+    with _sparse_responses_lock:
+        _sparse_responses[content_hash] = response
+        while len(_sparse_responses) > _sparse_responses_max_entries:
+            _sparse_responses.popitem(last=False)
+
+    return response
@@ -0,0 +1,135 @@
+"""
+Overview
+--------
+
+content-addressed cache of the response files (ARF, RMF) of spectra: within
+one result most sources share the same response file, and the same files come
+back in later results, so each file is identified by the hash of its content
+and decoded only once, with its extensions renamed to the OGIP names.
+
+Every result gets its own copy of the decoded data units, which are modified
+when written (url of the request in the primary header), and shares them
+between all of its sources with the same response.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   file_content_hash
+   ResponseCache
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import copy
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+# Project
+from oda_api.data_products import NumpyDataProduct
+
+from cdci_osa_plugin.osa_dda_client import _env_int
+
+
+logger = logging.getLogger(__name__)
+
+
+_hash_block_size = 2 ** 20
+
+# (path, size, mtime) -> hash, so that the same file is read once
+_file_hashes = OrderedDict()
+_file_hashes_max_entries = 1024
+_file_hashes_lock = threading.Lock()
+
+
+def file_content_hash(path):
+    """
+    sha256 of the content of the file, hex
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+    with _file_hashes_lock:
+        content_hash = _file_hashes.get(key)
+        if content_hash is not None:
+            _file_hashes.move_to_end(key)
+            return content_hash
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_hash_block_size), b''):
+            h.update(block)
+    content_hash = h.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[key] = content_hash
+        while len(_file_hashes) > _file_hashes_max_entries:
+            _file_hashes.popitem(last=False)
+
+    return content_hash
+
+
+class ResponseCache(object):
+    """
+    data units of response files by content hash, with extensions renamed
+
+    max_entries: number of decoded files kept, least recently used are dropped
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+
+        self._data_units = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, extnames=None, content_hash=None):
+        """
+        copy of the data units of the response file at path
+
+        extnames: {name in the file: name in the product}
+        content_hash: of the file, if already known
+        """
+        if content_hash is None:
+            content_hash = file_content_hash(path)
+        key = (content_hash, tuple(sorted((extnames or {}).items())))
+
+        with self._lock:
+            data_units = self._data_units.get(key)
+            if data_units is not None:
+                self._data_units.move_to_end(key)
+
+        if data_units is None:
+            logger.info("decoding response %s from %s", content_hash, path)
+
+            data_units = NumpyDataProduct.from_fits_file(path).data_unit
+            for du in data_units:
+                if du.name in (extnames or {}):
+                    du.name = extnames[du.name]
+
+            with self._lock:
+                self._data_units[key] = data_units
+                while len(self._data_units) > self.max_entries:
+                    self._data_units.popitem(last=False)
+
+        return copy.deepcopy(data_units)
+
+    def __len__(self):
+        return len(self._data_units)
+
+    def clear(self):
+        with self._lock:
+            self._data_units.clear()
+
+
+response_cache = ResponseCache(max_entries=_env_int('CDCI_OSA_PLUGIN_RESPONSE_CACHE_ENTRIES', 8))
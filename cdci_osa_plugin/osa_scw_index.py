@@ -0,0 +1,243 @@
+"""
+Overview
+--------
+
+local, offline table of INTEGRAL ScW pointings, for resolving the ScWs of a
+cone and time window in-process (the 'pointing_index' method of
+OsaDispatcher.test_has_input_products) instead of asking the timesystem API.
+
+The table is a numpy .npy structured array (scw_id, tstart, tstop in MJD UTC,
+ra, dec of the pointing in deg) sorted by tstart. Cone searches go through a
+grid of declination bands split in equal RA cells, time windows through
+binary search on tstart.
+
+The table is loaded in memory, with the unit vectors of the pointings and
+the cell grid derived from it: about 100 bytes per pointing, some 20 MB for
+the whole mission.
+
+The index file is set with CDCI_OSA_PLUGIN_SCW_INDEX; it can be made from the
+ISDC ScW index with ScWPointingIndex.from_isdc_index(fn).save(path)
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   ScWPointingIndex
+   get_scw_pointing_index
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import logging
+import os
+import threading
+
+# Dependencies
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+pointing_dtype = np.dtype([('scw_id', 'S16'),
+                           ('tstart', 'f8'),
+                           ('tstop', 'f8'),
+                           ('ra', 'f8'),
+                           ('dec', 'f8')])
+
+
+# ISDC time (IJD) is days since 2000-01-01T00:00:00
+IJD_TO_MJD = 51544.
+
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+class ScWPointingIndex(object):
+    """
+    cone and time window search over a pointing table, see module doc
+
+    cell_deg: height of the declination bands, and approximate width of the RA cells
+    """
+
+    def __init__(self, table, cell_deg=2.):
+        if table.dtype != pointing_dtype:
+            table = table.astype(pointing_dtype)
+
+        if len(table) > 1 and np.any(np.diff(table['tstart']) < 0):
+            table = np.sort(table, order='tstart')
+
+        self.table = table
+        self.cell_deg = cell_deg
+
+        self._tstart = np.asarray(table['tstart'])
+        self._tstop = np.asarray(table['tstop'])
+        self._max_duration = float(np.max(self._tstop - self._tstart)) if len(table) > 0 else 0.
+        self._xyz = _unit_vectors(table['ra'], table['dec'])
+        self._id_order = None
+
+        self._build_cells()
+
+    def _build_cells(self):
+        self._n_bands = int(np.ceil(180. / self.cell_deg))
+        band_lo = -90. + self.cell_deg * np.arange(self._n_bands)
+        band_hi = np.minimum(band_lo + self.cell_deg, 90.)
+
+        # the band is widest at its edge closest to the equator
+        widest = np.where((band_lo <= 0) & (band_hi >= 0), 0., np.minimum(np.abs(band_lo), np.abs(band_hi)))
+        self._band_n_ra = np.maximum(1, np.ceil(360. * np.cos(np.radians(widest)) / self.cell_deg)).astype(int)
+        self._band_offset = np.concatenate([[0], np.cumsum(self._band_n_ra)])
+
+        cells = self._cell_ids(np.asarray(self.table['ra']), np.asarray(self.table['dec']))
+
+        self._cell_rows = np.argsort(cells, kind='stable')
+        self._cell_start = np.searchsorted(cells[self._cell_rows], np.arange(self._band_offset[-1] + 1))
+
+    def _band(self, dec):
+        return np.clip(np.floor((np.asarray(dec) + 90.) / self.cell_deg).astype(int), 0, self._n_bands - 1)
+
+    def _cell_ids(self, ra, dec):
+        band = self._band(dec)
+        n_ra = self._band_n_ra[band]
+        ra_cell = np.minimum(np.floor(np.mod(ra, 360.) / 360. * n_ra).astype(int), n_ra - 1)
+        return self._band_offset[band] + ra_cell
+
+    def _cone_rows(self, ra, dec, radius):
+        rows = []
+
+        for band in range(int(self._band(max(dec - radius, -90.))), int(self._band(min(dec + radius, 90.))) + 1):
+            n_ra = self._band_n_ra[band]
+            offset = self._band_offset[band]
+
+            # half width in RA of the cone, from its center
+            if dec + radius >= 90. or dec - radius <= -90. or np.cos(np.radians(dec)) <= np.sin(np.radians(radius)):
+                cells = range(offset, offset + n_ra)
+            else:
+                dra = np.degrees(np.arcsin(np.sin(np.radians(radius)) / np.cos(np.radians(dec))))
+                first = int(np.floor((ra - dra) / 360. * n_ra))
+                last = int(np.floor((ra + dra) / 360. * n_ra))
+                if last - first + 1 >= n_ra:
+                    cells = range(offset, offset + n_ra)
+                else:
+                    cells = [offset + c % n_ra for c in range(first, last + 1)]
+
+            for c in cells:
+                rows.append(self._cell_rows[self._cell_start[c]:self._cell_start[c + 1]])
+
+        if len(rows) == 0:
+            return np.zeros(0, dtype=int)
+
+        return np.concatenate(rows)
+
+    def query(self, ra, dec, radius, t1, t2):
+        """
+        ids of the ScWs pointing within radius (deg) of ra, dec (deg) and overlapping [t1, t2] (MJD), by start time
+        """
+        # overlap: tstart < t2 and tstop > t1, with tstop - tstart <= max_duration
+        first = np.searchsorted(self._tstart, t1 - self._max_duration, side='left')
+        last = np.searchsorted(self._tstart, t2, side='left')
+
+        cone_rows = self._cone_rows(ra, dec, radius)
+
+        if last - first <= len(cone_rows):
+            rows = np.arange(first, last)
+        else:
+            rows = cone_rows[(cone_rows >= first) & (cone_rows < last)]
+
+        rows = rows[self._tstop[rows] > t1]
+        rows = rows[self._xyz[rows] @ _unit_vectors(ra, dec) >= np.cos(np.radians(radius))]
+
+        return [scw_id.decode() for scw_id in self.table['scw_id'][np.sort(rows)]]
+
+    def lookup(self, scw_ids):
+        """
+        rows of the table for scw_ids, None if any of them is not in the table
+        """
+        if self._id_order is None:
+            id_order = np.argsort(self.table['scw_id'])
+            self._sorted_ids = np.asarray(self.table['scw_id'])[id_order]
+            self._id_order = id_order
+
+        scw_ids = np.asarray(scw_ids, dtype='S16')
+        if len(scw_ids) == 0:
+            return self.table[:0]
+
+        i = np.minimum(np.searchsorted(self._sorted_ids, scw_ids), len(self._sorted_ids) - 1)
+        if len(self._sorted_ids) == 0 or np.any(self._sorted_ids[i] != scw_ids):
+            return None
+
+        return self.table[self._id_order[i]]
+
+    def __len__(self):
+        return len(self.table)
+
+    @classmethod
+    def from_arrays(cls, scw_id, tstart, tstop, ra, dec, **kwargs):
+        table = np.zeros(len(scw_id), dtype=pointing_dtype)
+        table['scw_id'] = scw_id
+        table['tstart'] = tstart
+        table['tstop'] = tstop
+        table['ra'] = ra
+        table['dec'] = dec
+        return cls(table, **kwargs)
+
+    @classmethod
+    def from_isdc_index(cls, fn, **kwargs):
+        """
+        from the ISDC ScW index (GNRL-SCWG-GRP-IDX), pointings only
+        """
+        from astropy.io import fits as pf
+
+        with pf.open(fn) as f:
+            d = f[1].data
+            pointings = np.asarray(d['SW_TYPE']).astype(str) == 'POINTING'
+            return cls.from_arrays(['%s.%03d' % (swid, swver) for swid, swver in
+                                    zip(d['SWID'][pointings], d['SWVER'][pointings])],
+                                   np.asarray(d['TSTART'][pointings]) + IJD_TO_MJD,
+                                   np.asarray(d['TSTOP'][pointings]) + IJD_TO_MJD,
+                                   d['RA_SCX'][pointings],
+                                   d['DEC_SCX'][pointings],
+                                   **kwargs)
+
+    def save(self, fn):
+        np.save(fn, np.asarray(self.table))
+
+    @classmethod
+    def load(cls, fn, **kwargs):
+        return cls(np.load(fn), **kwargs)
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def get_scw_pointing_index(fn=None):
+    """
+    index loaded from fn, by default CDCI_OSA_PLUGIN_SCW_INDEX; kept until the file changes. None if there is no file
+    """
+    if fn is None:
+        fn = os.environ.get('CDCI_OSA_PLUGIN_SCW_INDEX')
+
+    if fn is None or not os.path.exists(fn):
+        return None
+
+    key = (fn, os.stat(fn).st_mtime)
+
+    with _indices_lock:
+        index = _indices.get(fn)
+        if index is None or index[0] != key:
+            logger.info("loading ScW pointing index %s", fn)
+            index = _indices[fn] = (key, ScWPointingIndex.load(fn))
+
+    return index[1]
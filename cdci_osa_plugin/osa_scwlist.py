@@ -0,0 +1,151 @@
+"""
+Overview
+--------
+
+parsing and validation of user ScW lists in one vectorized pass: the ids are
+laid out as a fixed width array of codepoints, checked against the
+RRRRPPPPSSSF.VVV format, and decoded into integer arrays (revolution,
+pointing, subpointing, type and version). Lists of many thousands of ScWs are
+validated, counted and checked for NRT (.000) versions in linear time.
+
+ScWList.expression() gives a compact python expression evaluating to the
+list, with one tuple per run of consecutive pointings, for assumptions about
+long lists which would otherwise be written as one literal per ScW.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   ScWList
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Dependencies
+import numpy as np
+
+
+SCW_ID_LENGTH = 16
+
+# RRRR PPPP SSS F . VVV
+_fields = dict(revolution=(0, 4),
+               pointing=(4, 8),
+               subpointing=(8, 11),
+               scw_type=(11, 12),
+               version=(13, 16))
+
+_digit_columns = np.r_[0:12, 13:16]
+
+_scw_id_format = "%04d%04d%03d%d.%03d"
+
+
+def _decode(digits, first, last):
+    weights = 10 ** np.arange(last - first - 1, -1, -1)
+    return digits[:, first:last] @ weights
+
+
+class ScWList(object):
+    """
+    parsed ScW list, from a list of ids or a comma separated string; items are stripped of whitespace
+
+    ids: the stripped items, in order
+    valid: mask of the items in the RRRRPPPPSSSF.VVV format
+    revolution, pointing, subpointing, scw_type, version: integer fields, -1 for invalid items
+    """
+
+    def __init__(self, scw_list):
+        if scw_list is None:
+            scw_list = []
+        elif isinstance(scw_list, str):
+            scw_list = scw_list.split(",")
+
+        self.ids = [str(item).strip() for item in scw_list]
+
+        n = len(self.ids)
+
+        # longer items are truncated, they are malformed from their lengths alone
+        width = SCW_ID_LENGTH + 1
+
+        codes = np.array(self.ids, dtype='U%d' % width).view(np.uint32).reshape(n, width)
+        lengths = np.fromiter(map(len, self.ids), dtype=int, count=n)
+
+        digits = codes[:, :SCW_ID_LENGTH].astype(np.int64) - ord('0')
+
+        # as ^(\d{12}).(\d{3})$, with ascii digits
+        self.valid = (lengths == SCW_ID_LENGTH) & \
+            np.all((digits[:, _digit_columns] >= 0) & (digits[:, _digit_columns] <= 9), axis=1) & \
+            (codes[:, 12] != ord('\n'))
+
+        for name, (first, last) in _fields.items():
+            setattr(self, name, np.where(self.valid, _decode(digits, first, last), -1))
+
+        # for any item, valid or not, as endswith('.000')
+        rows = np.arange(n)
+        ends = np.minimum(lengths, width)
+        suffix = np.stack([codes[rows, np.maximum(ends - 4 + i, 0)] for i in range(4)], axis=-1)
+        self._nrt_suffix = (lengths >= 4) & np.all(suffix == [ord(c) for c in '.000'], axis=1)
+
+        for i in np.flatnonzero(lengths > width):
+            self._nrt_suffix[i] = self.ids[i].endswith('.000')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def malformed(self):
+        """
+        items not in the ScW id format, in order
+        """
+        return [self.ids[i] for i in np.flatnonzero(~self.valid)]
+
+    def accepted(self):
+        """
+        items in the ScW id format, in order
+        """
+        return [self.ids[i] for i in np.flatnonzero(self.valid)]
+
+    def nrt(self):
+        """
+        mask of the items with a .000 (NRT) version
+        """
+        return self._nrt_suffix.copy()
+
+    def has_nrt(self):
+        return bool(np.any(self._nrt_suffix))
+
+    def runs(self):
+        """
+        (revolution, first pointing, last pointing, subpointing, type, version) for each run of consecutive items
+        with increasing consecutive pointings and the other fields equal, in order; all items have to be valid
+        """
+        if not np.all(self.valid):
+            raise ValueError("malformed ScW ids: %s" % self.malformed())
+
+        if len(self) == 0:
+            return []
+
+        other = np.stack([self.revolution, self.subpointing, self.scw_type, self.version], axis=-1)
+
+        starts = np.ones(len(self), dtype=bool)
+        starts[1:] = (np.diff(self.pointing) != 1) | np.any(other[1:] != other[:-1], axis=1)
+        first = np.flatnonzero(starts)
+        last = np.r_[first[1:], len(self)] - 1
+
+        return list(zip(self.revolution[first].tolist(), self.pointing[first].tolist(), self.pointing[last].tolist(),
+                        self.subpointing[first].tolist(), self.scw_type[first].tolist(), self.version[first].tolist()))
+
+    def expression(self):
+        """
+        python expression evaluating to the list of ids, in order, its length grows with the number of runs
+        """
+        return '["%s" %% (r, p, s, f, v) for r, p0, p1, s, f, v in [%s] for p in range(p0, p1 + 1)]' % (
+            _scw_id_format, ", ".join("(%d,%d,%d,%d,%d,%d)" % run for run in self.runs()))
@@ -0,0 +1,264 @@
+"""
+Overview
+--------
+
+cache of resolved ScW lists (cone and time window to ScW ids), with TTL and
+least-recently-used eviction.
+
+Besides exact repeats, a query for the same cone with a time window extending
+a cached one only fetches the missing edges, and the results are merged.
+When the pointing (time and direction) of every ScW in a cached entry is
+known from the local pointing index (see osa_scw_index), narrower queries,
+in time or radius, are answered by filtering the entry locally.
+
+ScWs keep being ingested for a while after they are observed, so windows
+ending less than CDCI_OSA_PLUGIN_SCWLIST_INGESTION_LATENCY_S (30 days by
+default) ago are always resolved again, and never stored; this holds for
+every use of the cache, timesystem and ReportScWList lists alike.
+
+Lookups are split in two phases, lookup() and complete(), so that the fetching
+can be done either blocking or with asyncio; get() does both.
+
+
+Classes and Inheritance Structure
+----------------------------------------------
+.. inheritance-diagram::
+
+Summary
+---------
+.. autosummary::
+   ScWListCache
+   ScWListLookup
+
+Module API
+----------
+"""
+
+from __future__ import absolute_import, division, print_function
+
+# Standard library
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Dependencies
+import numpy as np
+from astropy.time import Time
+
+# Project
+from cdci_osa_plugin.osa_dda_client import _env_int, _env_float
+from cdci_osa_plugin.osa_scw_index import get_scw_pointing_index, _unit_vectors
+
+
+logger = logging.getLogger(__name__)
+
+
+def _mjd(t_iso):
+    return Time(t_iso, format='isot', scale='utc').mjd
+
+
+def _pointing_metadata(scw_list):
+    index = get_scw_pointing_index()
+    if index is None:
+        return None
+    return index.lookup(scw_list)
+
+
+class _Entry(object):
+
+    def __init__(self, key, ra, dec, radius, t1_iso, t2_iso, scw_list, metadata, created_at):
+        self.key = key
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius
+        self.t1_iso = t1_iso
+        self.t2_iso = t2_iso
+        self.t1 = _mjd(t1_iso)
+        self.t2 = _mjd(t2_iso)
+        self.scw_list = scw_list
+        self.created_at = created_at
+
+        # pointing of each ScW, if known: needed to answer narrower queries
+        self.metadata = metadata
+        if metadata is not None:
+            self._xyz = _unit_vectors(metadata['ra'], metadata['dec'])
+
+    def same_cone(self, ra, dec, radius):
+        return abs(self.ra - ra) < 1e-9 and abs(self.dec - dec) < 1e-9 and abs(self.radius - radius) < 1e-9
+
+    def covers_cone(self, ra, dec, radius):
+        cos_sep = float(np.dot(_unit_vectors(self.ra, self.dec), _unit_vectors(ra, dec)))
+        return np.degrees(np.arccos(np.clip(cos_sep, -1., 1.))) + radius <= self.radius + 1e-9
+
+    def select(self, ra, dec, radius, t1, t2):
+        m = (self.metadata['tstart'] < t2) & (self.metadata['tstop'] > t1)
+        m &= self._xyz @ _unit_vectors(ra, dec) >= np.cos(np.radians(radius))
+        return [scw for scw, selected in zip(self.scw_list, m) if selected]
+
+
+class ScWListLookup(object):
+    """
+    outcome of ScWListCache.lookup: scw_list if the query was answered from the cache, otherwise the (T1, T2)
+    windows, as isot, which still have to be resolved and passed to ScWListCache.complete
+    """
+
+    def __init__(self, query, scw_list=None, missing=None, base=None):
+        self.query = query
+        self.scw_list = scw_list
+        self.missing = missing
+        self.base = base
+
+
+class ScWListCache(object):
+    """
+    ttl_s: age after which entries are not used; 0 disables the cache
+    max_entries: number of entries kept, least recently used are dropped
+    metadata: function returning the pointings (tstart, tstop, ra, dec) of a ScW list, or None if unknown
+    ingestion_latency_s: windows ending less than this before now may still get new ScWs, and are not stored
+    """
+
+    def __init__(self, ttl_s=3600., max_entries=1024, metadata=_pointing_metadata, ingestion_latency_s=30 * 86400.):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.metadata = metadata
+        self.ingestion_latency_s = ingestion_latency_s
+
+        self._entries = OrderedDict()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _live_entries(self, key):
+        now = time.monotonic()
+        for entry_id, entry in list(self._entries.items()):
+            if now - entry.created_at > self.ttl_s:
+                del self._entries[entry_id]
+            elif entry.key == key:
+                yield entry_id, entry
+
+    def lookup(self, ra, dec, radius, t1_iso, t2_iso, key=(), exact=False):
+        """
+        key: other inputs of the resolution, entries are only used for the same key
+        exact: only answer repeats of the same query, e.g. when the result is not a plain union over time
+        """
+        query = (key, ra, dec, radius, t1_iso, t2_iso)
+
+        if self.ttl_s <= 0:
+            return ScWListLookup(query, missing=[(t1_iso, t2_iso)])
+
+        t1, t2 = _mjd(t1_iso), _mjd(t2_iso)
+
+        with self._lock:
+            extendable = None
+
+            for entry_id, entry in self._live_entries(key):
+                if entry.same_cone(ra, dec, radius) and entry.t1 == t1 and entry.t2 == t2:
+                    self._entries.move_to_end(entry_id)
+                    return ScWListLookup(query, scw_list=list(entry.scw_list))
+
+                if exact:
+                    continue
+
+                if entry.metadata is not None and entry.t1 <= t1 and entry.t2 >= t2 and \
+                        entry.covers_cone(ra, dec, radius):
+                    self._entries.move_to_end(entry_id)
+                    return ScWListLookup(query, scw_list=entry.select(ra, dec, radius, t1, t2))
+
+                # same cone, overlapping window: only the edges not covered have to be resolved;
+                # unless the entry has metadata, it can only be used if the query window contains it
+                if extendable is None and entry.same_cone(ra, dec, radius) and entry.t1 <= t2 and entry.t2 >= t1 and \
+                        (entry.metadata is not None or (t1 <= entry.t1 and t2 >= entry.t2)):
+                    extendable = entry
+
+        if extendable is None:
+            return ScWListLookup(query, missing=[(t1_iso, t2_iso)])
+
+        missing = []
+        if t1 < extendable.t1:
+            missing.append((t1_iso, extendable.t1_iso))
+        if t2 > extendable.t2:
+            missing.append((extendable.t2_iso, t2_iso))
+
+        return ScWListLookup(query, missing=missing, base=extendable)
+
+    def complete(self, lookup, fetched):
+        """
+        stores the ScW lists fetched for lookup.missing, in the same order, and returns the answer to the query
+        """
+        key, ra, dec, radius, t1_iso, t2_iso = lookup.query
+
+        if lookup.base is None:
+            scw_list = list(fetched[0]) if len(fetched) == 1 else sorted(set(itertools.chain(*fetched)))
+            self._store(key, ra, dec, radius, t1_iso, t2_iso, scw_list, time.monotonic())
+            return scw_list
+
+        base = lookup.base
+        merged = sorted(set(itertools.chain(base.scw_list, *fetched)))
+
+        t1_iso_merged = t1_iso if _mjd(t1_iso) < base.t1 else base.t1_iso
+        t2_iso_merged = t2_iso if _mjd(t2_iso) > base.t2 else base.t2_iso
+
+        logger.info("extended cached ScW list [%s, %s] to [%s, %s], fetched %s",
+                    base.t1_iso, base.t2_iso, t1_iso_merged, t2_iso_merged, lookup.missing)
+
+        # the merged entry is as old as its oldest part
+        self._store(key, ra, dec, radius, t1_iso_merged, t2_iso_merged, merged, base.created_at, replaces=base)
+
+        # the merged window is the query window unless the cached one extends beyond it,
+        # in which case lookup() only chose base if it has metadata; fetched edges are within the query window
+        if base.t1 >= _mjd(t1_iso) and base.t2 <= _mjd(t2_iso):
+            return merged
+
+        return sorted(set(itertools.chain(base.select(ra, dec, radius, _mjd(t1_iso), _mjd(t2_iso)), *fetched)))
+
+    def get(self, fetch, ra, dec, radius, t1_iso, t2_iso, key=(), exact=False):
+        """
+        ScW list for the query, fetch(t1_iso, t2_iso) resolves the windows not in the cache
+        """
+        lookup = self.lookup(ra, dec, radius, t1_iso, t2_iso, key=key, exact=exact)
+
+        if lookup.scw_list is not None:
+            return lookup.scw_list
+
+        return self.complete(lookup, [fetch(t1, t2) for t1, t2 in lookup.missing])
+
+    def is_recent(self, t2_iso):
+        """
+        whether ScWs of a window ending at t2_iso may still be ingested
+        """
+        return _mjd(t2_iso) > Time.now().utc.mjd - self.ingestion_latency_s / 86400.
+
+    def _store(self, key, ra, dec, radius, t1_iso, t2_iso, scw_list, created_at, replaces=None):
+        # no entry reaches into recent windows, so that lookup() always resolves them again, or at least their
+        # recent edge when extending an older entry
+        if self.ttl_s <= 0 or self.is_recent(t2_iso):
+            return None
+
+        metadata = self.metadata(scw_list) if self.metadata is not None else None
+
+        entry = _Entry(key, ra, dec, radius, t1_iso, t2_iso, scw_list, metadata, created_at)
+
+        with self._lock:
+            if replaces is not None:
+                for entry_id, e in list(self._entries.items()):
+                    if e is replaces:
+                        del self._entries[entry_id]
+
+            self._entries[next(self._ids)] = entry
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+scwlist_cache = ScWListCache(
+    ttl_s=_env_float('CDCI_OSA_PLUGIN_SCWLIST_CACHE_TTL_S', 3600.),
+    max_entries=_env_int('CDCI_OSA_PLUGIN_SCWLIST_CACHE_MAX_ENTRIES', 1024),
+    ingestion_latency_s=_env_float('CDCI_OSA_PLUGIN_SCWLIST_INGESTION_LATENCY_S', 30 * 86400.),
+)
@@ -45,6 +45,7 @@ __author__ = "Andrea Tramacere"
 
 from astropy.io import  fits as pf
 import glob
+import shutil
 
 import logging
 
@@ -56,15 +57,208 @@ from cdci_data_analysis.analysis.products import SpectrumProduct,QueryProductLis
 from cdci_data_analysis.analysis.io_helper import FilePath
 
 from .osa_dataserve_dispatcher import  OsaDispatcher, OsaQuery
-from oda_api.data_products import NumpyDataProduct
+from .osa_canonical import canonical_query, canonical_number
+from oda_api.data_products import NumpyDataProduct, NumpyDataUnit
 
 from .osa_common_pars import  DummyOsaRes, split_osa_version
+from .osa_response_cache import response_cache, file_content_hash
+from .osa_fits_stream import rewrite_fits_headers, fits_extnames
+from .osa_compress import compress_product, output_gzip_level, is_gzip
+from .osa_response import get_sparse_response
+from .osa_parallel import ordered_map, file_size
+from .osa_dda_client import _env_int
 
 
 logger = logging.getLogger(__name__)
 
 
-class JemxSpectrumProduct(SpectrumProduct):
+class OsaResponseProduct(SpectrumProduct):
+    """
+    ARF or RMF product of a response file, with its extensions renamed to extnames
+
+    the file is decoded (once for all products with the same content, see osa_response_cache) only if the data
+    are used, otherwise it is written by copying the file with only the headers rewritten, see osa_fits_stream
+
+    shared: product of the same file content, in the same result, whose data units are used
+    """
+
+    def __init__(self, name, file_name, response_file, extnames, content_hash=None, shared=None, prod_prefix=None,
+                 file_dir=None, meta_data={}):
+        self.response_file = response_file
+        self.extnames = extnames
+        self.content_hash = content_hash
+        self.shared = shared
+
+        self._data = None
+        self._url_args = None
+
+        super(OsaResponseProduct, self).__init__(name=name,
+                                                 data=None,
+                                                 file_name=file_name,
+                                                 name_prefix=prod_prefix,
+                                                 file_dir=file_dir,
+                                                 meta_data=meta_data)
+
+    @classmethod
+    def build(cls, name, response_file, responses, extnames, out_file, out_dir, prod_prefix, meta_data,
+              content_hash=None):
+        """
+        product of the response file, sharing the data units and output file of a response with the same content,
+        in responses: {content hash: (output file name, product)}, of the result
+        """
+        if content_hash is None:
+            content_hash = file_content_hash(response_file)
+        meta_data['content_hash'] = content_hash
+
+        if content_hash in responses:
+            out_file, shared = responses[content_hash]
+        else:
+            shared = None
+
+        product = cls(name=name, file_name=out_file, response_file=response_file, extnames=extnames,
+                      content_hash=content_hash, shared=shared, prod_prefix=prod_prefix, file_dir=out_dir,
+                      meta_data=meta_data)
+
+        if shared is None:
+            responses[content_hash] = out_file, product
+
+        return product
+
+    @property
+    def decoded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None and self.response_file is not None:
+            if self.shared is not None:
+                data_units = self.shared.data.data_unit
+            else:
+                data_units = response_cache.get(self.response_file, self.extnames, content_hash=self.content_hash)
+
+            self._data = NumpyDataProduct(data_unit=data_units, meta_data=self.meta_data)
+
+            if self._url_args is not None:
+                # add_url_to_fits_file was called before the data were decoded
+                par_dict, url, kwargs = self._url_args
+                self._url_args = None
+                super(OsaResponseProduct, self).add_url_to_fits_file(par_dict, url=url, **kwargs)
+
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def sparse_response(self):
+        """
+        SparseResponse of the RMF, for folding models, shared by the products of the same file content
+        """
+        return get_sparse_response(self.response_file, self.extnames, content_hash=self.content_hash)
+
+    def add_url_to_fits_file(self, par_dict, url='', **kwargs):
+        if self.decoded:
+            return super(OsaResponseProduct, self).add_url_to_fits_file(par_dict, url=url, **kwargs)
+
+        # to the primary header, when written
+        self._url_args = par_dict, url, kwargs
+
+    def write(self, file_name=None, overwrite=True, file_dir=None):
+        if self.decoded:
+            return super(OsaResponseProduct, self).write(file_name=file_name, overwrite=overwrite, file_dir=file_dir)
+
+        if file_name is None:
+            file_path = self.file_path.path
+        else:
+            file_path = self.file_path.get_file_path(file_name=file_name, file_dir=file_dir)
+
+        primary_header = None
+        if self._url_args is not None:
+            par_dict, url, kwargs = self._url_args
+
+            original_primary_header = dict(pf.getheader(self.response_file, 0))
+            primary = SpectrumProduct(data=NumpyDataProduct(data_unit=[
+                NumpyDataUnit(data=None, data_header=dict(original_primary_header), name='Primary',
+                              hdu_type='primary')]))
+            SpectrumProduct.add_url_to_fits_file(primary, par_dict, url=url, **kwargs)
+
+            # the url cards may leave the primary header as it is
+            if len(primary.data.data_unit) > 1 or dict(primary.data.data_unit[0].header) != original_primary_header:
+                primary_header = primary.data.data_unit[0].header
+
+        compresslevel = output_gzip_level(file_path)
+
+        if compresslevel is not None and primary_header is None and is_gzip(self.response_file) and \
+                not set(fits_extnames(self.response_file)) & set(self.extnames):
+            # nothing to change, already compressed
+            shutil.copyfile(self.response_file, file_path)
+        else:
+            rewrite_fits_headers(self.response_file, file_path, extnames=self.extnames, primary_header=primary_header,
+                                 compresslevel=compresslevel)
+
+
+class OsaSpectrumProduct(SpectrumProduct):
+    # files of the sources read, and products written, in parallel: at most build_max_pending_mb (0: no limit) of
+    # spectra, as on disk, are read at once
+    build_workers = _env_int('CDCI_OSA_PLUGIN_SPECTRUM_BUILD_WORKERS', 1)
+    build_max_pending_mb = _env_int('CDCI_OSA_PLUGIN_SPECTRUM_BUILD_MAX_PENDING_MB', 1024)
+
+    @classmethod
+    def map_files(cls, fn, items, item_file=lambda item: item):
+        """
+        fn for each item, in order, with build_workers threads; item_file gives the file read for the item
+        """
+        return ordered_map(fn, items, max_workers=cls.build_workers,
+                           max_pending_bytes=cls.build_max_pending_mb * 1024 * 1024,
+                           item_bytes=lambda item: file_size(item_file(item)))
+
+    @classmethod
+    def hash_files(cls, filenames):
+        """
+        {file name: content hash} of the (response) files
+        """
+        filenames = list(dict.fromkeys(filenames))
+        return dict(zip(filenames, cls.map_files(file_content_hash, filenames)))
+
+    @classmethod
+    def build_spectrum(cls, name, source_name, spec_filename, out_spec_file, out_dir, prod_prefix, arf, rmf):
+        meta_data = {}
+        meta_data['src_name'] = source_name
+        meta_data['product'] = name
+
+        try:
+            np_spec = NumpyDataProduct.from_fits_file(spec_filename, meta_data=meta_data)
+        except OSError as e:
+            logger.error("unable to open %s : %s", spec_filename, e)
+            raise
+
+        np_spec.data_unit[1].header['ANCRFILE'] = 'NONE'
+        np_spec.data_unit[1].header['RESPFILE'] = 'NONE'
+
+        return cls(name=name, data=np_spec, file_name=out_spec_file, file_dir=out_dir, prod_prefix=prod_prefix,
+                   meta_data=meta_data, rmf_file=rmf.file_path.name, arf_file=arf.file_path.name)
+
+    @classmethod
+    def build_spectra(cls, name, sources, out_dir, prod_prefix):
+        """
+        [spectrum, arf, rmf] of the sources, [(source name, spectrum file, output file name, arf, rmf)], in order,
+        the spectra read in parallel
+        """
+        spectra = cls.map_files(lambda source: cls.build_spectrum(name, source[0], source[1], source[2], out_dir,
+                                                                  prod_prefix, source[3], source[4]),
+                                sources,
+                                item_file=lambda source: source[1])
+
+        spec_list = []
+        for spec, (source_name, spec_filename, out_spec_file, arf, rmf) in zip(spectra, sources):
+            spec_list.append(spec)
+            spec_list.append(arf)
+            spec_list.append(rmf)
+
+        return spec_list
+
+
+class JemxSpectrumProduct(OsaSpectrumProduct):
     def __init__(self,name,file_name,data,prod_prefix=None,file_dir=None,meta_data={},rmf_file=None,arf_file=None):
 
         super(JemxSpectrumProduct, self).__init__(name=name,
@@ -90,7 +284,11 @@ class JemxSpectrumProduct(SpectrumProduct):
         #with open('res.pkl','rb') as f:
         #    pickle.dump(res,f)
 
-        spec_list = []
+        sources = []
+
+        # content hash of the response files of this result -> (output file name, product)
+        responses = {}
+        content_hashes = cls.hash_files([getattr(res, attr) for attr in arf_list_attr + rmf_list_attr])
 
         if out_dir is None:
             out_dir = './'
@@ -127,71 +325,25 @@ class JemxSpectrumProduct(SpectrumProduct):
             meta_data = {}
             meta_data['src_name'] = source_name
             meta_data['product'] = 'jemx_arf'
-            np_arf = NumpyDataProduct.from_fits_file(arf_filename, meta_data=meta_data)
-            
-            r = np_arf.get_data_unit_by_name('JMX%d-AXIS-ARF'%jemx_num)
-            if r is None:
-                r = np_arf.get_data_unit_by_name('SPECRESP')
-            else:
-                r.name='SPECRESP'            
-
-            arf = cls(name=name, data=np_arf, file_name=out_arf_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                       meta_data=meta_data)
-
+            arf = OsaResponseProduct.build(name, arf_filename, responses, {'JMX%d-AXIS-ARF' % jemx_num: 'SPECRESP'},
+                                           out_arf_file, out_dir, prod_prefix, meta_data,
+                                           content_hash=content_hashes[arf_filename])
 
             name = 'jemx_rmf'
             meta_data = {}
             meta_data['src_name'] = source_name
             meta_data['product'] = 'jemx_rmf'
-            meta_data['product'] = 'jemx_rmf'
-            np_rmf = NumpyDataProduct.from_fits_file(rmf_filename, meta_data=meta_data)
+            rmf = OsaResponseProduct.build(name, rmf_filename, responses,
+                                           {'JMX%d-RMF.-RSP' % jemx_num: 'SPECRESP MATRIX',
+                                            'JMX%d-FBDS-MOD' % jemx_num: 'EBOUNDS'},
+                                           out_rmf_file, out_dir, prod_prefix, meta_data,
+                                           content_hash=content_hashes[rmf_filename])
 
+            sources.append((source_name, spec_filename, out_spec_file, arf, rmf))
 
-            r = np_rmf.get_data_unit_by_name('JMX%d-RMF.-RSP'%jemx_num)
-            if r is None:
-                r = np_arf.get_data_unit_by_name('SPECRESP MATRIX')
-            else:
-                r.name='SPECRESP MATRIX'
-            
-            r = np_rmf.get_data_unit_by_name('JMX%d-FBDS-MOD'%jemx_num)
-            if r is None:
-                r = np_arf.get_data_unit_by_name('EBOUNDS')
-            else:
-                r.name='EBOUNDS'            
-
-            rmf = cls(name=name, data=np_rmf, file_name=out_rmf_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                      meta_data=meta_data)
+        return cls.build_spectra('jemx_spectrum', sources, out_dir, prod_prefix)
 
-            name = 'jemx_spectrum'
-            meta_data = {}
-            meta_data['src_name'] = source_name
-            meta_data['product'] = 'jemx_spectrum'
-
-            try:
-                np_spec = NumpyDataProduct.from_fits_file(spec_filename, meta_data=meta_data)
-            except OSError as e:
-                logger.error("unable to open %s : %s", spec_filename, e)
-                raise
-
-            np_spec.data_unit[1].header['ANCRFILE'] = 'NONE'
-            np_spec.data_unit[1].header['RESPFILE'] = 'NONE'
-
-            spec = cls(name=name, data=np_spec, file_name=out_spec_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                       meta_data=meta_data,rmf_file=rmf.file_path.name,arf_file=arf.file_path.name)
-
-
-            #print('spec out file-->', out_spec_file)
-            #print('arf  out file-->', out_arf_file)
-            #print('rmf  out file-->', out_rmf_file)
-
-
-            spec_list.append(spec)
-            spec_list.append(arf)
-            spec_list.append(rmf)
-
-        return spec_list
-
-class IsgriSpectrumProduct(SpectrumProduct):
+class IsgriSpectrumProduct(OsaSpectrumProduct):
 
     def __init__(self,name,file_name,data,prod_prefix=None,file_dir=None,meta_data={},rmf_file=None,arf_file=None):
 
@@ -212,7 +364,12 @@ class IsgriSpectrumProduct(SpectrumProduct):
 
 
 
-        spec_list=[]
+        sources = []
+
+        # content hash of the response files of this result -> (output file name, product)
+        responses = {}
+        content_hashes = cls.hash_files([getattr(res, attr) for _, _, rmf_attr, arf_attr in res.extracted_sources
+                                         for attr in (arf_attr, rmf_attr)])
 
         if out_dir is None:
             out_dir='./'
@@ -239,52 +396,22 @@ class IsgriSpectrumProduct(SpectrumProduct):
             meta_data = {}
             meta_data['src_name'] = source_name
             meta_data['product'] = 'isgri_arf'
-            np_arf = NumpyDataProduct.from_fits_file(arf_filename, meta_data=meta_data)
-
-            np_arf.get_data_unit_by_name('ISGR-ARF.-RSP').name='SPECRESP'
-
-            arf = cls(name=name, data=np_arf, file_name=out_arf_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                       meta_data=meta_data)
-
-
+            arf = OsaResponseProduct.build(name, arf_filename, responses, {'ISGR-ARF.-RSP': 'SPECRESP'},
+                                           out_arf_file, out_dir, prod_prefix, meta_data,
+                                           content_hash=content_hashes[arf_filename])
 
             name = 'isgri_rmf'
             meta_data = {}
             meta_data['src_name'] = source_name
             meta_data['product'] = 'isgri_rmf'
-            meta_data['product'] = 'isgri_rmf'
-            np_rmf = NumpyDataProduct.from_fits_file(rmf_filename, meta_data=meta_data)
+            rmf = OsaResponseProduct.build(name, rmf_filename, responses,
+                                           {'ISGR-RMF.-RSP': 'SPECRESP MATRIX', 'ISGR-EBDS-MOD': 'EBOUNDS'},
+                                           out_rmf_file, out_dir, prod_prefix, meta_data,
+                                           content_hash=content_hashes[rmf_filename])
 
-            np_rmf.get_data_unit_by_name('ISGR-RMF.-RSP').name= 'SPECRESP MATRIX'
+            sources.append((source_name, spec_filename, out_spec_file, arf, rmf))
 
-            np_rmf.get_data_unit_by_name('ISGR-EBDS-MOD').name='EBOUNDS'
-
-            rmf = cls(name=name, data=np_rmf, file_name=out_rmf_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                      meta_data=meta_data)
-
-            name = 'isgri_spectrum'
-            meta_data = {}
-            meta_data['src_name'] = source_name
-            meta_data['product'] = 'isgri_spectrum'
-
-            np_spec = NumpyDataProduct.from_fits_file(spec_filename, meta_data=meta_data)
-            np_spec.data_unit[1].header['ANCRFILE'] = 'NONE'
-            np_spec.data_unit[1].header['RESPFILE'] = 'NONE'
-
-            spec = cls(name=name, data=np_spec, file_name=out_spec_file, file_dir=out_dir, prod_prefix=prod_prefix,
-                       meta_data=meta_data,rmf_file=rmf.file_path.name,arf_file=arf.file_path.name)
-
-
-            #print('spec out file-->', out_spec_file)
-            #print('arf  out file-->', out_arf_file)
-            #print('rmf  out file-->', out_rmf_file)
-
-
-            spec_list.append(spec)
-            spec_list.append(arf)
-            spec_list.append(rmf)
-
-        return spec_list
+        return cls.build_spectra('isgri_spectrum', sources, out_dir, prod_prefix)
 
 
 
@@ -297,6 +424,13 @@ class OsaSpectrumQuery(SpectrumQuery, OsaQuery):
     def get_data_server_query(self, instrument,
                               config=None):
 
+        target, modules, assume, inject = canonical_query(self.build_data_server_query, instrument)
+
+        q=OsaDispatcher(config=config, target=target, modules=modules, assume=assume, inject=inject,instrument=instrument)
+
+        return q
+
+    def build_data_server_query(self, instrument):
 
         scwlist_assumption, cat, extramodules, inject=OsaDispatcher.get_osa_query_base(instrument)
         E1=instrument.get_par_by_name('E1_keV').value
@@ -308,9 +442,8 @@ class OsaSpectrumQuery(SpectrumQuery, OsaQuery):
             target, modules, assume=self.set_instr_dictionaries(extramodules,scwlist_assumption,E1,E2,osa_version,jemx_num=jemx_num)
         else:
             target, modules, assume = self.set_instr_dictionaries(extramodules, scwlist_assumption, E1, E2, osa_version)
-        q=OsaDispatcher(config=config, target=target, modules=modules, assume=assume, inject=inject,instrument=instrument)
 
-        return q
+        return target, modules, assume, inject
 
 
     def set_instr_dictionaries(self,catalog,):
@@ -325,15 +458,25 @@ class OsaSpectrumQuery(SpectrumQuery, OsaQuery):
         _arf_path = []
         _rmf_path = []
 
+        # responses shared between sources are written once
+        to_write = {}
+        for query_spec in prod_list.prod_list:
+            if query_spec is not None:
+                to_write.setdefault(query_spec.file_path.path, query_spec)
+
+        def write(query_spec):
+            query_spec.add_url_to_fits_file(instrument._current_par_dic, url=instrument.disp_conf.products_url)
+            query_spec.write()
+            compress_product(query_spec)
+
+        ordered_map(write, to_write.values(), max_workers=OsaSpectrumProduct.build_workers)
+
         query_out = QueryOutput()
         for query_spec in prod_list.prod_list:
             #print('jemx',query_spec)
             if query_spec is not None:
                 #print('jemx', query_spec.name)
 
-                query_spec.add_url_to_fits_file(instrument._current_par_dic, url=instrument.disp_conf.products_url)
-                query_spec.write()
-
                 if query_spec.name=='isgri_spectrum' or  query_spec.name=='jemx_spectrum':
                     _names.append(query_spec.meta_data['src_name'])
                     _sepc_path.append(str(query_spec.file_path.name))
@@ -396,7 +539,7 @@ class IsgriSpectrumQuery(OsaSpectrumQuery):
         
         assume = ['process_isgri_spectra.ScWSpectraList(input_scwlist=%s)'% scwlist_assumption[0],
                    scwlist_assumption[1],
-                  'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=E1,E2=E2),
+                  'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=canonical_number(E1),E2=canonical_number(E2)),
                   'process_isgri_spectra.ISGRISpectraSum(use_extract_all=True)',
                   'ddosa.ImagingConfig(use_SouFit=0,use_DoPart2=1,use_version="soufit0_p2")',
                   'ddosa.CatForSpectraFromImaging(use_minsig=3)',
@@ -492,7 +635,7 @@ class JemxSpectrumQuery(OsaSpectrumQuery):
 
         assume = ['ddjemx.JMXSpectraGroups(input_scwlist=%s)'% scwlist_assumption[0],
                    scwlist_assumption[1],
-                  'ddjemx.JEnergyBins(use_bins=[(%(E1)s,%(E2)s)])' % dict(E1=E1, E2=E2),
+                  'ddjemx.JEnergyBins(use_bins=[(%(E1)s,%(E2)s)])' % dict(E1=canonical_number(E1), E2=canonical_number(E2)),
                   'ddjemx.JEMX(use_num=%d)'%jemx_num,
                   'ddjemx.JEnergyBins(use_nchanpow=-4)']
 
@@ -1,3 +1,5 @@
+import pytest
+
 
 def test_osa_versions():
     from cdci_osa_plugin.osa_image_query import IsgriMosaicQuery
@@ -91,3 +93,1660 @@ def test_osa_versions():
                          'ddosa.ICRoot(use_ic_root_version="dev")'
                          ]
                     )
+
+
+def test_dda_client_pool_reuses_connections(tmp_path, monkeypatch):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from cdci_osa_plugin.osa_dda_client import DDAClientPool, PooledRemoteDDA
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        pool = DDAClientPool(pool_maxsize=2, max_sessions=1)
+
+        session = pool.get_session(url, "reduced/ddcache")
+        assert pool.get_session(url, "reduced/ddcache") is session
+
+        for _ in range(5):
+            assert session.get(url + "/api/v1.0/poke").text == "ok"
+
+        stats = pool.stats()
+        assert stats['total']['connections_opened'] == 1
+        assert stats['total']['connections_reused'] == 4
+        assert stats['limits']['pool_maxsize'] == 2
+
+        # least recently used session is dropped beyond max_sessions
+        pool.get_session(url, "other/ddcache")
+        assert list(pool.stats()['pools']) == [(url, "other/ddcache")]
+
+        # a session dropped while a request runs through it is closed only once released
+        closed = []
+        session = pool.get_session(url, "busy/ddcache")
+        session.close = lambda: closed.append(session)
+        with pool.session_in_use(session):
+            pool.get_session(url, "next/ddcache")
+            assert closed == []
+        assert closed == [session]
+
+        # ddaclient requests go through the session of the client, ddaclient itself is left as is
+        import requests
+        import ddaclient
+        assert ddaclient.requests is requests
+
+        monkeypatch.setenv("DDA_TOKEN", "secret")
+        session = pool.get_session(url, "next/ddcache")
+        remote = PooledRemoteDDA("public=" + url, str(tmp_path), pool_session=session, client_pool=pool)
+        requests_sent = pool.stats()['total']['requests']
+        remote.poke()
+        assert pool.stats()['total']['requests'] == requests_sent + 1
+
+        remote.download_ddcache_file("cached/path", "file", str(tmp_path / "downloaded" / "file"))
+        assert (tmp_path / "downloaded" / "file").read_bytes() == b"ok"
+        assert pool.stats()['total']['requests'] == requests_sent + 2
+
+        # the code of ddaclient is run as it is, with the session for its requests module: it has to send with it
+        for method, send in [(ddaclient.RemoteDDA._query, 'post'), (ddaclient.RemoteDDA.download_ddcache_file, 'get')]:
+            assert {'requests', send} <= set(method.__code__.co_names)
+    finally:
+        server.shutdown()
+
+
+def test_dda_health_monitor_state():
+    from cdci_osa_plugin.osa_dda_client import DDAHealthMonitor
+
+    class Remote:
+        def __init__(self, pool):
+            self.pool = pool
+
+        def poke(self):
+            self.pool.pokes += 1
+            if self.pool.fail:
+                raise RuntimeError("backend down")
+
+    class Pool:
+        pokes = 0
+        fail = False
+
+        def get_client(self, *args):
+            return Remote(self)
+
+    pool = Pool()
+    monitor = DDAHealthMonitor(pool, stale_after_s=60, background=False)
+    monitor.watch("http://dda", "reduced/ddcache", "logs")
+
+    assert monitor.get_fresh_state("http://dda") is None
+
+    state = monitor.poke("http://dda")
+    assert state.ok and not state.busy and state.status == 'OK'
+    assert monitor.get_fresh_state("http://dda") is state
+
+    pool.fail = True
+    state = monitor.poke("http://dda")
+    assert not state.ok and state.down and not state.busy
+    assert isinstance(state.exception, RuntimeError)
+    assert pool.pokes == 2
+
+    monitor.stale_after_s = 0
+    assert monitor.get_fresh_state("http://dda") is None
+    assert monitor.get_state("http://dda") is state
+
+
+def test_communication_reports_busy_and_down():
+    import json
+    import ddaclient as dc
+    from cdci_data_analysis.analysis.queries import QueryOutput
+    from cdci_osa_plugin.osa_dda_client import DDAHealthState
+    from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher, DDAException
+
+    busy = dc.WorkerException("busy", content=json.dumps({'result': {'status': 'busy'}}))
+    busy_state = DDAHealthState("http://dda", False, 'busy', 0.1, exception=busy)
+    down_state = DDAHealthState("http://dda", False, '', 0.1, exception=ConnectionError("refused"))
+
+    assert busy_state.busy and not busy_state.down
+    assert down_state.down and not down_state.busy
+
+    disp = OsaDispatcher.__new__(OsaDispatcher)
+
+    messages = {}
+    for name, state in [('busy', busy_state), ('down', down_state)]:
+        query_out = QueryOutput()
+        with pytest.raises(DDAException) as e:
+            disp.set_communication_failed(query_out, state)
+        messages[name] = (e.value.message, query_out.status_dictionary['error_message'])
+
+    assert messages['busy'][0] == 'data server busy'
+    assert messages['down'][0] == 'Connection Error'
+    assert messages['busy'][1] != messages['down'][1]
+
+
+def test_dda_outcome_of_refused_requests_is_neutral():
+    import ddaclient as dc
+    from cdci_osa_plugin.osa_dda_client import dda_circuit_breaker
+    from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher
+
+    disp = OsaDispatcher.__new__(OsaDispatcher)
+    disp.data_server_url = "http://dda-refusing"
+
+    for _ in range(3 * dda_circuit_breaker.failure_threshold):
+        disp.record_dda_outcome(dc.NotAuthorizedOnDDA("no token"))
+        disp.record_dda_outcome(dc.PermanentAnalysisException("no such target"))
+        disp.record_dda_outcome(ValueError("local error"))
+        disp.record_dda_outcome(dc.UnknownDDABackendProblem("got unexpected response status 404, raw response"))
+
+    assert not dda_circuit_breaker.is_open(disp.data_server_url)
+    assert dda_circuit_breaker.allow_request(disp.data_server_url)
+
+    for _ in range(dda_circuit_breaker.failure_threshold):
+        disp.record_dda_outcome(dc.UnknownDDABackendProblem("got unexpected response status 503, raw response"))
+
+    assert dda_circuit_breaker.is_open(disp.data_server_url)
+
+
+def test_dda_circuit_breaker():
+    import random
+    import time
+    from cdci_osa_plugin.osa_dda_client import DDACircuitBreaker
+
+    breaker = DDACircuitBreaker(failure_threshold=3, base_backoff_s=0.05, max_backoff_s=0.2, jitter=0.5,
+                                rng=random.Random(1))
+    url = "http://dda"
+
+    # exponential, capped, jittered down by at most half
+    for attempt, nominal in [(1, 0.05), (2, 0.1), (3, 0.2), (10, 0.2)]:
+        assert nominal * 0.5 <= breaker.backoff_s(attempt) <= nominal
+
+    for _ in range(2):
+        assert breaker.allow_request(url)
+        breaker.record_failure(url)
+    assert breaker.get_state(url) == breaker.CLOSED
+
+    breaker.record_failure(url)
+    assert breaker.get_state(url) == breaker.OPEN
+    assert breaker.is_open(url)
+    assert not breaker.allow_request(url)
+    assert 0 < breaker.retry_after_s(url) <= 0.05
+
+    time.sleep(0.06)
+    assert not breaker.is_open(url)
+    # a single probe in half-open state
+    assert breaker.allow_request(url)
+    assert breaker.get_state(url) == breaker.HALF_OPEN
+    assert not breaker.allow_request(url)
+
+    # failed probe opens again, with a longer backoff
+    breaker.record_failure(url)
+    assert breaker.get_state(url) == breaker.OPEN
+    assert 0.05 < breaker.retry_after_s(url) <= 0.1
+
+    time.sleep(0.11)
+    assert breaker.allow_request(url)
+
+    # a probe with an outcome telling nothing about the backend frees the probe slot
+    breaker.record_neutral(url)
+    assert breaker.get_state(url) == breaker.HALF_OPEN
+    assert breaker.allow_request(url)
+    assert not breaker.allow_request(url)
+
+    breaker.record_success(url)
+    assert breaker.get_state(url) == breaker.CLOSED
+    assert breaker.allow_request(url) and breaker.allow_request(url)
+
+
+def test_async_dispatcher_maps_answers_like_sync():
+    import asyncio
+    import json
+    import threading
+    import logging
+    import pytest
+    import requests
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    pytest.importorskip("aiohttp")
+
+    from cdci_osa_plugin.osa_async_dispatcher import AsyncOsaDispatcher, close_http_session
+    from cdci_osa_plugin.osa_dataserve_dispatcher import DDAUnknownException
+
+    submissions = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            submissions.append(self.path)
+            if self.path.endswith("/broken"):
+                code, body = 500, b"broken"
+            elif self.path.endswith("/poke"):
+                code, body = 200, b"{}"
+            else:
+                code, body = 200, json.dumps(dict(data=None, cached_path=[], result={},
+                                                  exceptions=dict(exception_type="delegation",
+                                                                  delegation_state="submitted"))).encode()
+            self.send_response(code)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # configured by hand, __init__ needs an instrument
+    disp = AsyncOsaDispatcher.__new__(AsyncOsaDispatcher)
+    disp.data_server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    disp.data_server_cache = "reduced/ddcache"
+    disp.logdir = "logs"
+    disp.target, disp.modules, disp.assume, disp.inject = "mosaic", [], [], []
+    disp.n_retries = 1
+
+    class Remote:
+        ddcache_root_local = "reduced/ddcache"
+
+        class secret:
+            _auth_source = "test"
+
+            @staticmethod
+            def get_auth():
+                return requests.auth.HTTPBasicAuth("remoteintegral", "")
+
+        def prepare_request(self, target, modules, assume, inject, prompt_delegate, callback):
+            return dict(url=disp.data_server_url + "/api/v2.0/" + target, params=dict(modules=",".join(modules)))
+
+    disp.get_remote_dda = Remote
+
+    async def run():
+        try:
+            query_out = await disp.test_communication(max_trial=1)
+            assert query_out.get_status() == 0
+
+            answers = await asyncio.gather(*[disp.run_query("http://callback", logger=logging.getLogger())
+                                             for _ in range(20)])
+            assert {query_out.status_dictionary['job_status'] for _, query_out in answers} == {'submitted'}
+            # identical queries in flight are sent once
+            assert len([path for path in submissions if path.endswith("/mosaic")]) == 1
+
+            with pytest.raises(DDAUnknownException):
+                await disp.run_query("http://callback", logger=logging.getLogger(), target="broken")
+        finally:
+            await close_http_session()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+
+
+def test_dda_single_flight():
+    import asyncio
+    import threading
+    import time
+    import pytest
+    from concurrent.futures import ThreadPoolExecutor
+    from cdci_osa_plugin.osa_dda_client import DDASingleFlight
+
+    flight = DDASingleFlight()
+
+    key = flight.key("mosaic_ii_skyimage", ["git://ddosa"], ["a", "b"], [])
+    assert key == flight.key("mosaic_ii_skyimage", ("git://ddosa",), ("a", "b"), [])
+    assert key != flight.key("mosaic_ii_skyimage", ["git://ddosa"], ["b", "a"], [])
+    assert key != flight.key("mosaic_ii_skyimage", ["git://ddosa"], ["a", "b"], [], prompt_delegate=False)
+
+    calls = []
+    started = threading.Event()
+
+    def query(result):
+        calls.append(result)
+        started.set()
+        time.sleep(0.2)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    with ThreadPoolExecutor(8) as pool:
+        leader = pool.submit(flight.do, key, lambda: query("product"))
+        started.wait()
+        followers = [pool.submit(flight.do, key, lambda: query("other")) for _ in range(7)]
+        assert {f.result() for f in [leader] + followers} == {"product"}
+    assert calls == ["product"]
+
+    # exceptions, e.g. delegation, are shared too
+    started.clear()
+    e = RuntimeError("delegated")
+    with ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(flight.do, key, lambda: query(e))
+        started.wait()
+        followers = [pool.submit(flight.do, key, lambda: query("other")) for _ in range(3)]
+        for f in [leader] + followers:
+            with pytest.raises(RuntimeError):
+                f.result()
+    assert calls == ["product", e]
+
+    async def run():
+        async def query_async():
+            calls.append("async")
+            await asyncio.sleep(0.05)
+            return "async product"
+        return await asyncio.gather(*[flight.do_async(key, query_async) for _ in range(10)])
+
+    assert asyncio.run(run()) == ["async product"] * 10
+    assert calls == ["product", e, "async"]
+    assert flight.stats()['in_flight'] == 0
+
+    # a cancelled leader leaves the query running for the followers, which is cancelled once nobody waits
+    async def run_cancelled():
+        cancelled = []
+
+        async def query_async():
+            calls.append("async")
+            try:
+                await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return "async product"
+
+        leader = asyncio.ensure_future(flight.do_async(key, query_async))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.ensure_future(flight.do_async(key, query_async)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+
+        assert await asyncio.gather(*followers) == ["async product"] * 3
+        assert leader.cancelled() and cancelled == []
+
+        alone = asyncio.ensure_future(flight.do_async(key, query_async))
+        await asyncio.sleep(0.01)
+        alone.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [True]
+
+    asyncio.run(run_cancelled())
+    assert calls == ["product", e, "async", "async", "async"]
+    assert flight.stats()['in_flight'] == 0
+
+    # the same query to another data server is another flight
+    assert key != flight.key("mosaic_ii_skyimage", ["git://ddosa"], ["a", "b"], [],
+                             data_server_url="http://other", data_server_cache="reduced/ddcache")
+
+
+def test_canonical_assumptions(monkeypatch):
+    from cdci_osa_plugin import osa_canonical
+    from cdci_osa_plugin.osa_canonical import (canonical_query, canonical_number, canonical_whitespace,
+                                               canonical_scw_list, CanonicalizationReport)
+    from cdci_osa_plugin.osa_image_query import IsgriMosaicQuery
+
+    monkeypatch.setattr(osa_canonical, "canonical_mode", "yes")
+
+    assert canonical_number(20) == canonical_number(20.) == canonical_number("20.0") == "20.0"
+    assert canonical_number(20.000000000000004) == "20.0"
+    assert canonical_number(-0.) == "0.0"
+    assert canonical_number(83.63308) == "83.63308"
+    assert canonical_number("OSA11.2") == "OSA11.2"
+
+    assert canonical_whitespace('ddjemx.JEnergyBinsLC (use_bins=[(20.0, 40.0)], use_version = "a  b")') == \
+        'ddjemx.JEnergyBinsLC(use_bins=[(20.0,40.0)],use_version="a  b")'
+    assert canonical_whitespace('f(x=lambda  y: y)') == 'f(x=lambda y:y)'
+
+    assert canonical_scw_list([" 066500230010.001", "066500220010.001", "066500230010.001"]) == \
+        ["066500220010.001", "066500230010.001"]
+
+    def query(E1, E2):
+        return IsgriMosaicQuery("name").set_instr_dictionaries(extramodules=[], scwlist_assumption=["sa", "sb  "],
+                                                               E1=E1, E2=E2, osa_version="OSA11.2") + ([],)
+
+    assert canonical_query(query, 20, 40) == canonical_query(query, 20., 40.000000000001)
+    assert 'use_version="onebin_20.0_40.0"' in canonical_query(query, 20, 40)[2][2]
+
+    # report mode: raw queries are sent, collapsing ones are reported
+    report = CanonicalizationReport()
+    monkeypatch.setattr(osa_canonical, "canonical_mode", "report")
+    monkeypatch.setattr(osa_canonical, "canonicalization_report", report)
+
+    # not sampled: built once, raw
+    monkeypatch.setattr(osa_canonical, "canonical_report_fraction", 0.)
+    built = []
+    assert canonical_query(lambda: built.append(1) or query(20, 40)) == canonical_query(query, 20, 40)
+    assert len(built) == 1 and report.collisions() == {}
+
+    monkeypatch.setattr(osa_canonical, "canonical_report_fraction", 1.)
+    assert 'use_version="onebin_20_40"' in canonical_query(query, 20, 40)[2][2]
+    canonical_query(query, 20., 40.)
+    canonical_query(query, 20., 40.)
+    canonical_query(query, 30., 40.)
+
+    collisions = report.collisions()
+    assert len(collisions) == 1
+    assert sorted(list(collisions.values())[0].values()) == [1, 2]
+
+
+def test_canonical_assumptions_default_to_baseline():
+    import os
+    from cdci_osa_plugin import osa_canonical
+    from cdci_osa_plugin.osa_canonical import canonical_query
+    from cdci_osa_plugin.osa_image_query import IsgriMosaicQuery
+    from cdci_osa_plugin.osa_spectrum_query import IsgriSpectrumQuery
+    from cdci_osa_plugin.osa_lightcurve_query import IsgriLightCurveQuery
+
+    assert osa_canonical.canonical_mode == os.environ.get('CDCI_OSA_PLUGIN_CANONICAL_ASSUME', 'report')
+
+    E1, E2 = 20.000000000000004, 40.5
+    scwlist_assumption = ["sa", "sb  "]
+
+    def build(query_class, *args):
+        def query():
+            return query_class("name").set_instr_dictionaries([], scwlist_assumption, E1, E2, *args) + ([],)
+        return canonical_query(query)[2]
+
+    # as formatted before canonical assumptions
+    image_bins = 'ddosa.ImageBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=E1, E2=E2)
+    assert image_bins == 'ddosa.ImageBins(use_ebins=[(20.000000000000004,40.5)],' \
+                         'use_version="onebin_20.000000000000004_40.5")'
+
+    assert build(IsgriMosaicQuery, "OSA11.2") == [
+        'ddosa.ImageGroups(input_scwlist=sa)',
+        'sb  ',
+        image_bins,
+        'ddosa.ImagingConfig(use_SouFit=0,use_version="soufit0")',
+    ]
+
+    assert build(IsgriSpectrumQuery, "OSA11.2")[:3] == [
+        'process_isgri_spectra.ScWSpectraList(input_scwlist=sa)',
+        'sb  ',
+        image_bins,
+    ]
+
+    assert build(IsgriLightCurveQuery, "src", 100., "OSA11.2") == [
+        'process_isgri_lc.ScWLCList(input_scwlist=sa)',
+        'sb  ',
+        image_bins,
+        'ddosa.LCEnergyBins(use_ebins=[(%(E1)s,%(E2)s)],use_version="onebin_%(E1)s_%(E2)s")' % dict(E1=E1, E2=E2),
+        'ddosa.ImagingConfig(use_SouFit=0,use_version="soufit0_p2",use_DoPart2=1)',
+        'ddosa.CatForLC(use_minsig=3)',
+        'ddosa.LCTimeBin(use_time_bin_seconds=100.000000)',
+    ]
+
+
+def test_scw_pointing_index(tmp_path):
+    import numpy as np
+    from cdci_osa_plugin.osa_scw_index import ScWPointingIndex, get_scw_pointing_index
+
+    rng = np.random.RandomState(0)
+    n = 20000
+
+    tstart = np.sort(rng.uniform(52650, 60000, n))
+    tstop = tstart + rng.uniform(0.01, 0.05, n)
+    ra = rng.uniform(0, 360, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    scw_id = ["%08d0010.001" % i for i in range(n)]
+
+    ScWPointingIndex.from_arrays(scw_id, tstart, tstop, ra, dec).save(tmp_path / "scw_index.npy")
+    index = get_scw_pointing_index(str(tmp_path / "scw_index.npy"))
+
+    assert len(index) == n and index.table['scw_id'][0].decode() == scw_id[0]
+    assert get_scw_pointing_index(str(tmp_path / "scw_index.npy")) is index
+    assert get_scw_pointing_index(str(tmp_path / "missing.npy")) is None
+
+    def brute_force(q_ra, q_dec, radius, t1, t2):
+        cos_sep = np.sin(np.radians(dec)) * np.sin(np.radians(q_dec)) + \
+                  np.cos(np.radians(dec)) * np.cos(np.radians(q_dec)) * np.cos(np.radians(ra - q_ra))
+        m = (cos_sep >= np.cos(np.radians(radius))) & (tstart < t2) & (tstop > t1)
+        return [scw_id[i] for i in np.where(m)[0]]
+
+    # RA wrap, poles, wide and narrow cones and time windows
+    for q_ra, q_dec, radius, t1, t2 in [(83.6, 22.0, 15., 52650, 60000),
+                                         (359.5, 10., 10., 53000, 58000),
+                                         (0.5, -89., 5., 52650, 60000),
+                                         (120., 89.5, 3., 52650, 60000),
+                                         (266.4, -28.9, 30., 55000, 55100),
+                                         (10., 0., 0.5, 52650, 60000),
+                                         (200., 45., 180., 56000.01, 56000.02)]:
+        assert index.query(q_ra, q_dec, radius, t1, t2) == brute_force(q_ra, q_dec, radius, t1, t2)
+
+
+def test_scwlist_cache():
+    import numpy as np
+    from astropy.time import Time
+    from cdci_osa_plugin.osa_scw_index import ScWPointingIndex
+    from cdci_osa_plugin.osa_scwlist_cache import ScWListCache
+
+    rng = np.random.RandomState(1)
+    n = 5000
+    tstart = np.sort(rng.uniform(53000, 53100, n))
+    index = ScWPointingIndex.from_arrays(["%08d0010.001" % i for i in range(n)], tstart, tstart + 0.02,
+                                         rng.uniform(70, 100, n), rng.uniform(10, 30, n))
+
+    def iso(mjd):
+        return Time(mjd, format='mjd', scale='utc').isot
+
+    fetched = []
+
+    def fetch(t1, t2, radius=10.):
+        fetched.append((t1, t2))
+        return index.query(83.6, 22., radius, Time(t1).mjd, Time(t2).mjd)
+
+    def truth(t1, t2, radius=10.):
+        return index.query(83.6, 22., radius, t1, t2)
+
+    # without pointing metadata: repeats, and windows containing a cached one
+    cache = ScWListCache(metadata=None)
+    assert cache.get(fetch, 83.6, 22., 10., iso(53020), iso(53040)) == truth(53020, 53040)
+    assert cache.get(fetch, 83.6, 22., 10., iso(53020), iso(53040)) == truth(53020, 53040)
+    assert len(fetched) == 1
+
+    assert cache.get(fetch, 83.6, 22., 10., iso(53010), iso(53050)) == truth(53010, 53050)
+    assert fetched[1:] == [(iso(53010), iso(53020)), (iso(53040), iso(53050))]
+
+    # narrower: can not be answered without metadata
+    assert cache.get(fetch, 83.6, 22., 10., iso(53015), iso(53030)) == truth(53015, 53030)
+    assert len(fetched) == 4
+
+    # with pointing metadata: narrower in time and radius locally, partial overlaps fetch the missing edge only
+    fetched.clear()
+    cache = ScWListCache(metadata=index.lookup)
+    cache.get(fetch, 83.6, 22., 10., iso(53020), iso(53040))
+    assert cache.get(fetch, 83.6, 22., 10., iso(53025), iso(53030)) == truth(53025, 53030)
+    assert cache.get(fetch, 84., 21., 5., iso(53025), iso(53030)) == index.query(84., 21., 5., 53025, 53030)
+    assert len(fetched) == 1
+
+    assert cache.get(fetch, 83.6, 22., 10., iso(53030), iso(53060)) == truth(53030, 53060)
+    assert fetched[1:] == [(iso(53040), iso(53060))]
+
+    # exact only, and expiry
+    assert cache.lookup(83.6, 22., 10., iso(53025), iso(53030), exact=True).scw_list is None
+    cache.ttl_s = 0
+    assert cache.lookup(83.6, 22., 10., iso(53020), iso(53060)).missing == [(iso(53020), iso(53060))]
+
+    # windows ending within the ingestion latency are resolved again every time, also in exact mode
+    fetched.clear()
+    now = Time.now().mjd
+    cache = ScWListCache(metadata=None, ingestion_latency_s=86400.)
+    for exact in [False, False, True, True]:
+        cache.get(fetch, 83.6, 22., 10., iso(53020), iso(now), exact=exact)
+    assert len(fetched) == 4
+
+    # an older window is stored, extending it to now fetches the recent edge only
+    cache.get(fetch, 83.6, 22., 10., iso(53020), iso(now - 2))
+    cache.get(fetch, 83.6, 22., 10., iso(53020), iso(now - 2))
+    assert len(fetched) == 5
+    for _ in range(2):
+        cache.get(fetch, 83.6, 22., 10., iso(53020), iso(now))
+    assert fetched[5:] == [(iso(now - 2), iso(now))] * 2
+
+
+def test_scwlist_parsing():
+    import re
+    import numpy as np
+    from cdci_osa_plugin.osa_scwlist import ScWList
+
+    items = ["066500220010.001", " 066500230010.000 ", "1234", "06650022001X.001", "066500220010.0011",
+             "066500220010_001", "", "abc.000", "１２３４５６７８９０１２.001",
+             "066500220010.001" + "0" * 100000 + ".000", "0665002200100" * 1000]
+
+    scw_list = ScWList(items)
+    template = re.compile(r'^([0-9]{12}).([0-9]{3})$')
+
+    assert len(scw_list) == len(items)
+    assert list(scw_list.valid) == [template.match(item.strip()) is not None for item in items]
+    assert scw_list.malformed() == [item.strip() for item in items if template.match(item.strip()) is None]
+    assert list(scw_list.nrt()) == [item.strip().endswith('.000') for item in items]
+
+    assert scw_list.revolution[:2].tolist() == [665, 665]
+    assert scw_list.pointing[:2].tolist() == [22, 23]
+    assert scw_list.subpointing[:2].tolist() == [1, 1]
+    assert scw_list.scw_type[:2].tolist() == [0, 0]
+    assert scw_list.version.tolist() == [1, 0] + [-1] * 3 + [1] + [-1] * 5
+
+    # long items do not widen the character array, which would take 4 GB here
+    huge = ScWList(["066500220010.001"] + ["0" * 10 ** 6 + ".000"] * 1000)
+    assert huge.valid.tolist() == [True] + [False] * 1000 and huge.nrt().sum() == 1000
+
+    assert ScWList("066500220010.001,066500230010.001").ids == ["066500220010.001", "066500230010.001"]
+    assert len(ScWList(None)) == 0 and not ScWList([]).has_nrt()
+
+    # linear: 200k ids, a few bad ones
+    many = ["%04d%04d0010.001" % (i // 1000, i % 1000) for i in range(200000)]
+    many[1000] = "bad"
+    scw_list = ScWList(many)
+    assert scw_list.malformed() == ["bad"]
+    assert np.sum(scw_list.valid) == 199999
+
+
+def test_compact_scwlist_assumption(monkeypatch):
+    from cdci_osa_plugin.osa_scwlist import ScWList
+    from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher
+
+    scw_ids = ["%04d%04d0010.001" % (rev, p) for rev in range(1000, 1020) for p in range(100)] + \
+              ["100500550020.001", "100500560010.000", "160000010010.001"]
+
+    for scw_list in scw_ids, scw_ids[::-1], sorted(scw_ids), []:
+        assert eval(ScWList(scw_list).expression()) == scw_list
+
+    assert len(ScWList(sorted(scw_ids)).runs()) == 24
+
+    full = OsaDispatcher.get_scwlist_assumption(scw_ids, None, None, None, None, None, None)
+
+    monkeypatch.setattr(OsaDispatcher, 'compact_scwlist_min', 100)
+    compact = OsaDispatcher.get_scwlist_assumption(scw_ids, None, None, None, None, None, None)
+    assert compact[0] == full[0]
+    assert len(compact[1]) < len(full[1]) / 20
+
+    # same list once evaluated by the backend
+    prefix = 'ddosa.IDScWList(use_scwid_list='
+    assert eval(compact[1][len(prefix):-1]) == eval(full[1][len(prefix):-1])
+
+    assert OsaDispatcher.get_scwlist_assumption(scw_ids[:10], None, None, None, None, None, None)[1].startswith(
+        prefix + '["')
+
+
+def test_catalog_inject(monkeypatch):
+    import numpy as np
+    from astropy.coordinates import SkyCoord
+    from astropy.table import Table
+    from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher
+
+    class Instrument:
+        name = 'isgri'
+
+    class Catalog:
+        def __init__(self, n, flags=True):
+            rng = np.random.RandomState(0)
+            self.sc = SkyCoord(rng.uniform(0, 360, n), rng.uniform(-90, 90, n), unit='deg', frame='fk5')
+            self.table = Table([["src %d" % i for i in range(n)]], names=['src_names'])
+            if flags:
+                self.table['FLAG'] = rng.randint(0, 2, n)
+                self.table['ISGRI_FLAG'] = rng.randint(0, 3, n).astype(float)
+
+        ra = property(lambda self: self.sc.fk5.ra)
+        dec = property(lambda self: self.sc.fk5.dec)
+        name = property(lambda self: self.table['src_names'])
+
+    # the content hash is only computed when it is sent
+    from cdci_osa_plugin import osa_dataserve_dispatcher
+    hashed = []
+    content_hash = osa_dataserve_dispatcher.get_inject_content_hash
+    monkeypatch.setattr(osa_dataserve_dispatcher, 'get_inject_content_hash',
+                        lambda columns: hashed.append(columns) or content_hash(columns))
+
+    for catalog in Catalog(500), Catalog(3, flags=False):
+        flags = 'FLAG' in catalog.table.colnames
+
+        cat = OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=catalog)
+        assert cat[0] == 'SourceCatalog'
+        assert cat[1]['version'] == 'v2' and cat[1]['autoversion']
+        assert cat[1]['catalog'] == [
+            {
+                "RA": float(ra.deg),
+                "DEC": float(dec.deg),
+                "NAME": str(name),
+                "FLAG": int(flag),
+                "ISGRI_FLAG": int(isgri_flag),
+            }
+            for ra, dec, name, flag, isgri_flag in zip(
+                catalog.ra, catalog.dec, catalog.name,
+                catalog.table['FLAG'] if flags else np.zeros(len(catalog.ra)),
+                catalog.table['ISGRI_FLAG'] if flags else np.zeros(len(catalog.ra)))
+        ]
+
+    assert hashed == []
+
+    monkeypatch.setattr(OsaDispatcher, 'catalog_inject_format', 'columns')
+
+    cat = OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=Catalog(500))
+    columns = cat[1]['catalog_columns']
+    assert len(hashed) == 1
+    assert set(columns) == {"RA", "DEC", "NAME", "FLAG", "ISGRI_FLAG"}
+    assert all(len(c) == 500 for c in columns.values())
+    assert type(columns['FLAG'][0]) is int and type(columns['RA'][0]) is float
+
+    assert OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=Catalog(500))[1]['content_hash'] == \
+        cat[1]['content_hash']
+    assert OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=Catalog(499))[1]['content_hash'] != \
+        cat[1]['content_hash']
+
+
+def test_catalog_store(tmp_path, monkeypatch):
+    import os
+    import time
+    from cdci_osa_plugin.osa_catalog_store import LocalCatalogStore
+    from cdci_osa_plugin.osa_dataserve_dispatcher import OsaDispatcher
+
+    store = LocalCatalogStore(str(tmp_path / "store"), max_entries=3)
+
+    catalogs = [dict(RA=[float(i)], DEC=[1.], NAME=["src %d" % i], FLAG=[0], ISGRI_FLAG=[1]) for i in range(5)]
+
+    hashes = [store.put(c) for c in catalogs[:3]]
+    assert len(set(hashes)) == 3
+    assert store.put(dict(catalogs[0])) == hashes[0]
+    assert len(store) == 3
+    assert store.get(hashes[1]) == catalogs[1]
+
+    # 1 used last, 2 is least recently used
+    for i, h in enumerate([hashes[2], hashes[0], hashes[1]]):
+        os.utime(store._path(h), (time.time() + i, time.time() + i))
+
+    store.put(catalogs[3])
+    assert len(store) == 3
+    assert hashes[2] not in store and store.get(hashes[2]) is None
+    assert hashes[0] in store and hashes[1] in store
+
+    # requests carry the reference only
+    monkeypatch.setenv('CDCI_OSA_PLUGIN_CATALOG_STORE', str(tmp_path / "dispatcher_store"))
+
+    class Instrument:
+        name = 'isgri'
+
+    from astropy.coordinates import SkyCoord
+    from astropy.table import Table
+
+    class Catalog:
+        sc = SkyCoord([10., 20.], [-5., 5.], unit='deg', frame='fk5')
+        table = Table([["a", "b"]], names=['src_names'])
+        ra = sc.fk5.ra
+        dec = sc.fk5.dec
+
+    cat = OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=Catalog())
+    assert set(cat[1]) == {"catalog_ref", "content_hash", "version", "autoversion"}
+    assert cat[1]['catalog_ref'] == "sha256:" + cat[1]['content_hash']
+
+    from cdci_osa_plugin.osa_catalog_store import get_catalog_store
+    assert get_catalog_store().get(cat[1]['content_hash'])['NAME'] == ["a", "b"]
+    assert OsaDispatcher.get_instr_catalog(Instrument(), user_catalog=Catalog()) == cat
+    assert len(get_catalog_store()) == 1
+
+
+def test_srclres_catalog(tmp_path, monkeypatch):
+    import numpy as np
+    from astropy.io import fits
+    from cdci_osa_plugin.osa_catalog import OsaIsgriCatalog, OsaJemxCatalog, read_srclres_columns
+
+    # BasicCatalog still uses np.bool
+    monkeypatch.setattr(np, 'bool', bool, raising=False)
+
+    n = 6
+    columns = dict(NAME=np.array([" Crab  ", "Cyg X-1", "NEW_1", "A", "B", "C"]),
+                   RA_FIN=np.array([83.6, 0., 10., 0., 20., 30.]),
+                   DEC_FIN=np.array([22., 0., 0., 5., -5., 1.]),
+                   RA_OBJ=np.array([83.63, 299.59, 10.1, 40., 21., 31.]),
+                   DEC_OBJ=np.array([22.01, 35.2, 0.1, 5., -5.1, 1.1]),
+                   DETSIG=np.arange(n, dtype=float), NEW_SOURCE=np.zeros(n, dtype=np.int16),
+                   ISGRI_FLAG=np.ones(n, dtype=np.int16), FLAG=np.zeros(n, dtype=np.int16),
+                   ERR_RAD=np.full(n, 0.01), SPA_MODEL=np.zeros((n, 100)))
+
+    formats = dict(NAME='20A', SPA_MODEL='100D')
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name=k, array=v, format=formats.get(k, 'D' if v.dtype.kind == 'f' else 'I'))
+                                         for k, v in columns.items()])
+    hdu.header['RADECSYS'] = 'FK5'
+    fn = str(tmp_path / "isgri_srclres.fits")
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fn)
+
+    frame, data = read_srclres_columns(fn, ['NAME', 'RA_FIN'])
+    assert frame == 'fk5'
+    assert set(data) == {'NAME', 'RA_FIN'}
+    assert data['NAME'] == ["Crab", "Cyg X-1", "NEW_1", "A", "B", "C"]
+
+    catalog = OsaIsgriCatalog.build_from_ddosa_srclres(fn)
+    assert np.allclose(catalog.ra.deg, [83.6, 299.59, 10., 0., 20., 30.])
+    assert np.allclose(catalog.dec.deg, [22., 35.2, 0., 5., -5., 1.])
+    assert list(catalog.name) == data['NAME']
+
+    catalog = OsaJemxCatalog.build_from_ddosa_srclres(fn)
+    assert np.allclose(catalog.ra.deg, columns['RA_OBJ'])
+
+    # the file is left as it is
+    with fits.open(fn) as f:
+        assert np.all(f[1].data['RA_FIN'] == columns['RA_FIN'])
+
+
+def test_catalog_index(monkeypatch):
+    import sys
+    import numpy as np
+    from cdci_osa_plugin.osa_catalog import CatalogIndex, OsaIsgriCatalog, get_catalog_index
+    from cdci_osa_plugin.osa_scw_index import _unit_vectors
+
+    # BasicCatalog still uses np.bool
+    monkeypatch.setattr(np, 'bool', bool, raising=False)
+
+    rng = np.random.RandomState(3)
+    n = 3000
+    ra = rng.uniform(0, 360, n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    significance = rng.exponential(5, n)
+    significance[:10] = np.nan
+
+    def brute_cone(ra0, dec0, radius):
+        return np.flatnonzero(_unit_vectors(ra, dec) @ _unit_vectors(ra0, dec0) >= np.cos(np.radians(radius)))
+
+    for scipy_available in True, False:
+        if not scipy_available:
+            monkeypatch.setitem(sys.modules, 'scipy.spatial', None)
+
+        index = CatalogIndex(ra, dec, significance)
+        assert (index._tree is not None) == scipy_available
+
+        for threshold in 0, 3., 7.5, 100:
+            assert np.array_equal(index.significance_above(threshold), significance > threshold)
+
+        for ra0, dec0, radius in (83.6, 22., 10.), (0., 89., 5.), (359.9, -30., 20.), (10., 0., 180.):
+            assert np.array_equal(index.cone_search(ra0, dec0, radius), brute_cone(ra0, dec0, radius))
+
+        rows, separation = index.nearest(83.6, 22., k=5)
+        sep_all = np.degrees(np.arccos(np.clip(_unit_vectors(ra, dec) @ _unit_vectors(83.6, 22.), -1, 1)))
+        assert np.array_equal(rows, np.argsort(sep_all)[:5])
+        assert np.allclose(separation, np.sort(sep_all)[:5])
+
+    catalog = OsaIsgriCatalog(["src %d" % i for i in range(n)], ra, dec, significance, frame='fk5',
+                              ISGRI_FLAG=np.ones(n), FLAG=np.zeros(n), ERR_RAD=np.full(n, 0.01))
+    assert np.array_equal(catalog.significance_above(5.), significance > 5.)
+    assert np.array_equal(catalog.cone_search(83.6, 22., 10.), brute_cone(83.6, 22., 10.))
+
+    # shared by catalogs with the same content
+    same_catalog = OsaIsgriCatalog(["src %d" % i for i in range(n)], ra, dec, significance, frame='fk5')
+    assert get_catalog_index(same_catalog) is catalog.index
+
+    # looked up once per catalog, again once its coordinates or table are replaced
+    from cdci_osa_plugin import osa_catalog
+    lookups = []
+    monkeypatch.setattr(osa_catalog, 'get_catalog_index',
+                        lambda catalog: lookups.append(catalog) or get_catalog_index(catalog))
+
+    for _ in range(3):
+        assert same_catalog.index is catalog.index
+        same_catalog.cone_search(83.6, 22., 10.)
+    assert lookups == [same_catalog]
+
+    same_catalog._sc = same_catalog._sc[::-1]
+    same_catalog._table = same_catalog._table[::-1]
+    assert np.array_equal(same_catalog.cone_search(83.6, 22., 10.), n - 1 - brute_cone(83.6, 22., 10.)[::-1])
+    same_catalog.cone_search(83.6, 22., 10.)
+    assert len(lookups) == 2
+
+
+def test_cross_match(monkeypatch):
+    import sys
+    from collections import OrderedDict
+    import numpy as np
+    from cdci_data_analysis.analysis.catalog import BasicCatalog
+    from cdci_osa_plugin.osa_catalog import OsaIsgriCatalog, cross_match
+    from cdci_osa_plugin.osa_scw_index import _unit_vectors
+
+    # BasicCatalog still uses np.bool
+    monkeypatch.setattr(np, 'bool', bool, raising=False)
+
+    rng = np.random.RandomState(5)
+    n_ref = 20000
+    ref_ra = rng.uniform(0, 360, n_ref)
+    ref_dec = np.degrees(np.arcsin(rng.uniform(-1, 1, n_ref)))
+
+    # detections: offsets of some reference sources, and unrelated ones
+    n_det = 20000
+    matched = rng.choice(n_ref, n_det // 2, replace=False)
+    det_ra = np.concatenate([ref_ra[matched] + rng.normal(0, 0.01, len(matched)) / np.cos(np.radians(ref_dec[matched])),
+                             rng.uniform(0, 360, n_det - len(matched))]) % 360
+    det_dec = np.clip(np.concatenate([ref_dec[matched] + rng.normal(0, 0.01, len(matched)),
+                                      np.degrees(np.arcsin(rng.uniform(-1, 1, n_det - len(matched))))]), -90, 90)
+    det_err = rng.uniform(0.005, 0.02, n_det)
+    significance = rng.uniform(0, 20, n_det)
+
+    detections = OsaIsgriCatalog(["det %d" % i for i in range(n_det)], det_ra, det_dec, significance, frame='fk5',
+                                 ISGRI_FLAG=np.ones(n_det), FLAG=np.zeros(n_det), ERR_RAD=det_err)
+    reference = BasicCatalog(["ref %d" % i for i in range(n_ref)], ref_ra, ref_dec, np.zeros(n_ref), frame='fk5')
+    detections.selected = significance > 5
+
+    for scipy_available in True, False:
+        if not scipy_available:
+            monkeypatch.setitem(sys.modules, 'scipy.spatial', None)
+            monkeypatch.setattr('cdci_osa_plugin.osa_catalog._catalog_indices', OrderedDict())
+
+        matches = detections.cross_match(reference)
+
+        # brute force on a subset of the selected detections
+        det_rows = np.flatnonzero(detections.selected)
+        for i in rng.choice(len(det_rows), 200, replace=False):
+            j = det_rows[i]
+            separation = np.degrees(np.arccos(np.clip(
+                _unit_vectors(ref_ra, ref_dec) @ _unit_vectors(det_ra[j], det_dec[j]), -1, 1)))
+            expected = np.flatnonzero(separation <= max(3 * det_err[j], 1. / 60))
+            found = matches[matches['det_row'] == i]
+            assert sorted(found['ref_row']) == sorted(expected)
+            if len(found) > 0:
+                assert found['ref_row'][found['nearest']][0] == expected[np.argmin(separation[expected])]
+                assert found['det_name'][0] == "det %d" % j
+
+        assert np.sum(matches['nearest']) > 0.9 * np.sum(detections.selected[:n_det // 2])
+
+    fixed = cross_match(detections, reference, radius=0.001)
+    assert np.all(fixed['separation'] <= 0.001)
+
+
+def _ensure_timedel_loop(du):
+    # the per-bin loop OsaLightCurve.ensure_timedel used, reference for test_ensure_timedel
+    from numpy.lib.recfunctions import append_fields
+    import numpy as np
+
+    timedel = du.header['TIMEDEL']
+    timepix = du.header['TIMEPIXR']
+    t_lc = du.data['TIME'] + (0.5 - timepix) * timedel
+    dt_lc = (timedel / 2) * np.ones(t_lc.shape)
+
+    for i in range(len(t_lc) - 1):
+        dt_lc[i + 1] = min(timedel / 2, t_lc[i + 1] - t_lc[i] - dt_lc[i])
+        if dt_lc[i + 1] <= 0:
+            dt_lc[i + 1] = timedel / 2
+
+    _d = np.array(du.data)
+    _o = append_fields(_d, 'TIMEDEL', dt_lc*2)
+
+    du.data = _o.data
+
+
+def _lc_data_unit(time, time_format='D'):
+    import numpy as np
+    from astropy.io import fits
+    from oda_api.data_products import NumpyDataUnit
+
+    n = len(time)
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='TIME', array=time, format=time_format),
+                                         fits.Column(name='RATE', array=np.arange(n, dtype=np.float32), format='E'),
+                                         fits.Column(name='ERROR', array=np.ones(n, dtype=np.float32), format='E'),
+                                         fits.Column(name='FRACEXP', array=np.ones(n, dtype=np.float32), format='E')],
+                                        name='ISGR-SRC.-LCR')
+    hdu.header['TIMEDEL'] = 0.01
+    hdu.header['TIMEPIXR'] = 0.5
+    return NumpyDataUnit.from_fits_hdu(hdu)
+
+
+def _lc_times(n, rng):
+    import numpy as np
+
+    timedel = 0.01
+    regular = 3000. + timedel * np.arange(n)
+
+    return {
+        'regular': regular,
+        'jittered': regular + rng.normal(0, timedel * 0.3, n),
+        'gaps': np.sort(np.concatenate([regular[:n // 2], regular[n // 2:] + 0.123456])),
+        'unsorted and repeated': np.round(rng.uniform(3000, 3000 + n * timedel, n), 4),
+        'chain': 3000. + 0.75 * timedel * np.arange(n),
+        'nan': np.where(np.arange(n) % 97 == 0, np.nan, regular),
+    }
+
+
+def test_ensure_timedel():
+    import numpy as np
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve
+
+    rng = np.random.RandomState(7)
+
+    for time_format in 'D', 'E':
+        for n in 0, 1, 2, 3, 500:
+            for name, time in _lc_times(n, rng).items():
+                du, du_loop = _lc_data_unit(time, time_format), _lc_data_unit(time, time_format)
+
+                OsaLightCurve.ensure_timedel(du)
+                _ensure_timedel_loop(du_loop)
+
+                assert du.data.dtype == du_loop.data.dtype, name
+                assert du.data.tobytes() == du_loop.data.tobytes(), name
+
+
+@pytest.mark.slow
+def test_ensure_timedel_benchmark():
+    import time
+    import numpy as np
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve
+
+    rng = np.random.RandomState(8)
+
+    for name, time_lc in _lc_times(200000, rng).items():
+        du, du_loop = _lc_data_unit(time_lc), _lc_data_unit(time_lc)
+
+        t0 = time.perf_counter()
+        OsaLightCurve.ensure_timedel(du)
+        t_vectorized = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        _ensure_timedel_loop(du_loop)
+        t_loop = time.perf_counter() - t0
+
+        print(f"ensure_timedel, {name}, 200000 bins: {t_vectorized:.3f} s, loop {t_loop:.3f} s")
+
+        assert du.data.tobytes() == du_loop.data.tobytes()
+        assert t_vectorized < t_loop * 1.5
+
+
+def test_lightcurve_draw_from_memory(tmp_path, monkeypatch):
+    import numpy as np
+    from oda_api.data_products import NumpyDataProduct
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve, ScatterPlot
+
+    du = _lc_data_unit(3000. + 0.01 * np.arange(100))
+    du.data['RATE'][10] = 0
+    du.data['ERROR'][10] = 0
+    du.header['MJDREF'] = 51544.
+    OsaLightCurve.ensure_timedel(du)
+
+    lc = OsaLightCurve(name='isgri_lc', data=NumpyDataProduct(data_unit=[du]), file_name='lc', file_dir=str(tmp_path),
+                       prod_prefix='', src_name='Crab', meta_data={})
+    lc.write()
+
+    drawn = []
+    monkeypatch.setattr(ScatterPlot, 'add_errorbar',
+                        lambda self, x, y, yerr=None, xerr=None: drawn.append((x, y, yerr, xerr)))
+
+    with monkeypatch.context() as m:
+        m.setattr(NumpyDataProduct, 'from_fits_file', None)
+        lc.get_html_draw()
+
+    lc.data = None
+    lc.get_html_draw()
+
+    assert len(drawn) == 2
+    assert len(drawn[0][0]) == 99
+    for in_memory, from_file in zip(*drawn):
+        assert np.array_equal(in_memory, from_file)
+
+
+def test_decimate_lightcurve():
+    import numpy as np
+    from cdci_osa_plugin.osa_lightcurve_query import decimate_lightcurve
+
+    rng = np.random.RandomState(9)
+    n = 100000
+    x = np.arange(n) * 0.01
+    dx = np.full(n, 0.005)
+    y = rng.normal(10, 1, n)
+    y[54321] = 100.
+    y[12345] = -50.
+    dy = rng.uniform(0.5, 1.5, n)
+
+    x_short = x[:100]
+    assert decimate_lightcurve(x_short, dx[:100], y[:100], dy[:100], 1000)[0] is x_short
+    assert len(decimate_lightcurve(x, dx, y, dy, 0)[0]) == n
+
+    xm, dxm, ym, dym = decimate_lightcurve(x, dx, y, dy, 1000)
+    assert len(xm) <= 1000
+    assert np.all(np.diff(xm) > 0)
+    assert 100. in ym and -50. in ym
+    # points are bins as they are
+    rows = np.searchsorted(x, xm)
+    assert np.array_equal(ym, y[rows]) and np.array_equal(dym, dy[rows]) and np.array_equal(dxm, dx[rows])
+
+    xr, dxr, yr, dyr = decimate_lightcurve(x, dx, y, dy, 1000, method='rebin')
+    assert len(xr) == 1000
+    assert np.allclose(xr - dxr, x[::100] - dx[::100]) and np.allclose(xr + dxr, x[99::100] + dx[99::100])
+    assert np.allclose(yr, y.reshape(1000, 100).mean(axis=1))
+    assert np.allclose(dyr, np.sqrt((dy.reshape(1000, 100) ** 2).sum(axis=1)) / 100)
+
+
+def test_lightcurve_fit_statistics(tmp_path, monkeypatch):
+    import json
+    import numpy as np
+    from oda_api.data_products import NumpyDataProduct
+    from cdci_osa_plugin.osa_fit_statistics import lightcurve_fit_statistics
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve
+
+    rng = np.random.RandomState(11)
+    n = 1000
+    x = np.sort(rng.uniform(0, 100, n))
+    dy = rng.uniform(0.5, 2, n)
+    y = 3. + 0.05 * x + rng.normal(0, dy)
+
+    statistics = lightcurve_fit_statistics(x, y, dy)
+    json.dumps(statistics)
+    assert statistics['n_bins'] == n
+
+    for name, deg in ('constant', 0), ('linear', 1):
+        p = np.polyfit(x, y, deg, w=1 / dy)
+        chisq = np.sum((np.polyval(p, x) - y) ** 2 / dy ** 2)
+        fit = statistics[name]
+        assert np.allclose(fit['p'], p)
+        assert np.isclose(fit['chisq'], chisq)
+        assert fit['dof'] == n - deg - 1
+        assert np.isclose(fit['chisq_red'], chisq / (n - deg - 1))
+
+    # zero, nan errors do not count
+    dy_bad = dy.copy()
+    dy_bad[:10] = 0
+    dy_bad[10] = np.nan
+    statistics_bad = lightcurve_fit_statistics(x, y, dy_bad)
+    assert statistics_bad['n_bins'] == n - 11
+    assert np.allclose(statistics_bad['linear']['p'], np.polyfit(x[11:], y[11:], 1, w=1 / dy[11:]))
+    assert np.isfinite(statistics_bad['linear']['chisq_red'])
+
+    assert lightcurve_fit_statistics(x[:1], y[:1], dy[:1])['constant'] is None
+    assert lightcurve_fit_statistics(x[:2], y[:2], dy[:2])['linear'] is None
+    assert lightcurve_fit_statistics(np.ones(5), y[:5], dy[:5])['linear'] is None
+
+    # computed on the first draw, kept in meta_data
+    du = _lc_data_unit(3000. + 0.01 * np.arange(100))
+    du.data['RATE'][:] = np.arange(100)
+    du.header['MJDREF'] = 51544.
+    OsaLightCurve.ensure_timedel(du)
+    lc = OsaLightCurve(name='isgri_lc', data=NumpyDataProduct(data_unit=[du]), file_name='lc', file_dir=str(tmp_path),
+                       prod_prefix='', src_name='Crab', meta_data={})
+    lc.get_html_draw()
+    assert lc.meta_data['fit_statistics']['x_offset'] == 3000
+    assert np.isclose(lc.meta_data['fit_statistics']['linear']['p'][0], 100)
+
+    monkeypatch.setattr('cdci_osa_plugin.osa_lightcurve_query.lightcurve_fit_statistics', None)
+    lc.get_html_draw()
+
+    # and written as header keywords of the lightcurve extension
+    from astropy.io import fits
+    lc.write()
+    with fits.open(lc.file_path.path) as f:
+        header = f['ISGR-SRC.-LCR'].header
+        fit_statistics = lc.meta_data['fit_statistics']
+        assert header['FIT_NBIN'] == fit_statistics['n_bins'] and header['FIT_TOFF'] == 3000
+        assert np.isclose(header['LF_SLOPE'], 100) and header['LF_DOF'] == fit_statistics['linear']['dof']
+        assert np.isclose(header['CF_LEVEL'], fit_statistics['constant']['p'][0])
+        assert np.isclose(header['CF_RCHI2'], fit_statistics['constant']['chisq_red'])
+
+
+def test_ordered_map():
+    import threading
+    import time
+    from cdci_osa_plugin.osa_parallel import ordered_map
+
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight_bytes = [0]
+
+    def square(item):
+        with lock:
+            in_flight.append(item)
+            max_in_flight_bytes[0] = max(max_in_flight_bytes[0], sum(in_flight))
+        time.sleep(0.01 * (item % 3))
+        with lock:
+            in_flight.remove(item)
+        return item ** 2
+
+    items = list(range(1, 30))
+
+    assert ordered_map(square, items) == [i ** 2 for i in items]
+    assert ordered_map(square, items, max_workers=4) == [i ** 2 for i in items]
+
+    max_in_flight_bytes[0] = 0
+    assert ordered_map(square, items, max_workers=8, max_pending_bytes=40,
+                       item_bytes=lambda item: item) == [i ** 2 for i in items]
+    # the items started and not collected are within the budget, or alone
+    assert max_in_flight_bytes[0] <= max(40, max(items))
+
+    def fail(item):
+        if item == 5:
+            raise ValueError(item)
+        return item
+
+    with pytest.raises(ValueError):
+        ordered_map(fail, items, max_workers=4)
+
+
+def test_build_lc_in_parallel(tmp_path, monkeypatch):
+    import numpy as np
+    from astropy.io import fits
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve
+
+    class Res(object):
+        extracted_sources = []
+
+    res = Res()
+    for i in range(12):
+        n = 100 + 10 * i
+        hdu = fits.BinTableHDU.from_columns([fits.Column(name='TIME', array=3000. + 0.01 * np.arange(n), format='D'),
+                                             fits.Column(name='RATE', array=np.full(n, i, dtype=np.float32), format='E'),
+                                             fits.Column(name='ERROR', array=np.ones(n, dtype=np.float32), format='E')],
+                                            name='ISGR-SRC.-LCR')
+        hdu.header['NAME'] = 'source %d' % i
+        hdu.header['TIMEDEL'] = 0.01
+        hdu.header['TIMEPIXR'] = 0.5
+
+        path = str(tmp_path / ('lc_%d.fits' % i))
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path)
+
+        res.extracted_sources.append(('source %d' % i, 'lc_%d' % i))
+        setattr(res, 'lc_%d' % i, path)
+
+    products = {}
+    for workers in 1, 4:
+        monkeypatch.setattr(OsaLightCurve, 'build_workers', workers)
+        monkeypatch.setattr(OsaLightCurve, 'build_max_pending_mb', 1)
+        products[workers] = OsaLightCurve.build_isgri_lc_from_ddosa_res(res, prod_prefix='', file_dir=str(tmp_path))
+
+    assert [lc.meta_data['src_name'] for lc in products[4]] == ['source %d' % i for i in range(12)]
+    for lc_1, lc_4 in zip(products[1], products[4]):
+        assert lc_1.meta_data == lc_4.meta_data
+        du_1, du_4 = OsaLightCurve.get_lc_data_unit(lc_1.data), OsaLightCurve.get_lc_data_unit(lc_4.data)
+        assert du_1.data.tobytes() == du_4.data.tobytes()
+
+
+def _isgri_spectra_res(tmp_path, n_sources, rmf_paths):
+    import numpy as np
+    from astropy.io import fits
+
+    class Res(object):
+        extracted_sources = []
+
+    res = Res()
+
+    for path in rmf_paths:
+        matrix = fits.BinTableHDU.from_columns([fits.Column(name='MATRIX', array=np.eye(16, dtype=np.float32),
+                                                            format='16E')], name='ISGR-RMF.-RSP')
+        ebounds = fits.BinTableHDU.from_columns([fits.Column(name='E_MIN', array=np.arange(16.), format='D')],
+                                                name='ISGR-EBDS-MOD')
+        fits.HDUList([fits.PrimaryHDU(), matrix, ebounds]).writeto(str(path), overwrite=True)
+
+    for i in range(n_sources):
+        spectrum = fits.BinTableHDU.from_columns([fits.Column(name='RATE', array=np.full(16, i, dtype=np.float32),
+                                                              format='E')], name='ISGR-PHA1-SPE')
+        arf = fits.BinTableHDU.from_columns([fits.Column(name='SPECRESP', array=np.full(16, i, dtype=np.float32),
+                                                         format='E')], name='ISGR-ARF.-RSP')
+        for kind, hdu in ('spec', spectrum), ('arf', arf):
+            path = str(tmp_path / ('%s_%d.fits' % (kind, i)))
+            fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+            setattr(res, '%s_%d' % (kind, i), path)
+
+        setattr(res, 'rmf_%d' % i, str(rmf_paths[i % len(rmf_paths)]))
+        res.extracted_sources.append(('source %d' % i, 'spec_%d' % i, 'rmf_%d' % i, 'arf_%d' % i))
+
+    return res
+
+
+def test_spectrum_responses_deduplicated(tmp_path, monkeypatch):
+    import os
+    from cdci_data_analysis.analysis.products import QueryProductList, SpectrumProduct
+    from oda_api.data_products import NumpyDataProduct
+    from cdci_osa_plugin import osa_response_cache
+    from cdci_osa_plugin.osa_response_cache import ResponseCache
+    from cdci_osa_plugin.osa_spectrum_query import IsgriSpectrumProduct, IsgriSpectrumQuery
+
+    monkeypatch.setattr(osa_response_cache, 'response_cache', ResponseCache())
+    monkeypatch.setattr('cdci_osa_plugin.osa_spectrum_query.response_cache', osa_response_cache.response_cache)
+
+    decoded = []
+    from_fits_file = NumpyDataProduct.from_fits_file
+    monkeypatch.setattr(NumpyDataProduct, 'from_fits_file',
+                        lambda path, **kw: decoded.append(os.path.basename(path)) or from_fits_file(path, **kw))
+
+    # the same matrix, in two files
+    (tmp_path / 'scw').mkdir()
+    res = _isgri_spectra_res(tmp_path, 6, [tmp_path / 'rmf.fits', tmp_path / 'scw' / 'rmf.fits'])
+
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    spec_list = IsgriSpectrumProduct.build_list_from_ddosa_res(res, prod_prefix='query', out_dir=str(out_dir))
+
+    assert len(spec_list) == 18
+    spectra, arfs, rmfs = spec_list[0::3], spec_list[1::3], spec_list[2::3]
+    assert [spec.meta_data['src_name'] for spec in spectra] == ['source %d' % i for i in range(6)]
+    assert {spec.rmf_file for spec in spectra} == {'query_rmf.fits'}
+    assert len({spec.arf_file for spec in spectra}) == 6
+    # decoded when the data are used
+    assert [path for path in decoded if 'spec' not in path] == []
+    for product in arfs + rmfs:
+        assert product.data.meta_data['src_name'] == product.meta_data['src_name']
+    assert len([path for path in decoded if 'rmf' in path]) == 1
+    assert len([path for path in decoded if 'arf' in path]) == 6
+    assert rmfs[0].data.get_data_unit_by_name('SPECRESP MATRIX') is not None
+    assert rmfs[0].data.get_data_unit_by_name('EBOUNDS') is not None
+    assert arfs[0].data.get_data_unit_by_name('SPECRESP') is not None
+
+    class Instrument(object):
+        _current_par_dic = {'src_name': 'test'}
+
+        class disp_conf(object):
+            products_url = 'http://products'
+
+    written = []
+    write = SpectrumProduct.write
+    monkeypatch.setattr(SpectrumProduct, 'write',
+                        lambda self, **kw: written.append(self.file_path.name) or write(self, **kw))
+
+    query_out = IsgriSpectrumQuery('isgri_spectrum_query').process_product_method(Instrument(),
+                                                                                  QueryProductList(prod_list=spec_list))
+    assert sorted(written) == sorted(set(written))
+    assert written.count('query_rmf.fits') == 1
+    assert query_out.prod_dictionary['rmf_file_name'] == ['query_rmf.fits'] * 6
+
+    # decoded once for later results too
+    spec_list = IsgriSpectrumProduct.build_list_from_ddosa_res(res, prod_prefix='other', out_dir=str(out_dir))
+    for product in spec_list[1::3] + spec_list[2::3]:
+        product.data
+    assert len([path for path in decoded if 'spec' not in path]) == 7
+    assert spec_list[2].data.get_data_unit_by_name('PRIMARY') is not rmfs[0].data.get_data_unit_by_name('PRIMARY')
+
+
+def test_response_header_rewrite(tmp_path, monkeypatch):
+    import gzip
+    import os
+    import shutil
+    import numpy as np
+    from astropy.io import fits
+    from cdci_data_analysis.analysis.products import QueryProductList
+    from oda_api.data_products import NumpyDataProduct
+    from cdci_osa_plugin.osa_fits_stream import rewrite_fits_headers
+    from cdci_osa_plugin.osa_spectrum_query import JemxSpectrumProduct, JemxSpectrumQuery
+
+    rng = np.random.RandomState(3)
+    matrix = fits.BinTableHDU.from_columns([fits.Column(name='MATRIX', array=rng.uniform(size=(300, 200)).astype('>f4'),
+                                                        format='200E')], name='JMX2-RMF.-RSP')
+    matrix.header['EXTNAME'] = ('JMX2-RMF.-RSP', 'extension name')
+    ebounds = fits.BinTableHDU.from_columns([fits.Column(name='E_MIN', array=np.arange(200.), format='D')],
+                                            name='JMX2-FBDS-MOD')
+    image = fits.ImageHDU(rng.uniform(size=(7, 5)), name='OTHER')
+    fits.HDUList([fits.PrimaryHDU(), matrix, ebounds, image]).writeto(str(tmp_path / 'rmf.fits'))
+
+    with open(tmp_path / 'rmf.fits', 'rb') as f_in, gzip.open(tmp_path / 'rmf.fits.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+    extnames = {'JMX2-RMF.-RSP': 'SPECRESP MATRIX', 'JMX2-FBDS-MOD': 'EBOUNDS'}
+    for in_file, out_file, compresslevel in [('rmf.fits', 'out.fits', None),
+                                             ('rmf.fits.gz', 'out_gz.fits', None),
+                                             ('rmf.fits', 'out.fits.gz', 6)]:
+        rewrite_fits_headers(str(tmp_path / in_file), str(tmp_path / out_file), extnames, compresslevel=compresslevel)
+
+        with fits.open(str(tmp_path / 'rmf.fits')) as original, fits.open(str(tmp_path / out_file)) as rewritten:
+            assert [hdu.name for hdu in rewritten] == ['PRIMARY', 'SPECRESP MATRIX', 'EBOUNDS', 'OTHER']
+            assert rewritten[1].header.comments['EXTNAME'] == ''
+            for hdu, hdu_original in zip(rewritten[1:], original[1:]):
+                assert hdu.data.tobytes() == hdu_original.data.tobytes()
+
+    assert (tmp_path / 'out.fits').stat().st_size == (tmp_path / 'rmf.fits').stat().st_size
+
+    # permissions of files written by astropy, not of temporary files
+    for out_file in ['out.fits', 'out_gz.fits', 'out.fits.gz']:
+        assert (tmp_path / out_file).stat().st_mode == (tmp_path / 'rmf.fits').stat().st_mode
+
+    # the compressed file is closed with its reader
+    from cdci_osa_plugin.osa_fits_stream import open_fits_stream
+    if os.path.isdir('/proc/self/fd'):
+        n_fd = len(os.listdir('/proc/self/fd'))
+        for _ in range(10):
+            with open_fits_stream(str(tmp_path / 'rmf.fits.gz')) as f:
+                f.read(2880)
+        assert len(os.listdir('/proc/self/fd')) == n_fd
+
+    with open(tmp_path / 'truncated.fits', 'wb') as f:
+        f.write((tmp_path / 'rmf.fits').read_bytes()[:10000])
+    with pytest.raises(ValueError):
+        rewrite_fits_headers(str(tmp_path / 'truncated.fits'), str(tmp_path / 'out_truncated.fits'), extnames)
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith('tmp')) == []
+
+    # products written without decoding the responses
+    class Res(object):
+        spectrum_crab = str(tmp_path / 'spectrum.fits')
+        arf_crab = str(tmp_path / 'arf.fits')
+        rmf_crab = str(tmp_path / 'rmf.fits.gz')
+
+    spectrum = fits.BinTableHDU.from_columns([fits.Column(name='RATE', array=np.ones(200), format='E')],
+                                             name='JMX2-PHA1-SPE')
+    fits.HDUList([fits.PrimaryHDU(), spectrum]).writeto(Res.spectrum_crab)
+    arf = fits.BinTableHDU.from_columns([fits.Column(name='SPECRESP', array=np.ones(200), format='E')],
+                                        name='JMX2-AXIS-ARF')
+    fits.HDUList([fits.PrimaryHDU(), arf]).writeto(Res.arf_crab)
+
+    decoded = []
+    from_fits_file = NumpyDataProduct.from_fits_file
+    monkeypatch.setattr(NumpyDataProduct, 'from_fits_file',
+                        lambda path, **kw: decoded.append(path) or from_fits_file(path, **kw))
+
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    spec_list = JemxSpectrumProduct.build_list_from_ddosa_res(Res(), prod_prefix='query', out_dir=str(out_dir))
+
+    class Instrument(object):
+        _current_par_dic = {'src_name': 'crab'}
+
+        class disp_conf(object):
+            products_url = 'http://products'
+
+    JemxSpectrumQuery('jemx_spectrum_query').process_product_method(Instrument(), QueryProductList(prod_list=spec_list))
+    assert decoded == [Res.spectrum_crab]
+
+    with fits.open(str(out_dir / 'query_rmf_crab.fits.gz')) as rmf, fits.open(str(out_dir / 'query_arf_crab.fits.gz')) as arf:
+        assert [hdu.name for hdu in rmf] == ['PRIMARY', 'SPECRESP MATRIX', 'EBOUNDS', 'OTHER']
+        assert [hdu.name for hdu in arf] == ['PRIMARY', 'SPECRESP']
+        assert np.array_equal(rmf[1].data['MATRIX'], matrix.data['MATRIX'])
+
+    # the same, decoded
+    assert np.array_equal(spec_list[2].data.get_data_unit_by_name('SPECRESP MATRIX').data['MATRIX'],
+                          matrix.data['MATRIX'])
+
+    # decoded after the url was added: the url goes to the decoded primary header too
+    from cdci_data_analysis.analysis.products import SpectrumProduct
+    from cdci_osa_plugin.osa_spectrum_query import OsaResponseProduct
+
+    def add_url_to_fits_file(self, par_dict, url='', **kwargs):
+        self.data.get_data_unit(0).header['URL'] = url
+
+    monkeypatch.setattr(SpectrumProduct, 'add_url_to_fits_file', add_url_to_fits_file)
+
+    rmf = OsaResponseProduct('jemx_rmf', 'rmf_url.fits', Res.rmf_crab, extnames, file_dir=str(out_dir), meta_data={})
+    rmf.add_url_to_fits_file({'src_name': 'crab'}, url='http://products')
+    assert not rmf.decoded
+    assert rmf.data.get_data_unit(0).header['URL'] == 'http://products'
+    assert rmf.data.get_data_unit_by_name('EBOUNDS') is not None
+
+    rmf.write()
+    with fits.open(rmf.file_path.path) as f:
+        assert f[0].header['URL'] == 'http://products'
+
+
+def test_sparse_response(tmp_path, monkeypatch):
+    import sys
+    import numpy as np
+    from astropy.io import fits
+    from cdci_osa_plugin import osa_response
+    from cdci_osa_plugin.osa_response import SparseResponse, get_sparse_response
+    from cdci_osa_plugin.osa_spectrum_query import OsaResponseProduct
+
+    rng = np.random.RandomState(5)
+    n_energies, n_channels = 50, 32
+
+    # up to two groups of channels per energy, channels numbered from 0
+    dense = np.zeros((n_energies, n_channels))
+    n_grp, f_chan, n_chan, matrix = [], [], [], []
+    for i in range(n_energies):
+        starts = np.sort(rng.choice(np.arange(0, n_channels - 4, 4), 2, replace=False))
+        groups = [(starts[0], 3), (starts[1], 4)][:1 + i % 2]
+        values = np.concatenate([rng.uniform(0.1, 1, n) for _, n in groups])
+        values[0] = 0
+        for (f, n), v in zip(groups, np.split(values, np.cumsum([n for _, n in groups])[:-1])):
+            dense[i, f:f + n] = v
+        n_grp.append(len(groups))
+        f_chan.append([f for f, _ in groups] + [0] * (2 - len(groups)))
+        n_chan.append([n for _, n in groups] + [0] * (2 - len(groups)))
+        matrix.append(np.r_[values, np.zeros(7 - len(values))])
+
+    matrix_hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='ENERG_LO', array=np.arange(n_energies, dtype=float), format='E'),
+        fits.Column(name='ENERG_HI', array=np.arange(1, n_energies + 1, dtype=float), format='E'),
+        fits.Column(name='N_GRP', array=n_grp, format='I'),
+        fits.Column(name='F_CHAN', array=f_chan, format='2I'),
+        fits.Column(name='N_CHAN', array=n_chan, format='2I'),
+        fits.Column(name='MATRIX', array=matrix, format='7E')], name='JMX1-RMF.-RSP')
+    matrix_hdu.header['TLMIN4'] = 0
+    matrix_hdu.header['DETCHANS'] = n_channels
+    ebounds = fits.BinTableHDU.from_columns([fits.Column(name='CHANNEL', array=np.arange(n_channels), format='I'),
+                                             fits.Column(name='E_MIN', array=np.arange(n_channels, dtype=float), format='E'),
+                                             fits.Column(name='E_MAX', array=np.arange(1, n_channels + 1, dtype=float),
+                                                         format='E')], name='JMX1-FBDS-MOD')
+    rmf_file = str(tmp_path / 'rmf.fits')
+    fits.HDUList([fits.PrimaryHDU(), matrix_hdu, ebounds]).writeto(rmf_file)
+
+    extnames = {'JMX1-RMF.-RSP': 'SPECRESP MATRIX', 'JMX1-FBDS-MOD': 'EBOUNDS'}
+    rmf = OsaResponseProduct('jemx_rmf', 'rmf.fits', rmf_file, extnames, file_dir=str(tmp_path / 'out'),
+                             meta_data={})
+
+    models = rng.uniform(0, 10, (20, n_energies))
+    specresp = rng.uniform(10, 100, n_energies)
+    expected = (models * specresp) @ dense
+
+    response = rmf.sparse_response()
+    assert response.nnz == np.count_nonzero(dense)
+    assert np.array_equal(response.to_dense(), dense.astype(np.float32).astype(float))
+    assert np.allclose(response.fold(models, specresp), expected, rtol=1e-6)
+    assert np.allclose(response.fold(models[3]), models[3] @ dense, rtol=1e-6)
+    assert np.array_equal(response.e_min, np.arange(n_channels))
+
+    # cached by content, decoded once
+    monkeypatch.setattr(osa_response.response_cache, 'get', None)
+    assert get_sparse_response(rmf_file, extnames) is response
+    assert rmf.sparse_response() is response
+
+    with pytest.raises(ValueError):
+        response.fold(models[:, 1:])
+
+    # without scipy
+    monkeypatch.setitem(sys.modules, 'scipy.sparse', None)
+    monkeypatch.setattr(osa_response, '_fold_chunk_size', 1000)
+    response_numpy = SparseResponse(response.indptr, response.channels, response.values, response.n_channels)
+    assert response_numpy._matrix_t is None
+    assert np.allclose(response_numpy.fold(models, specresp), response.fold(models, specresp))
+
+
+def test_spectra_built_in_parallel(tmp_path, monkeypatch):
+    from cdci_data_analysis.analysis.products import QueryProductList
+    from cdci_osa_plugin.osa_spectrum_query import OsaSpectrumProduct, IsgriSpectrumProduct, IsgriSpectrumQuery
+
+    (tmp_path / 'scw').mkdir()
+    res = _isgri_spectra_res(tmp_path, 12, [tmp_path / 'rmf.fits', tmp_path / 'scw' / 'rmf_other.fits'])
+
+    class Instrument(object):
+        _current_par_dic = {'src_name': 'test'}
+
+        class disp_conf(object):
+            products_url = 'http://products'
+
+    outputs = {}
+    for workers in 1, 4:
+        monkeypatch.setattr(OsaSpectrumProduct, 'build_workers', workers)
+        monkeypatch.setattr(OsaSpectrumProduct, 'build_max_pending_mb', 1)
+
+        out_dir = tmp_path / ('out_%d' % workers)
+        out_dir.mkdir()
+
+        spec_list = IsgriSpectrumProduct.build_list_from_ddosa_res(res, prod_prefix='query', out_dir=str(out_dir))
+        query_out = IsgriSpectrumQuery('isgri_spectrum_query').process_product_method(
+            Instrument(), QueryProductList(prod_list=spec_list))
+
+        outputs[workers] = ([(product.name, product.meta_data['src_name'], product.file_path.name)
+                             for product in spec_list],
+                            {key: query_out.prod_dictionary[key]
+                             for key in ('spectrum_name', 'ph_file_name', 'arf_file_name', 'rmf_file_name')},
+                            {path.name: path.read_bytes() for path in out_dir.iterdir()})
+
+    assert outputs[1] == outputs[4]
+    products, prod_dictionary, files = outputs[4]
+    assert [name for name, _, _ in products[:3]] == ['isgri_spectrum', 'isgri_arf', 'isgri_rmf']
+    assert prod_dictionary['spectrum_name'] == ['source %d' % i for i in range(12)]
+    # the same content, in two files
+    assert prod_dictionary['rmf_file_name'] == ['query_rmf.fits'] * 12
+    assert len(files) == 12 + 12 + 1
+
+
+def test_parallel_gzip(tmp_path, monkeypatch):
+    import gzip
+    import io
+    import zlib
+    import numpy as np
+    from astropy.io import fits
+    from oda_api.data_products import NumpyDataProduct
+    from cdci_osa_plugin import osa_compress
+    from cdci_osa_plugin.osa_compress import ParallelGzipWriter, compress_file, is_gzip
+    from cdci_osa_plugin.osa_lightcurve_query import OsaLightCurve
+    from cdci_osa_plugin.osa_spectrum_query import OsaResponseProduct
+
+    rng = np.random.RandomState(9)
+    data = rng.bytes(300000) + bytes(500000) + np.arange(200000, dtype='>i4').tobytes()
+
+    for workers in 1, 4:
+        for payload in data, b'', b'x':
+            f = io.BytesIO()
+            with ParallelGzipWriter(f, compresslevel=6, workers=workers, block_size=65536) as writer:
+                for i in range(0, len(payload), 10000):
+                    writer.write(payload[i:i + 10000])
+            assert gzip.decompress(f.getvalue()) == payload
+            # a single member, checked by zlib too
+            assert zlib.decompress(f.getvalue(), 16 + zlib.MAX_WBITS) == payload
+
+    # primed blocks compress about as well as a single stream
+    assert len(f.getvalue()) < 1.05 * len(gzip.compress(payload, 6)) + 100
+
+    (tmp_path / 'data').write_bytes(data)
+    compress_file(str(tmp_path / 'data'), compresslevel=1, workers=3, block_size=100000)
+    assert is_gzip(str(tmp_path / 'data'))
+    assert gzip.decompress((tmp_path / 'data').read_bytes()) == data
+
+    # products written compressed
+    monkeypatch.setattr(osa_compress, 'gzip_level', 6)
+
+    du = _lc_data_unit(3000. + 0.01 * np.arange(100))
+    lc = OsaLightCurve(name='isgri_lc', data=NumpyDataProduct(data_unit=[du]), file_name='lc.fits',
+                       file_dir=str(tmp_path), prod_prefix='', src_name='Crab', meta_data={})
+    osa_compress.gzip_file_path(lc)
+    lc.write()
+    osa_compress.compress_product(lc)
+    assert lc.file_path.name == 'lc.fits.gz'
+    assert is_gzip(lc.file_path.path)
+    with fits.open(lc.file_path.path) as f:
+        assert np.array_equal(f['ISGR-SRC.-LCR'].data['TIME'], du.data['TIME'])
+
+    # responses rewritten compressed, or copied as they are if there is nothing to change
+    arf = fits.BinTableHDU.from_columns([fits.Column(name='SPECRESP', array=np.ones(100), format='E')],
+                                        name='JMX1-AXIS-ARF')
+    with gzip.open(tmp_path / 'arf.fits.gz', 'wb') as f:
+        fits.HDUList([fits.PrimaryHDU(), arf]).writeto(f)
+    arf.name = 'SPECRESP'
+    with gzip.open(tmp_path / 'arf_ogip.fits.gz', 'wb') as f:
+        fits.HDUList([fits.PrimaryHDU(), arf]).writeto(f)
+
+    (tmp_path / 'out').mkdir()
+    for in_file in 'arf.fits.gz', 'arf_ogip.fits.gz':
+        product = OsaResponseProduct('jemx_arf', in_file, str(tmp_path / in_file), {'JMX1-AXIS-ARF': 'SPECRESP'},
+                                     file_dir=str(tmp_path / 'out'), meta_data={})
+        product.add_url_to_fits_file({'src_name': 'crab'}, url='http://products')
+        product.write()
+
+        assert is_gzip(product.file_path.path)
+        with fits.open(product.file_path.path) as f:
+            assert [hdu.name for hdu in f] == ['PRIMARY', 'SPECRESP']
+            assert np.array_equal(f['SPECRESP'].data['SPECRESP'], arf.data['SPECRESP'])
+
+    assert (tmp_path / 'out' / 'arf_ogip.fits.gz').read_bytes() == (tmp_path / 'arf_ogip.fits.gz').read_bytes()
+    assert (tmp_path / 'out' / 'arf.fits.gz').read_bytes() != (tmp_path / 'arf.fits.gz').read_bytes()
+
+    # url cards in the primary header: rewritten
+    from cdci_data_analysis.analysis.products import SpectrumProduct
+
+    def add_url_to_fits_file(self, par_dict, url='', **kwargs):
+        self.data.get_data_unit(0).header['URL'] = url
+
+    monkeypatch.setattr(SpectrumProduct, 'add_url_to_fits_file', add_url_to_fits_file)
+
+    product = OsaResponseProduct('jemx_arf', 'arf_url.fits.gz', str(tmp_path / 'arf_ogip.fits.gz'),
+                                 {'JMX1-AXIS-ARF': 'SPECRESP'}, file_dir=str(tmp_path / 'out'), meta_data={})
+    product.add_url_to_fits_file({'src_name': 'crab'}, url='http://products')
+    product.write()
+    with fits.open(product.file_path.path) as f:
+        assert f[0].header['URL'] == 'http://products'